@@ -0,0 +1,349 @@
+"""Archivo mensual de movimientos antiguos fuera de `transacciones_moneda`.
+
+Los movimientos con más de `ARCHIVO_EDAD_DIAS` se mueven por lotes a
+colecciones `transacciones_moneda_archivo_AAAAMM`, una por mes de `fecha`,
+para que los índices de la colección caliente sigan cabiendo en memoria.
+Cada lote se copia a su partición y se borra de la caliente en la misma
+transacción: tras una caída no quedan movimientos duplicados ni perdidos, y
+el siguiente lote retoma desde lo que siga en la caliente.
+
+- Las solicitudes de servicio pendientes no se archivan: pueden aceptarse
+  todavía y `aceptar_servicio` las busca en la colección caliente.
+- Si corre el conciliador, solo se archiva lo que su checkpoint ya sumó.
+- `archivo_particiones` guarda una entrada por partición con el rango
+  `[desde, hasta)` de fechas que puede contener; la exportación por rango
+  la usa para abrir solo las particiones de ese rango.
+- `archivo_usuarios` guarda, en la misma transacción que cada lote, una
+  entrada `{usuario, particion, hasta}` por usuario con movimientos en la
+  partición. Los historiales abren solo las particiones del usuario. Al
+  arrancar, el archivador indexa las particiones anteriores a este índice
+  (las que no tienen `usuarios_indexados`).
+
+Debe ejecutarse un solo proceso a la vez:
+
+    python -m app.db.archivo --puerto-metricas 9102
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from prometheus_client import Counter, Histogram, start_http_server
+from pymongo import UpdateOne
+
+from app.db.indices import INDICES_ARCHIVO, INDICES_ARCHIVO_USUARIOS
+from app.db.mongo import (
+    archivo_particiones,
+    archivo_particiones_lectura,
+    archivo_usuarios,
+    archivo_usuarios_lectura,
+    coleccion,
+    transacciones_collection,
+    transacciones_lectura,
+)
+from app.db.transaccional import ejecutar_transaccion
+
+# Compartido por el archivador y la API: por debajo de `ahora - edad` el
+# historial consulta el catálogo de particiones
+ARCHIVO_EDAD_DIAS = int(os.getenv("ARCHIVO_EDAD_DIAS", "365"))
+ARCHIVO_LOTE = int(os.getenv("ARCHIVO_LOTE", "1000"))
+ARCHIVO_PAUSA_SEGUNDOS = float(os.getenv("ARCHIVO_PAUSA_SEGUNDOS", "0.5"))
+ARCHIVO_ESPERA_SEGUNDOS = float(os.getenv("ARCHIVO_ESPERA_SEGUNDOS", "3600"))
+
+PREFIJO = "transacciones_moneda_archivo_"
+_FECHA_MINIMA = datetime.min
+
+ARCHIVO_MOVIDOS = Counter(
+    "archivo_movidos_total",
+    "Movimientos trasladados de la colección caliente al archivo",
+)
+ARCHIVO_LOTE_SEGUNDOS = Histogram(
+    "archivo_lote_segundos",
+    "Duración de cada lote del archivador (lectura, copia y borrado)",
+)
+
+
+class ArchivoInconsistente(Exception):
+    """El borrado no coincide con lo copiado; la transacción se aborta."""
+
+
+def horizonte() -> datetime:
+    return datetime.utcnow() - timedelta(days=ARCHIVO_EDAD_DIAS)
+
+
+def _mes(fecha: datetime) -> datetime:
+    return datetime(fecha.year, fecha.month, 1)
+
+
+def _mes_siguiente(mes: datetime) -> datetime:
+    return datetime(mes.year + mes.month // 12, mes.month % 12 + 1, 1)
+
+
+def nombre_particion(fecha: datetime) -> str:
+    return f"{PREFIJO}{fecha:%Y%m}"
+
+
+async def preparar_particion(mes: datetime) -> str:
+    """Registra la partición del mes y crea sus índices antes de escribir en ella."""
+    nombre = nombre_particion(mes)
+    await archivo_particiones.update_one(
+        {"_id": nombre},
+        {
+            "$setOnInsert": {
+                "desde": mes,
+                "hasta": _mes_siguiente(mes),
+                "documentos": 0,
+                # Nace vacía: todo lo que reciba se indexa en el mismo lote
+                "usuarios_indexados": True,
+            }
+        },
+        upsert=True,
+    )
+    await coleccion(nombre).create_indexes(INDICES_ARCHIVO)
+    # También crea la colección: dentro de la transacción no se podría
+    await archivo_usuarios.create_indexes(INDICES_ARCHIVO_USUARIOS)
+    return nombre
+
+
+def _usuarios(documentos) -> set:
+    return {
+        usuario
+        for documento in documentos
+        for usuario in (documento.get("id_emisor"), documento.get("id_receptor"))
+        if usuario and usuario != "admin"
+    }
+
+
+def _entrada_usuario(usuario: str, particion: str, hasta: datetime) -> UpdateOne:
+    return UpdateOne(
+        {"_id": f"{usuario}|{particion}"},
+        {"$setOnInsert": {"usuario": usuario, "particion": particion, "hasta": hasta}},
+        upsert=True,
+    )
+
+
+async def indexar_particiones() -> int:
+    """Rellena `archivo_usuarios` para las particiones creadas antes de que existiera.
+
+    Devuelve cuántas particiones indexó. Es idempotente y puede repetirse
+    tras una caída.
+    """
+    await archivo_usuarios.create_indexes(INDICES_ARCHIVO_USUARIOS)
+    indexadas = 0
+    async for particion in archivo_particiones.find({"usuarios_indexados": {"$ne": True}}):
+        nombre, hasta = particion["_id"], particion["hasta"]
+        cursor = coleccion(nombre).aggregate(
+            [
+                {"$project": {"usuario": ["$id_emisor", "$id_receptor"]}},
+                {"$unwind": "$usuario"},
+                {"$match": {"usuario": {"$nin": [None, "", "admin"]}}},
+                {"$group": {"_id": "$usuario"}},
+                {
+                    "$project": {
+                        "_id": {"$concat": ["$_id", f"|{nombre}"]},
+                        "usuario": "$_id",
+                        "particion": nombre,
+                        "hasta": hasta,
+                    }
+                },
+                {"$merge": {"into": "archivo_usuarios", "on": "_id", "whenMatched": "keepExisting"}},
+            ],
+            allowDiskUse=True,
+        )
+        await cursor.to_list(None)
+        await archivo_particiones.update_one({"_id": nombre}, {"$set": {"usuarios_indexados": True}})
+        indexadas += 1
+    return indexadas
+
+
+async def archivar_lote(tamano: int = ARCHIVO_LOTE) -> int:
+    """Mueve el siguiente lote de movimientos antiguos. Devuelve cuántos movió."""
+    inicio = time.perf_counter()
+    filtro = {
+        "fecha": {"$lt": horizonte()},
+        "$nor": [{"tipo": "servicio", "estado": "pending"}],
+    }
+    # Import local: la API importa este módulo y no debe registrar las métricas del conciliador
+    from app.db.conciliacion import leer_checkpoint
+
+    checkpoint = await leer_checkpoint()
+    if checkpoint.get("ultimo_id"):
+        filtro["_id"] = {"$lte": checkpoint["ultimo_id"]}
+
+    lote = await transacciones_collection.find(filtro).sort("fecha", 1).limit(tamano).to_list(None)
+    if not lote:
+        return 0
+
+    por_particion = {}
+    for transaccion in lote:
+        por_particion.setdefault(_mes(transaccion["fecha"]), []).append(transaccion)
+    # Los índices no se pueden crear dentro de la transacción
+    nombres = {mes: await preparar_particion(mes) for mes in por_particion}
+
+    async def operacion(session):
+        for mes, documentos in por_particion.items():
+            await coleccion(nombres[mes]).insert_many(documentos, session=session)
+            await archivo_particiones.update_one(
+                {"_id": nombres[mes]}, {"$inc": {"documentos": len(documentos)}}, session=session
+            )
+            entradas = [_entrada_usuario(u, nombres[mes], _mes_siguiente(mes)) for u in _usuarios(documentos)]
+            if entradas:
+                await archivo_usuarios.bulk_write(entradas, ordered=False, session=session)
+        borrado = await transacciones_collection.delete_many(
+            {"_id": {"$in": [t["_id"] for t in lote]}}, session=session
+        )
+        if borrado.deleted_count != len(lote):
+            # Otro proceso tocó el lote entre la lectura y la transacción
+            raise ArchivoInconsistente(f"Se copiaron {len(lote)} movimientos y se borraron {borrado.deleted_count}")
+
+    try:
+        await ejecutar_transaccion("archivar", operacion)
+    except ArchivoInconsistente as exc:
+        print(f"🔴 Lote de archivo descartado: {exc}")
+        return 0
+    ARCHIVO_MOVIDOS.inc(len(lote))
+    ARCHIVO_LOTE_SEGUNDOS.observe(time.perf_counter() - inicio)
+    return len(lote)
+
+
+async def _siguiente(fuente):
+    try:
+        return await fuente.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def _particiones_de(usuario: str, session=None) -> list:
+    """Particiones con movimientos del usuario, de la más reciente a la más antigua.
+
+    Incluye también las aún no indexadas, para no perder filas mientras
+    `indexar_particiones` no haya terminado.
+    """
+    propias = await archivo_usuarios_lectura.find(
+        {"usuario": usuario}, {"particion": 1, "hasta": 1}, session=session
+    ).sort("hasta", -1).to_list(None)
+    sin_indexar = await archivo_particiones_lectura.find(
+        {"usuarios_indexados": {"$ne": True}}, {"hasta": 1}, session=session
+    ).to_list(None)
+    particiones = {p["particion"]: p["hasta"] for p in propias}
+    particiones.update({p["_id"]: p["hasta"] for p in sin_indexar})
+    return [
+        {"_id": nombre, "hasta": hasta}
+        for nombre, hasta in sorted(particiones.items(), key=lambda p: p[1], reverse=True)
+    ]
+
+
+async def mezclar(abrir, orden, usuario: str, session=None, maximo: Optional[int] = None):
+    """Une la colección caliente con las particiones del usuario, de más reciente a más antiguo.
+
+    `abrir(coleccion)` devuelve un generador asíncrono ya ordenado por
+    `ORDEN_KEYSET` y `orden(elemento)` su clave `(fecha, _id)`. Las
+    particiones del usuario solo se buscan cuando la caliente se agota o
+    llega a fechas anteriores al horizonte del archivador, y cada una se
+    abre cuando su rango alcanza la fila siguiente; una página reciente no
+    toca el archivo y un usuario sin movimientos archivados no abre ninguna
+    partición. Tras emitir `maximo` elementos no se lee nada más.
+
+    Un movimiento que se archiva mientras se lee puede aparecer en ambas
+    fuentes: se descarta la copia del archivo.
+    """
+    if maximo is not None and maximo <= 0:
+        return
+    limite = horizonte()
+    caliente = abrir(transacciones_lectura)
+    fuentes = [[await _siguiente(caliente), caliente, True]]
+    particiones: Optional[list] = None
+    vistos_antiguos = set()
+    emitidos = 0
+
+    def clave(fuente):
+        elemento = fuente[0]
+        fecha, _id = orden(elemento)
+        return fecha or _FECHA_MINIMA, _id
+
+    try:
+        while True:
+            activas = [f for f in fuentes if f[0] is not None]
+            mejor = max(activas, key=clave, default=None)
+
+            if particiones is None and (fuentes[0][0] is None or clave(fuentes[0])[0] < limite):
+                particiones = await _particiones_de(usuario, session)
+            while particiones and (mejor is None or particiones[0]["hasta"] > clave(mejor)[0]):
+                fuente = abrir(coleccion(particiones.pop(0)["_id"], lectura=True))
+                fuentes.append([await _siguiente(fuente), fuente, False])
+                mejor = max((f for f in fuentes if f[0] is not None), key=clave, default=None)
+
+            if mejor is None:
+                return
+            elemento = mejor[0]
+            _id = orden(elemento)[1]
+            emitir = True
+            if mejor[2]:
+                if clave(mejor)[0] < limite:
+                    vistos_antiguos.add(_id)
+            elif _id in vistos_antiguos:
+                emitir = False
+            if emitir:
+                yield elemento
+                emitidos += 1
+                if emitidos == maximo:
+                    return
+            mejor[0] = await _siguiente(mejor[1])
+    finally:
+        for _, fuente, _ in fuentes:
+            await fuente.aclose()
+
+
+async def movimientos_en_rango(filtro: dict, desde: datetime, hasta: datetime):
+    """Movimientos del filtro con fecha en `[desde, hasta)`: primero el archivo, mes a mes, y luego la caliente.
+
+    Cada fuente sale ordenada por `fecha`; las filas aún sin archivar de la
+    caliente pueden ser anteriores a las de la última partición.
+    """
+    particiones = await archivo_particiones_lectura.find(
+        {"hasta": {"$gt": desde}, "desde": {"$lt": hasta}}, {"_id": 1}
+    ).sort("desde", 1).to_list(None)
+    fuentes = [coleccion(p["_id"], lectura=True) for p in particiones] + [transacciones_lectura]
+    for fuente in fuentes:
+        async for documento in fuente.find(filtro).sort("fecha", 1):
+            yield documento
+
+
+async def ejecutar(args) -> None:
+    indexadas = await indexar_particiones()
+    if indexadas:
+        print(f"{indexadas} particiones anteriores indexadas por usuario")
+    while True:
+        movidos = 0
+        while True:
+            n = await archivar_lote(args.lote)
+            movidos += n
+            if n < args.lote:
+                break
+            await asyncio.sleep(args.pausa)
+        print(f"Archivo al día hasta {horizonte().isoformat()}: {movidos} movimientos trasladados")
+        if args.una_vez:
+            return
+        await asyncio.sleep(args.espera)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lote", type=int, default=ARCHIVO_LOTE, help="Movimientos por transacción")
+    parser.add_argument(
+        "--pausa", type=float, default=ARCHIVO_PAUSA_SEGUNDOS, help="Pausa entre lotes para no saturar el primario"
+    )
+    parser.add_argument("--espera", type=float, default=ARCHIVO_ESPERA_SEGUNDOS, help="Pausa al estar al día")
+    parser.add_argument("--puerto-metricas", type=int, help="Expone /metrics en este puerto")
+    parser.add_argument("--una-vez", action="store_true", help="Termina al ponerse al día (para cron)")
+    args = parser.parse_args()
+
+    if args.puerto_metricas:
+        start_http_server(args.puerto_metricas)
+    asyncio.run(ejecutar(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Change stream compartido de solicitudes de servicio y su reparto por proveedor."""
+import asyncio
+import contextvars
+import os
+from collections import defaultdict
+from typing import AsyncIterator, Dict, Optional, Set
+
+from prometheus_client import Counter, Gauge
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.db.mongo import transacciones_collection
+
+SSE_COLA_MAXIMA = int(os.getenv("SSE_COLA_MAXIMA", "100"))
+# Espera máxima a que el stream compartido quede abierto al suscribirse
+SSE_APERTURA_SEGUNDOS = float(os.getenv("SSE_APERTURA_SEGUNDOS", "5"))
+_CHANGE_STREAM_HISTORY_LOST = 286
+
+# Solo solicitudes nuevas y cambios de estado de servicios
+PIPELINE_SERVICIOS = [
+    {
+        "$match": {
+            "fullDocument.tipo": "servicio",
+            "$or": [
+                {"operationType": "insert", "fullDocument.estado": "pending"},
+                {"operationType": "replace"},
+                {
+                    "operationType": "update",
+                    "updateDescription.updatedFields.estado": {"$exists": True},
+                },
+            ],
+        }
+    }
+]
+
+SUSCRIPTORES = Gauge(
+    "sse_pendientes_suscriptores",
+    "Conexiones suscritas a solicitudes pendientes",
+    multiprocess_mode="livesum",
+)
+EVENTOS_REPARTIDOS = Counter(
+    "sse_pendientes_eventos_total", "Cambios de servicios entregados a suscriptores"
+)
+DESBORDES = Counter(
+    "sse_pendientes_desbordes_total",
+    "Suscriptores desconectados por no consumir sus eventos a tiempo",
+)
+
+
+def id_evento(cambio: dict) -> str:
+    """Resume token del cambio en forma de texto, usado como `id` del evento SSE."""
+    return cambio["_id"]["_data"]
+
+
+class Suscripcion:
+    def __init__(self, proveedor_id: str):
+        self.proveedor_id = proveedor_id
+        # None en la cola indica que la conexión debe cerrarse y reanudarse
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=SSE_COLA_MAXIMA)
+
+    def cerrar(self):
+        while not self.cola.empty():
+            self.cola.get_nowait()
+        self.cola.put_nowait(None)
+
+
+class DifusorServicios:
+    """Un solo change stream sobre `transacciones_moneda` repartido por `id_receptor`.
+
+    El stream se abre con el primer suscriptor y se cierra con el último. Si
+    se corta, se reanuda desde el último resume token (el del último evento
+    o, sin eventos, el `postBatchResumeToken` del último lote); si no hay
+    token o el oplog ya no lo contiene, se cierran todas las suscripciones
+    para que los clientes reconecten y reciban el estado completo.
+    """
+
+    def __init__(self):
+        self._suscriptores: Dict[str, Set[Suscripcion]] = defaultdict(set)
+        self._tarea: Optional[asyncio.Task] = None
+        self._abierto: Optional[asyncio.Event] = None
+
+    async def suscribir(self, proveedor_id: str) -> Suscripcion:
+        """Registra la suscripción y espera a que el stream compartido esté abierto.
+
+        Todo cambio posterior al retorno llega a la cola, así que el estado
+        leído después no deja huecos. Lanza `asyncio.TimeoutError` si el
+        stream no se abre en `SSE_APERTURA_SEGUNDOS`.
+        """
+        suscripcion = Suscripcion(proveedor_id)
+        self._suscriptores[proveedor_id].add(suscripcion)
+        SUSCRIPTORES.inc()
+        if self._tarea is None or self._tarea.done():
+            self._abierto = asyncio.Event()
+            # Contexto vacío: la tarea es compartida y sobrevive a la solicitud
+            # que la creó, no debe heredar sus contextvars (p. ej. el contador
+            # de comandos Mongo de esa solicitud)
+            self._tarea = asyncio.create_task(
+                self._escuchar(self._abierto), context=contextvars.Context()
+            )
+        try:
+            await asyncio.wait_for(self._abierto.wait(), SSE_APERTURA_SEGUNDOS)
+        except BaseException:
+            self.cancelar(suscripcion)
+            raise
+        return suscripcion
+
+    def cancelar(self, suscripcion: Suscripcion):
+        grupo = self._suscriptores.get(suscripcion.proveedor_id)
+        if grupo is None or suscripcion not in grupo:
+            return
+        grupo.discard(suscripcion)
+        SUSCRIPTORES.dec()
+        if not grupo:
+            del self._suscriptores[suscripcion.proveedor_id]
+        if not self._suscriptores and self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    async def detener(self):
+        for grupo in list(self._suscriptores.values()):
+            for suscripcion in grupo:
+                suscripcion.cerrar()
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    def _repartir(self, cambio: dict):
+        documento = cambio.get("fullDocument")
+        if not documento:
+            return
+        for suscripcion in list(self._suscriptores.get(documento.get("id_receptor"), ())):
+            try:
+                suscripcion.cola.put_nowait(cambio)
+                EVENTOS_REPARTIDOS.inc()
+            except asyncio.QueueFull:
+                # El cliente reconectará con Last-Event-ID y recuperará lo perdido
+                DESBORDES.inc()
+                suscripcion.cerrar()
+
+    async def _escuchar(self, abierto: asyncio.Event):
+        token = None
+        while True:
+            stream = None
+            try:
+                async with transacciones_collection.watch(
+                    PIPELINE_SERVICIOS, full_document="updateLookup", resume_after=token
+                ) as stream:
+                    token = stream.resume_token or token
+                    abierto.set()
+                    async for cambio in stream:
+                        token = cambio["_id"]
+                        self._repartir(cambio)
+            except PyMongoError as exc:
+                print(f"🔴 Change stream de servicios interrumpido: {exc}")
+                if stream is not None and stream.resume_token:
+                    # Avanza con los lotes vacíos aunque no lleguen eventos
+                    token = stream.resume_token
+                perdido = isinstance(exc, OperationFailure) and exc.code == _CHANGE_STREAM_HISTORY_LOST
+                if perdido or token is None:
+                    # Sin punto de reanudación hay un hueco: los clientes
+                    # reconectan con Last-Event-ID o reciben el estado completo
+                    token = None
+                    abierto.clear()
+                    for grupo in list(self._suscriptores.values()):
+                        for suscripcion in grupo:
+                            suscripcion.cerrar()
+                await asyncio.sleep(1)
+
+
+async def ponerse_al_dia(proveedor_id: str, ultimo_id: str) -> AsyncIterator[dict]:
+    """Recorre los cambios del proveedor posteriores a `ultimo_id` hasta el presente.
+
+    Usa un change stream privado que termina en cuanto no quedan cambios
+    disponibles. Lanza `OperationFailure` si el token es inválido o ya salió
+    del oplog.
+    """
+    pipeline = PIPELINE_SERVICIOS + [{"$match": {"fullDocument.id_receptor": proveedor_id}}]
+    async with transacciones_collection.watch(
+        pipeline,
+        full_document="updateLookup",
+        resume_after={"_data": ultimo_id},
+        max_await_time_ms=100,
+    ) as stream:
+        while True:
+            cambio = await stream.try_next()
+            if cambio is None:
+                return
+            yield cambio
+
+
+difusor_servicios = DifusorServicios()
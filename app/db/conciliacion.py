@@ -0,0 +1,284 @@
+"""Conciliación incremental entre `usuarios.saldo_creditos` y el ledger.
+
+Recorre `transacciones_moneda` por `_id` desde el último checkpoint y
+acumula en `conciliacion_saldos` lo que el ledger dice que debe tener cada
+usuario. Cada lote suma y avanza el checkpoint en la misma transacción, de
+modo que tras una caída se retoma exactamente donde quedó, sin releer nada.
+
+- Solo se leen movimientos con `_id` anterior a `ahora - margen`: un
+  movimiento con `_id` menor puede confirmarse después que uno mayor
+  mientras su transacción siga abierta.
+- Las solicitudes de servicio pendientes no mueven saldo al insertarse; se
+  apuntan en `conciliacion_pendientes` y se suman cuando se aceptan.
+- Una vez al día con el ledger se compara cada saldo con su suma. Una
+  diferencia no cuenta si el usuario tiene movimientos posteriores al
+  checkpoint, y solo se marca como deriva si se repite igual en dos
+  comprobaciones seguidas (el estado se guarda, así que también vale entre
+  ejecuciones con `--una-vez`).
+
+Debe ejecutarse un solo proceso a la vez:
+
+    python -m app.db.conciliacion --puerto-metricas 9101
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from pymongo import DeleteOne, UpdateOne
+
+from app.db.mongo import (
+    conciliacion_estado,
+    conciliacion_pendientes,
+    conciliacion_saldos,
+    transacciones_collection,
+    usuarios_collection,
+)
+from app.db.resumenes import aportes, cuenta_en_resumen
+from app.db.transaccional import ejecutar_transaccion
+from app.utils.contrapartes import iterar_por_lotes
+
+CONCILIACION_LOTE = int(os.getenv("CONCILIACION_LOTE", "5000"))
+# Más que la vida máxima de una transacción (60 s por defecto en mongod)
+CONCILIACION_MARGEN_SEGUNDOS = float(os.getenv("CONCILIACION_MARGEN_SEGUNDOS", "120"))
+CONCILIACION_ESPERA_SEGUNDOS = float(os.getenv("CONCILIACION_ESPERA_SEGUNDOS", "10"))
+CONCILIACION_VERIFICAR_SEGUNDOS = float(os.getenv("CONCILIACION_VERIFICAR_SEGUNDOS", "300"))
+CONCILIACION_TOLERANCIA = float(os.getenv("CONCILIACION_TOLERANCIA", "0.001"))
+
+_CHECKPOINT = "checkpoint"
+_PROYECCION = {"id_emisor": 1, "id_receptor": 1, "monto": 1, "tipo": 1, "estado": 1, "fecha": 1}
+_APORTE_SIGNO = {"enviado": -1, "recibido": 1, "bonificado": 1}
+
+CONCILIACION_MOVIMIENTOS = Counter(
+    "conciliacion_movimientos_total",
+    "Movimientos del ledger sumados por el conciliador",
+)
+CONCILIACION_LOTE_SEGUNDOS = Histogram(
+    "conciliacion_lote_segundos",
+    "Duración de cada lote del conciliador (lectura, suma y checkpoint)",
+)
+CONCILIACION_RETRASO = Gauge(
+    "conciliacion_retraso_segundos",
+    "Antigüedad del último movimiento conciliado",
+)
+CONCILIACION_PENDIENTES = Gauge(
+    "conciliacion_pendientes",
+    "Solicitudes pendientes que el conciliador espera ver completadas",
+)
+CONCILIACION_DERIVAS = Gauge(
+    "conciliacion_usuarios_con_deriva",
+    "Usuarios cuyo saldo no coincide con el ledger en dos comprobaciones seguidas",
+)
+
+
+def _sumas(transacciones) -> dict:
+    """Efecto neto de cada movimiento sobre el saldo de cada usuario."""
+    sumas = {}
+    for transaccion in transacciones:
+        monto = float(transaccion.get("monto", 0))
+        for usuario, campo in aportes(transaccion):
+            suma = sumas.setdefault(usuario, [0.0, 0])
+            suma[0] += _APORTE_SIGNO[campo] * monto
+            suma[1] += 1
+    return sumas
+
+
+def _operaciones_sumas(sumas: dict) -> list:
+    return [
+        UpdateOne({"_id": usuario}, {"$inc": {"suma": suma, "movimientos": n}}, upsert=True)
+        for usuario, (suma, n) in sumas.items()
+    ]
+
+
+async def leer_checkpoint() -> dict:
+    return await conciliacion_estado.find_one({"_id": _CHECKPOINT}) or {}
+
+
+async def procesar_lote(tamano: int = CONCILIACION_LOTE) -> bool:
+    """Concilia el siguiente lote del ledger. Devuelve True si ya está al día."""
+    inicio = time.perf_counter()
+    checkpoint = await leer_checkpoint()
+    tope = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=CONCILIACION_MARGEN_SEGUNDOS))
+    rango = {"$lt": tope}
+    if checkpoint.get("ultimo_id"):
+        rango["$gt"] = checkpoint["ultimo_id"]
+
+    cursor = transacciones_collection.find({"_id": rango}, _PROYECCION).sort("_id", 1).limit(tamano)
+    lote = await cursor.to_list(None)
+    if lote:
+        ultimo = lote[-1]
+        completados = [t for t in lote if cuenta_en_resumen(t)]
+        pendientes = [t for t in lote if not cuenta_en_resumen(t)]
+
+        async def operacion(session):
+            operaciones = _operaciones_sumas(_sumas(completados))
+            if operaciones:
+                await conciliacion_saldos.bulk_write(operaciones, ordered=False, session=session)
+            if pendientes:
+                apuntes = [
+                    UpdateOne({"_id": t["_id"]}, {"$set": {"fecha": t.get("fecha")}}, upsert=True)
+                    for t in pendientes
+                ]
+                await conciliacion_pendientes.bulk_write(apuntes, ordered=False, session=session)
+            await conciliacion_estado.update_one(
+                {"_id": _CHECKPOINT},
+                {
+                    "$set": {
+                        "ultimo_id": ultimo["_id"],
+                        "ultima_fecha": ultimo.get("fecha"),
+                        "actualizado": datetime.utcnow(),
+                    },
+                    "$inc": {"movimientos": len(lote)},
+                },
+                upsert=True,
+                session=session,
+            )
+
+        await ejecutar_transaccion("conciliacion", operacion)
+        CONCILIACION_MOVIMIENTOS.inc(len(lote))
+        CONCILIACION_LOTE_SEGUNDOS.observe(time.perf_counter() - inicio)
+        checkpoint = {"ultimo_id": ultimo["_id"]}
+
+    if checkpoint.get("ultimo_id"):
+        generado = checkpoint["ultimo_id"].generation_time.replace(tzinfo=None)
+        CONCILIACION_RETRASO.set(max(0.0, (datetime.utcnow() - generado).total_seconds()))
+    return len(lote) < tamano
+
+
+async def completar_pendientes() -> int:
+    """Suma las solicitudes apuntadas como pendientes que ya se aceptaron."""
+    completadas = 0
+    async for lote in iterar_por_lotes(conciliacion_pendientes.find({}, {"_id": 1}), CONCILIACION_LOTE):
+        ids = [p["_id"] for p in lote]
+        gestionadas = await transacciones_collection.find(
+            {"_id": {"$in": ids}, "estado": {"$ne": "pending"}}, _PROYECCION
+        ).to_list(None)
+        if not gestionadas:
+            continue
+
+        async def operacion(session):
+            operaciones = _operaciones_sumas(_sumas(t for t in gestionadas if cuenta_en_resumen(t)))
+            if operaciones:
+                await conciliacion_saldos.bulk_write(operaciones, ordered=False, session=session)
+            await conciliacion_pendientes.bulk_write(
+                [DeleteOne({"_id": t["_id"]}) for t in gestionadas], session=session
+            )
+
+        await ejecutar_transaccion("conciliacion", operacion)
+        CONCILIACION_MOVIMIENTOS.inc(len(gestionadas))
+        completadas += len(gestionadas)
+
+    CONCILIACION_PENDIENTES.set(await conciliacion_pendientes.estimated_document_count())
+    return completadas
+
+
+async def _actividad_reciente(user_id: str, ultimo_id) -> bool:
+    if ultimo_id is None:
+        return True
+    for campo in ("id_emisor", "id_receptor"):
+        if await transacciones_collection.count_documents(
+            {campo: user_id, "_id": {"$gt": ultimo_id}}, limit=1
+        ):
+            return True
+    return False
+
+
+async def verificar() -> int:
+    """Compara cada saldo con su suma y devuelve cuántos usuarios derivan."""
+    ultimo_id = (await leer_checkpoint()).get("ultimo_id")
+    con_deriva = 0
+    cursor = usuarios_collection.find({}, {"saldo_creditos": 1}).sort("_id", 1)
+    async for lote in iterar_por_lotes(cursor, CONCILIACION_LOTE):
+        ids = [str(u["_id"]) for u in lote]
+        sumas = {
+            s["_id"]: s async for s in conciliacion_saldos.find({"_id": {"$in": ids}})
+        }
+        operaciones = []
+        for usuario in lote:
+            user_id = str(usuario["_id"])
+            estado = sumas.get(user_id, {})
+            deriva = round(float(usuario.get("saldo_creditos", 0)) - estado.get("suma", 0.0), 6)
+
+            if abs(deriva) <= CONCILIACION_TOLERANCIA:
+                if "deriva_observada" in estado or "deriva_confirmada" in estado:
+                    operaciones.append(
+                        UpdateOne(
+                            {"_id": user_id},
+                            {"$unset": {"deriva_observada": "", "deriva_confirmada": "", "detectada": ""}},
+                        )
+                    )
+                continue
+            if await _actividad_reciente(user_id, ultimo_id):
+                # El saldo ya incluye movimientos que el checkpoint no ha alcanzado
+                continue
+
+            previa = estado.get("deriva_observada")
+            if previa is not None and abs(previa - deriva) <= CONCILIACION_TOLERANCIA:
+                con_deriva += 1
+                if estado.get("deriva_confirmada") != deriva:
+                    print(f"🔴 Deriva de saldo en {user_id}: saldo - ledger = {deriva}")
+                    operaciones.append(
+                        UpdateOne(
+                            {"_id": user_id},
+                            {"$set": {"deriva_confirmada": deriva, "detectada": datetime.utcnow()}},
+                            upsert=True,
+                        )
+                    )
+                continue
+
+            operaciones.append(
+                UpdateOne({"_id": user_id}, {"$set": {"deriva_observada": deriva}}, upsert=True)
+            )
+        if operaciones:
+            await conciliacion_saldos.bulk_write(operaciones, ordered=False)
+
+    CONCILIACION_DERIVAS.set(con_deriva)
+    return con_deriva
+
+
+async def ejecutar(args) -> None:
+    ultima_verificacion = None
+    while True:
+        al_dia = await procesar_lote(args.lote)
+        if not al_dia:
+            continue
+
+        await completar_pendientes()
+        ahora = time.monotonic()
+        if ultima_verificacion is None or ahora - ultima_verificacion >= args.verificar:
+            con_deriva = await verificar()
+            ultima_verificacion = ahora
+            checkpoint = await leer_checkpoint()
+            print(
+                f"Conciliación al día hasta {checkpoint.get('ultima_fecha')}: "
+                f"{checkpoint.get('movimientos', 0)} movimientos, {con_deriva} usuarios con deriva"
+            )
+        if args.una_vez:
+            return
+        await asyncio.sleep(args.espera)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lote", type=int, default=CONCILIACION_LOTE, help="Movimientos por transacción")
+    parser.add_argument("--espera", type=float, default=CONCILIACION_ESPERA_SEGUNDOS, help="Pausa al estar al día")
+    parser.add_argument(
+        "--verificar",
+        type=float,
+        default=CONCILIACION_VERIFICAR_SEGUNDOS,
+        help="Segundos entre comprobaciones de saldos",
+    )
+    parser.add_argument("--puerto-metricas", type=int, help="Expone /metrics en este puerto")
+    parser.add_argument("--una-vez", action="store_true", help="Termina al ponerse al día (para cron)")
+    args = parser.parse_args()
+
+    if args.puerto_metricas:
+        start_http_server(args.puerto_metricas)
+    asyncio.run(ejecutar(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Consistencia causal entre requests para las lecturas en secundarios.
+
+Las escrituras devuelven en `X-Consistencia-Causal` el `operationTime` y el
+`clusterTime` de su sesión. Un cliente que reenvía esa cabecera en una
+lectura obtiene una sesión causal adelantada a ese punto, de modo que
+incluso un secundario espera a haber replicado su propia escritura antes
+de responder.
+"""
+import base64
+import contextvars
+import time
+from typing import Optional
+
+import bson
+from fastapi import HTTPException, Request
+
+from app.db.mongo import client
+
+CABECERA_CONSISTENCIA = "X-Consistencia-Causal"
+
+# Margen admitido para un operationTime por delante del reloj local
+_DESFASE_MAXIMO_SEGUNDOS = 60
+
+# Igual que en monitoreo: diccionario mutable compartido con el middleware
+_contexto_escritura: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar(
+    "contexto_consistencia", default=None
+)
+
+
+def codificar_token(session) -> Optional[str]:
+    if session.operation_time is None or session.cluster_time is None:
+        return None
+    datos = bson.encode({"o": session.operation_time, "c": session.cluster_time})
+    return base64.urlsafe_b64encode(datos).decode().rstrip("=")
+
+
+def decodificar_token(token: str) -> dict:
+    try:
+        datos = bson.decode(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        operacion, cluster = datos["o"], datos["c"]
+        if not isinstance(operacion, bson.Timestamp):
+            raise ValueError("operationTime inesperado")
+        if not isinstance(cluster.get("clusterTime"), bson.Timestamp):
+            raise ValueError("clusterTime inesperado")
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"{CABECERA_CONSISTENCIA} inválida")
+    # Un token del futuro haría esperar indefinidamente a los secundarios
+    if operacion.time > time.time() + _DESFASE_MAXIMO_SEGUNDOS:
+        raise HTTPException(status_code=400, detail=f"{CABECERA_CONSISTENCIA} inválida")
+    return datos
+
+
+def registrar_escritura(session):
+    """Anota el punto de la escritura para devolverlo en la respuesta."""
+    contexto = _contexto_escritura.get()
+    token = codificar_token(session)
+    if contexto is not None and token:
+        contexto["token"] = token
+
+
+async def sesion_lectura(request: Request, siempre: bool = False):
+    """Sesión causal adelantada al token del request, o None si no trae token.
+
+    Con `siempre=True` se abre la sesión aunque no haya token, para que
+    varias lecturas del mismo request vean estados en orden aunque las
+    sirvan secundarios distintos. El llamador debe cerrarla con
+    `end_session()` cuando termine de leer, también si la respuesta se
+    emite en streaming.
+    """
+    token = request.headers.get(CABECERA_CONSISTENCIA)
+    if not token:
+        return await client.start_session(causal_consistency=True) if siempre else None
+    datos = decodificar_token(token)
+    session = await client.start_session(causal_consistency=True)
+    session.advance_cluster_time(datos["c"])
+    session.advance_operation_time(datos["o"])
+    return session
+
+
+class ConsistenciaCausal:
+    """Middleware ASGI que añade `X-Consistencia-Causal` a las respuestas de escritura."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        contexto = {}
+        token = _contexto_escritura.set(contexto)
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start" and contexto.get("token"):
+                mensaje["headers"] = list(mensaje.get("headers", [])) + [
+                    (CABECERA_CONSISTENCIA.lower().encode(), contexto["token"].encode())
+                ]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            _contexto_escritura.reset(token)
@@ -0,0 +1,128 @@
+"""Pipeline de agregación que devuelve el historial ya formado por Mongo.
+
+Reproduce en el servidor lo que hacen `_formatear_historial` y
+`ResolutorContrapartes`: clasifica cada movimiento con `$cond`, une la
+contraparte con un `$lookup` proyectado sobre `usuarios` y da a cada fila
+su forma final. Cada fila lleva además `_id` y `_fecha` crudos para poder
+generar el cursor de la página siguiente; el router los quita antes de
+responder.
+"""
+from typing import Optional
+
+from app.utils.contrapartes import USUARIOS_API_BASE_URL
+from app.utils.paginacion import ORDEN_KEYSET
+
+
+def _no_vacio(expresion) -> dict:
+    """Equivalente a la veracidad de Python para campos de texto opcionales."""
+    return {"$not": [{"$in": [{"$ifNull": [expresion, None]}, [None, ""]]}]}
+
+
+def _avatar(foto) -> dict:
+    # Misma lógica que `_build_avatar_url`
+    return {
+        "$cond": [
+            {"$not": [_no_vacio(foto)]},
+            "",
+            {
+                "$cond": [
+                    {"$eq": [{"$substrCP": [foto, 0, 1]}, "/"]},
+                    {"$concat": [USUARIOS_API_BASE_URL, foto]},
+                    foto,
+                ]
+            },
+        ]
+    }
+
+
+def pipeline_historial(user_id: str, filtro: dict, limit: Optional[int]) -> list:
+    tipo_original = {"$ifNull": ["$tipo", "transferencia"]}
+    es_bonus = {"$or": [{"$eq": [tipo_original, "asignacion"]}, {"$eq": ["$id_emisor", "admin"]}]}
+    es_recibida = {"$eq": ["$id_receptor", user_id]}
+
+    etapas = [
+        {"$match": filtro},
+        {"$sort": dict(ORDEN_KEYSET)},
+    ]
+    if limit is not None:
+        # Una fila extra indica si existe una página siguiente
+        etapas.append({"$limit": limit + 1})
+
+    etapas += [
+        {
+            "$set": {
+                "_tipo": {
+                    "$cond": [es_bonus, "bonus", {"$cond": [es_recibida, "received", "sent"]}]
+                },
+                "_contraparte": {
+                    "$cond": [{"$or": [es_bonus, es_recibida]}, "$id_emisor", "$id_receptor"]
+                },
+            }
+        },
+        {
+            "$set": {
+                "_contraparte_oid": {
+                    "$convert": {
+                        "input": "$_contraparte",
+                        "to": "objectId",
+                        "onError": None,
+                        "onNull": None,
+                    }
+                }
+            }
+        },
+        {
+            "$lookup": {
+                "from": "usuarios",
+                "localField": "_contraparte_oid",
+                "foreignField": "_id",
+                "pipeline": [{"$project": {"_id": 0, "nombres": 1, "apellidos": 1, "foto_url": 1}}],
+                "as": "_usuario",
+            }
+        },
+        {"$set": {"_usuario": {"$first": "$_usuario"}}},
+        {
+            "$set": {
+                "_nombre": {
+                    "$trim": {
+                        "input": {
+                            "$concat": [
+                                {"$ifNull": ["$_usuario.nombres", ""]},
+                                " ",
+                                {"$ifNull": ["$_usuario.apellidos", ""]},
+                            ]
+                        }
+                    }
+                }
+            }
+        },
+        {
+            "$project": {
+                "_id": 1,
+                "_fecha": "$fecha",
+                "id": {"$toString": "$_id"},
+                "type": "$_tipo",
+                "amount": {"$toDouble": {"$ifNull": ["$monto", 0]}},
+                "date": {"$ifNull": ["$fecha", "$$NOW"]},
+                "description": {
+                    "$cond": [_no_vacio("$justificacion"), "$justificacion", tipo_original]
+                },
+                "status": {"$ifNull": ["$estado", "completed"]},
+                "counterparty": {
+                    "$cond": [
+                        _no_vacio("$_contraparte"),
+                        {
+                            "id": "$_contraparte",
+                            "name": {
+                                "$cond": [{"$eq": ["$_nombre", ""]}, "Usuario", "$_nombre"]
+                            },
+                            "avatar": _avatar("$_usuario.foto_url"),
+                        },
+                        None,
+                    ]
+                },
+                "id_servicio": {"$ifNull": ["$id_servicio", None]},
+            }
+        },
+    ]
+    return etapas
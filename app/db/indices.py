@@ -0,0 +1,240 @@
+"""Índices gestionados de la API y verificación de los planes de consulta.
+
+Cada consulta de los routers registra aquí su forma en CONSULTAS junto al
+índice compuesto que la cubre en INDICES. `verificar_planes` ejecuta
+`explain()` sobre cada forma y falla si alguna cae en COLLSCAN o en un SORT
+en memoria. Para revisarlo contra un mongod local:
+
+    MONGODB_URI=mongodb://localhost:27017 python -m app.db.indices --verificar
+"""
+import asyncio
+import sys
+from datetime import datetime
+from typing import Iterator, List
+
+from bson import ObjectId
+from prometheus_client import Counter
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.db.mongo import db
+from app.utils.idempotencia import IDEMPOTENCIA_TTL_SEGUNDOS
+from app.utils.paginacion import ORDEN_KEYSET, codificar_cursor, filtro_keyset
+
+INDICES_FALLIDOS = Counter(
+    "mongo_indices_fallidos_total",
+    "Colecciones cuyos índices no se pudieron crear o actualizar",
+    ["coleccion"],
+)
+
+_ID_EJEMPLO = "000000000000000000000000"
+_KEYSET_EJEMPLO = filtro_keyset(
+    codificar_cursor({"fecha": datetime(2024, 1, 1), "_id": ObjectId(_ID_EJEMPLO)})
+)
+
+# Historiales: cada rama del $or queda ordenada por (fecha, _id)
+INDICES_HISTORIAL = [
+    IndexModel([("id_emisor", ASCENDING), ("fecha", DESCENDING), ("_id", DESCENDING)]),
+    IndexModel([("id_receptor", ASCENDING), ("fecha", DESCENDING), ("_id", DESCENDING)]),
+]
+# Particiones de `app.db.archivo`: historiales y exportación por rango de fechas
+INDICES_ARCHIVO = [*INDICES_HISTORIAL, IndexModel([("fecha", ASCENDING)])]
+# Particiones de cada usuario, de la más reciente a la más antigua
+INDICES_ARCHIVO_USUARIOS = [IndexModel([("usuario", ASCENDING), ("hasta", DESCENDING)])]
+
+INDICES = {
+    "transacciones_moneda": [
+        *INDICES_HISTORIAL,
+        # Solicitudes pendientes de un proveedor
+        IndexModel(
+            [
+                ("tipo", ASCENDING),
+                ("estado", ASCENDING),
+                ("id_receptor", ASCENDING),
+                ("fecha", DESCENDING),
+            ]
+        ),
+        IndexModel([("fecha", ASCENDING)]),
+    ],
+    "archivo_usuarios": INDICES_ARCHIVO_USUARIOS,
+    # Ventanas del limitador compartido (ADMISION_BACKEND=mongo)
+    "limites_admision": [
+        IndexModel([("expira", ASCENDING)], expireAfterSeconds=0),
+    ],
+    # Resúmenes diarios: clave única del $inc/$merge y rango de días de la plataforma
+    "resumen_diario": [
+        IndexModel(
+            [("usuario", ASCENDING), ("dia", ASCENDING), ("tipo", ASCENDING), ("origen", ASCENDING)],
+            unique=True,
+        ),
+        IndexModel([("dia", ASCENDING)]),
+    ],
+    # Los registros de Idempotency-Key caducan solos
+    "idempotencia": [
+        IndexModel([("creado", ASCENDING)], expireAfterSeconds=IDEMPOTENCIA_TTL_SEGUNDOS),
+    ],
+}
+
+# Colecciones de otros servicios: solo se crea el índice si su dueño no
+# tiene ya uno sobre las mismas claves, sean cuales sean sus opciones
+INDICES_AJENOS = {
+    # Login por correo
+    "usuarios": [
+        IndexModel([("correo", ASCENDING)]),
+    ],
+}
+
+_RAMAS_USUARIO = [{"id_emisor": _ID_EJEMPLO}, {"id_receptor": _ID_EJEMPLO}]
+
+CONSULTAS = [
+    {
+        "nombre": "historial_transacciones",
+        "coleccion": "transacciones_moneda",
+        "filtro": {"$or": _RAMAS_USUARIO},
+        "orden": ORDEN_KEYSET,
+    },
+    {
+        "nombre": "historial_transacciones_pagina",
+        "coleccion": "transacciones_moneda",
+        "filtro": {"$or": [{**rama, **_KEYSET_EJEMPLO} for rama in _RAMAS_USUARIO]},
+        "orden": ORDEN_KEYSET,
+    },
+    {
+        "nombre": "historial_servicios",
+        "coleccion": "transacciones_moneda",
+        "filtro": {"tipo": "servicio", "$or": _RAMAS_USUARIO},
+        "orden": ORDEN_KEYSET,
+    },
+    {
+        "nombre": "solicitudes_pendientes",
+        "coleccion": "transacciones_moneda",
+        "filtro": {"tipo": "servicio", "estado": "pending", "id_receptor": _ID_EJEMPLO},
+        "orden": [("fecha", DESCENDING)],
+    },
+    {
+        "nombre": "resumen_usuario",
+        "coleccion": "resumen_diario",
+        "filtro": {"usuario": _ID_EJEMPLO, "dia": {"$gte": datetime(2024, 1, 1)}},
+        "orden": None,
+    },
+    {
+        "nombre": "resumen_plataforma",
+        "coleccion": "resumen_diario",
+        "filtro": {"dia": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 2, 1)}},
+        "orden": None,
+    },
+    {
+        "nombre": "archivo_particiones_usuario",
+        "coleccion": "archivo_usuarios",
+        "filtro": {"usuario": _ID_EJEMPLO},
+        "orden": [("hasta", DESCENDING)],
+    },
+    {
+        "nombre": "login",
+        "coleccion": "usuarios",
+        "filtro": {"correo": "usuario@ejemplo.com"},
+        "orden": None,
+    },
+]
+
+ETAPAS_PROHIBIDAS = {"COLLSCAN", "SORT"}
+
+
+def _claves(claves) -> list:
+    # El shell guarda las direcciones como double (1.0); se comparan como enteros
+    return [(campo, int(orden) if isinstance(orden, float) else orden) for campo, orden in claves]
+
+
+async def _sincronizar_ttl(coleccion: str, indices: List[IndexModel], existentes: dict) -> None:
+    """Ajusta con `collMod` los TTL cambiados; `create_indexes` los rechazaría por conflicto."""
+    por_claves = {tuple(_claves(info["key"])): info for info in existentes.values()}
+    for indice in indices:
+        documento = indice.document
+        if "expireAfterSeconds" not in documento:
+            continue
+        actual = por_claves.get(tuple(_claves(documento["key"].items())))
+        if actual is None or actual.get("expireAfterSeconds") == documento["expireAfterSeconds"]:
+            continue
+        await db.command(
+            "collMod",
+            coleccion,
+            index={"keyPattern": documento["key"], "expireAfterSeconds": documento["expireAfterSeconds"]},
+        )
+        print(f"TTL de {coleccion}.{actual.get('name', documento['name'])}: {documento['expireAfterSeconds']} s")
+
+
+async def _crear_en(coleccion: str, indices: List[IndexModel], ajena: bool) -> None:
+    existentes = await db[coleccion].index_information()
+    if ajena:
+        claves = [_claves(info["key"]) for info in existentes.values()]
+        indices = [indice for indice in indices if _claves(indice.document["key"].items()) not in claves]
+    else:
+        await _sincronizar_ttl(coleccion, indices, existentes)
+    if indices:
+        nombres = await db[coleccion].create_indexes(indices)
+        print(f"Índices de {coleccion}: {', '.join(nombres)}")
+
+
+async def crear_indices() -> List[str]:
+    """Crea (si faltan) todos los índices registrados. Es idempotente.
+
+    Un conflicto con un índice existente se registra y se cuenta en
+    `mongo_indices_fallidos_total` sin detener el resto; devuelve las
+    colecciones que fallaron. Los errores de conexión sí se propagan.
+    """
+    fallidas = []
+    registrados = [(c, i, False) for c, i in INDICES.items()] + [(c, i, True) for c, i in INDICES_AJENOS.items()]
+    for coleccion, indices, ajena in registrados:
+        try:
+            await _crear_en(coleccion, indices, ajena)
+        except OperationFailure as exc:
+            INDICES_FALLIDOS.labels(coleccion).inc()
+            print(f"🔴 No se pudieron crear los índices de {coleccion}: {exc}")
+            fallidas.append(coleccion)
+    return fallidas
+
+
+def _etapas(plan) -> Iterator[str]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for valor in plan.values():
+            yield from _etapas(valor)
+    elif isinstance(plan, list):
+        for valor in plan:
+            yield from _etapas(valor)
+
+
+async def verificar_planes() -> None:
+    """Lanza RuntimeError si alguna consulta registrada no usa sus índices."""
+    errores: List[str] = []
+    for consulta in CONSULTAS:
+        cursor = db[consulta["coleccion"]].find(consulta["filtro"])
+        if consulta["orden"]:
+            cursor = cursor.sort(consulta["orden"])
+        explicacion = await cursor.explain()
+
+        plan = explicacion["queryPlanner"]["winningPlan"]
+        prohibidas = ETAPAS_PROHIBIDAS.intersection(_etapas(plan))
+        if prohibidas:
+            errores.append(f"{consulta['nombre']}: {', '.join(sorted(prohibidas))}")
+
+    if errores:
+        raise RuntimeError("Consultas sin índice adecuado -> " + "; ".join(errores))
+    print(f"{len(CONSULTAS)} consultas verificadas sin COLLSCAN ni SORT en memoria")
+
+
+async def _main(verificar: bool) -> None:
+    fallidas = await crear_indices()
+    if fallidas:
+        raise RuntimeError("Índices sin crear en: " + ", ".join(fallidas))
+    if verificar:
+        await verificar_planes()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_main("--verificar" in sys.argv))
+    except RuntimeError as exc:
+        print(exc)
+        sys.exit(1)
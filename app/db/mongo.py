@@ -1,22 +1,158 @@
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING
+import asyncio
 import os
-import motor.motor_asyncio
+from typing import Callable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
+
+from app.db.monitoreo import MonitorComandos, MonitorPool
 
 MONGO_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")  # usa Atlas si existe
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
 DATABASE_NAME = "intercambio_servicios"  # Misma DB para mantener relaciones
 
-client = AsyncIOMotorClient(MONGO_URI)
-db = client[DATABASE_NAME]
+# Pool y timeouts; los valores por defecto son los de pymongo salvo minPoolSize
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0")) or None
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0")) or None
+# Conexiones que se abren en paralelo al arrancar
+MONGO_CONEXIONES_CALENTAMIENTO = int(
+    os.getenv("MONGO_CONEXIONES_CALENTAMIENTO", str(MONGO_MIN_POOL_SIZE))
+)
+
+# Preferencia de lectura de historiales, servicios y pendientes
+LECTURA_PREFERENCIA = os.getenv("LECTURA_PREFERENCIA", "secondaryPreferred")
+# -1 desactiva el límite; si se fija, MongoDB exige al menos 90 segundos
+LECTURA_MAX_STALENESS_SEGUNDOS = int(os.getenv("LECTURA_MAX_STALENESS_SEGUNDOS", "-1"))
+
+_MODOS_LECTURA = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+monitor_pool = MonitorPool()
+_cliente: Optional[AsyncIOMotorClient] = None
+_colecciones = {}
+
+
+def opciones_cliente() -> dict:
+    return {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+    }
+
+
+def conectar() -> AsyncIOMotorClient:
+    """Crea el cliente si no existe. El lifespan de la app lo llama al arrancar;
+    los scripts de línea de comandos lo obtienen al primer uso."""
+    global _cliente
+    if _cliente is None:
+        _cliente = AsyncIOMotorClient(
+            MONGO_URI,
+            event_listeners=[MonitorComandos(), monitor_pool],
+            **opciones_cliente(),
+        )
+    return _cliente
+
+
+def cerrar():
+    global _cliente
+    if _cliente is not None:
+        _cliente.close()
+        _cliente = None
+        _colecciones.clear()
+
+
+def preferencia_lectura():
+    if LECTURA_PREFERENCIA not in _MODOS_LECTURA:
+        raise ValueError(f"LECTURA_PREFERENCIA desconocida: {LECTURA_PREFERENCIA}")
+    if LECTURA_PREFERENCIA == "primary":
+        return Primary()
+    return _MODOS_LECTURA[LECTURA_PREFERENCIA](max_staleness=LECTURA_MAX_STALENESS_SEGUNDOS)
+
+
+def _coleccion(nombre: str, lectura: bool = False):
+    clave = (nombre, lectura)
+    if clave not in _colecciones:
+        coleccion = conectar()[DATABASE_NAME][nombre]
+        if lectura:
+            coleccion = coleccion.with_options(read_preference=preferencia_lectura())
+        _colecciones[clave] = coleccion
+    return _colecciones[clave]
+
+
+def coleccion(nombre: str, lectura: bool = False):
+    """Colección por nombre, para las que no tienen delegado fijo (particiones de archivo)."""
+    return _coleccion(nombre, lectura)
+
+
+async def calentar():
+    """Abre conexiones del pool antes de recibir tráfico.
+
+    Los pings concurrentes obligan a abrir una conexión por ping (con su
+    handshake y TLS) en lugar de pagarlo en los primeros requests.
+    """
+    db_actual = conectar()[DATABASE_NAME]
+    await asyncio.gather(
+        *(db_actual.command("ping") for _ in range(max(1, MONGO_CONEXIONES_CALENTAMIENTO)))
+    )
+
+
+class _Diferido:
+    """Delegado que resuelve el cliente o la colección real en cada acceso.
+
+    Permite importar `client`, `db` y las colecciones a nivel de módulo
+    aunque el cliente se cree más tarde en el lifespan.
+    """
+
+    def __init__(self, resolver: Callable):
+        self._resolver = resolver
+
+    def __getattr__(self, nombre):
+        return getattr(self._resolver(), nombre)
+
+    def __getitem__(self, nombre):
+        return self._resolver()[nombre]
+
+
+client = _Diferido(conectar)
+db = _Diferido(lambda: conectar()[DATABASE_NAME])
 
 # Colecciones
-usuarios_collection = db["usuarios"]
-transacciones_collection = db["transacciones_moneda"]  # Nueva colección
-
-# Índices (ejecutar una vez)
-async def create_indexes():
-    await transacciones_collection.create_index([("id_emisor", ASCENDING)])
-    await transacciones_collection.create_index([("id_receptor", ASCENDING)])
-    await transacciones_collection.create_index([("fecha", ASCENDING)])
-    print("Índices creados")
\ No newline at end of file
+usuarios_collection = _Diferido(lambda: _coleccion("usuarios"))
+transacciones_collection = _Diferido(lambda: _coleccion("transacciones_moneda"))  # Nueva colección
+idempotencia_collection = _Diferido(lambda: _coleccion("idempotencia"))
+resumenes_collection = _Diferido(lambda: _coleccion("resumen_diario"))
+# Catálogo de particiones mensuales de transacciones archivadas
+archivo_particiones = _Diferido(lambda: _coleccion("archivo_particiones"))
+# Particiones que guardan movimientos de cada usuario, para no abrir las demás
+archivo_usuarios = _Diferido(lambda: _coleccion("archivo_usuarios"))
+# Estado del conciliador: sumas por usuario, solicitudes por completar y checkpoint
+conciliacion_saldos = _Diferido(lambda: _coleccion("conciliacion_saldos"))
+conciliacion_pendientes = _Diferido(lambda: _coleccion("conciliacion_pendientes"))
+conciliacion_estado = _Diferido(lambda: _coleccion("conciliacion_estado"))
+
+# Mismas colecciones leyendo según LECTURA_PREFERENCIA, para consultas que
+# toleran retraso de replicación salvo que traigan un token causal
+usuarios_lectura = _Diferido(lambda: _coleccion("usuarios", lectura=True))
+transacciones_lectura = _Diferido(lambda: _coleccion("transacciones_moneda", lectura=True))
+resumenes_lectura = _Diferido(lambda: _coleccion("resumen_diario", lectura=True))
+archivo_particiones_lectura = _Diferido(lambda: _coleccion("archivo_particiones", lectura=True))
+archivo_usuarios_lectura = _Diferido(lambda: _coleccion("archivo_usuarios", lectura=True))
@@ -0,0 +1,211 @@
+"""Métricas de Mongo a nivel de comando y su atribución a cada ruta HTTP."""
+import contextvars
+import threading
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import monitoring
+
+MONGO_DURACION = Histogram(
+    "mongo_comando_duracion_segundos",
+    "Duración de los comandos enviados a Mongo",
+    ["coleccion", "comando"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+MONGO_DOCUMENTOS = Counter(
+    "mongo_documentos_devueltos_total",
+    "Documentos devueltos por Mongo en lotes de cursor",
+    ["coleccion", "comando"],
+)
+MONGO_FALLOS = Counter(
+    "mongo_comandos_fallidos_total", "Comandos de Mongo que terminaron en error", ["coleccion", "comando"]
+)
+MONGO_COMANDOS_POR_REQUEST = Histogram(
+    "http_mongo_comandos_por_request",
+    "Comandos de Mongo ejecutados para atender cada request HTTP",
+    ["metodo", "ruta"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000),
+)
+# Con varios workers, los gauges se suman entre los procesos vivos
+MONGO_POOL_CONEXIONES = Gauge(
+    "mongo_pool_conexiones",
+    "Conexiones del pool de Mongo por servidor",
+    ["servidor", "estado"],
+    multiprocess_mode="livesum",
+)
+MONGO_POOL_ESPERA = Histogram(
+    "mongo_pool_espera_segundos",
+    "Tiempo hasta obtener una conexión del pool",
+    ["servidor"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+MONGO_POOL_FALLOS = Counter(
+    "mongo_pool_checkout_fallidos_total",
+    "Peticiones de conexión al pool que fallaron",
+    ["servidor", "motivo"],
+)
+
+# Contador mutable del request en curso. Motor copia el contexto al hilo
+# que ejecuta cada comando, así que el listener ve el mismo diccionario.
+contexto_request: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar(
+    "contexto_mongo_request", default=None
+)
+# Los listeners corren en hilos del driver: `+= 1` sobre el dict no es atómico
+_cerrojo_comandos = threading.Lock()
+
+
+def _coleccion(event) -> str:
+    if event.command_name == "getMore":
+        return str(event.command.get("collection", ""))
+    objetivo = event.command.get(event.command_name)
+    return objetivo if isinstance(objetivo, str) else ""
+
+
+def _documentos_devueltos(reply) -> int:
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+    if not cursor:
+        return 0
+    return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+
+
+class MonitorComandos(monitoring.CommandListener):
+    """Exporta duración y documentos devueltos por colección y comando."""
+
+    def __init__(self):
+        self._colecciones = {}
+
+    def started(self, event):
+        self._colecciones[(event.connection_id, event.request_id)] = _coleccion(event)
+        contador = contexto_request.get()
+        if contador is not None:
+            with _cerrojo_comandos:
+                contador["comandos"] += 1
+
+    def succeeded(self, event):
+        coleccion = self._colecciones.pop((event.connection_id, event.request_id), "")
+        MONGO_DURACION.labels(coleccion, event.command_name).observe(event.duration_micros / 1e6)
+        documentos = _documentos_devueltos(event.reply)
+        if documentos:
+            MONGO_DOCUMENTOS.labels(coleccion, event.command_name).inc(documentos)
+
+    def failed(self, event):
+        coleccion = self._colecciones.pop((event.connection_id, event.request_id), "")
+        MONGO_DURACION.labels(coleccion, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FALLOS.labels(coleccion, event.command_name).inc()
+
+
+def _servidor(address) -> str:
+    host, puerto = address
+    return f"{host}:{puerto}"
+
+
+class MonitorPool(monitoring.ConnectionPoolListener):
+    """Lleva la cuenta de conexiones abiertas y en uso de cada pool.
+
+    `estadisticas()` alimenta el endpoint `/ready`; los mismos números se
+    exportan como gauges.
+    """
+
+    def __init__(self):
+        self._pools = {}
+        # Los eventos llegan desde varios hilos del driver a la vez
+        self._cerrojo = threading.Lock()
+
+    def _pool(self, address) -> dict:
+        servidor = _servidor(address)
+        if servidor not in self._pools:
+            self._pools[servidor] = {"abiertas": 0, "en_uso": 0, "esperando": 0}
+        return self._pools[servidor]
+
+    def _ajustar(self, address, estado: str, delta: int):
+        with self._cerrojo:
+            pool = self._pool(address)
+            pool[estado] += delta
+            MONGO_POOL_CONEXIONES.labels(_servidor(address), estado).set(pool[estado])
+
+    def estadisticas(self) -> dict:
+        with self._cerrojo:
+            return {servidor: dict(pool) for servidor, pool in self._pools.items()}
+
+    def pool_created(self, event):
+        with self._cerrojo:
+            self._pool(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        servidor = _servidor(event.address)
+        with self._cerrojo:
+            self._pools.pop(servidor, None)
+            for estado in ("abiertas", "en_uso", "esperando"):
+                MONGO_POOL_CONEXIONES.labels(servidor, estado).set(0)
+
+    def connection_created(self, event):
+        self._ajustar(event.address, "abiertas", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._ajustar(event.address, "abiertas", -1)
+
+    def connection_check_out_started(self, event):
+        self._ajustar(event.address, "esperando", 1)
+
+    def connection_check_out_failed(self, event):
+        self._ajustar(event.address, "esperando", -1)
+        MONGO_POOL_FALLOS.labels(_servidor(event.address), event.reason).inc()
+
+    def connection_checked_out(self, event):
+        self._ajustar(event.address, "esperando", -1)
+        self._ajustar(event.address, "en_uso", 1)
+        if event.duration is not None:
+            MONGO_POOL_ESPERA.labels(_servidor(event.address)).observe(event.duration)
+
+    def connection_checked_in(self, event):
+        self._ajustar(event.address, "en_uso", -1)
+
+
+class ContadorComandosMongo:
+    """Middleware ASGI que cuenta los comandos de Mongo de cada request.
+
+    Observa el total cuando termina de enviarse el cuerpo, así que también
+    cubre las respuestas en streaming.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._rutas = None
+
+    def _plantilla(self, scope) -> str:
+        if self._rutas is None:
+            self._rutas = {
+                getattr(ruta, "endpoint", None): ruta.path for ruta in scope["app"].routes
+            }
+        return self._rutas.get(scope.get("endpoint"), "sin_ruta")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        contador = {"comandos": 0}
+        token = contexto_request.set(contador)
+        observado = False
+
+        async def enviar(mensaje):
+            nonlocal observado
+            await send(mensaje)
+            if mensaje["type"] == "http.response.body" and not mensaje.get("more_body") and not observado:
+                observado = True
+                MONGO_COMANDOS_POR_REQUEST.labels(scope["method"], self._plantilla(scope)).observe(
+                    contador["comandos"]
+                )
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            contexto_request.reset(token)
@@ -0,0 +1,243 @@
+"""Resúmenes diarios por usuario y tipo, mantenidos junto a cada movimiento.
+
+Cada documento de `resumen_diario` acumula, para un usuario, un día (UTC) y
+un `tipo`, lo enviado, lo recibido y lo bonificado, con el número de
+movimientos de cada clase. Las escrituras de saldo llaman a `acumular`
+dentro de su transacción, así que el resumen nunca diverge del libro.
+
+Los movimientos anteriores al despliegue se cargan una sola vez con:
+
+    python -m app.db.resumenes --corte 2024-06-01T00:00:00
+
+`--corte` es el instante desde el que la API ya acumula en vivo. La carga
+escribe documentos con `origen: "reconstruccion"`, separados de los que
+mantiene la API (`origen: "vivo"`), y los reemplaza si se repite.
+"""
+import argparse
+import asyncio
+from datetime import date, datetime, timedelta
+from typing import Iterable, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+from app.db.mongo import archivo_particiones, coleccion, resumenes_collection, transacciones_collection
+
+ORIGEN_VIVO = "vivo"
+ORIGEN_RECONSTRUCCION = "reconstruccion"
+
+# Campo acumulado -> contador de movimientos asociado
+CAMPOS = {
+    "enviado": "n_enviados",
+    "recibido": "n_recibidos",
+    "bonificado": "n_bonificados",
+}
+
+
+def dia(fecha: datetime) -> datetime:
+    return datetime(fecha.year, fecha.month, fecha.day)
+
+
+def cuenta_en_resumen(transaccion: dict) -> bool:
+    # Las solicitudes de servicio pendientes aún no han movido saldo
+    return not (transaccion.get("tipo") == "servicio" and transaccion.get("estado") == "pending")
+
+
+def aportes(transaccion: dict):
+    """(usuario, campo) afectados por un movimiento, con la misma
+    clasificación que el historial: las asignaciones solo bonifican al
+    receptor; el resto es envío para el emisor y recepción para el receptor."""
+    tipo = transaccion.get("tipo") or "transferencia"
+    if tipo == "asignacion" or transaccion.get("id_emisor") == "admin":
+        return [(transaccion["id_receptor"], "bonificado")]
+    return [(transaccion["id_emisor"], "enviado"), (transaccion["id_receptor"], "recibido")]
+
+
+async def acumular(transacciones: Iterable[dict], session=None) -> None:
+    """Suma los movimientos a sus resúmenes con `$inc` en una sola escritura.
+
+    Debe llamarse en la misma transacción que inserta o completa los
+    movimientos, con cada documento ya en su estado y fecha finales.
+    """
+    incrementos = {}
+    for transaccion in transacciones:
+        if not cuenta_en_resumen(transaccion):
+            continue
+        tipo = transaccion.get("tipo") or "transferencia"
+        monto = float(transaccion.get("monto", 0))
+        for usuario, campo in aportes(transaccion):
+            clave = (usuario, dia(transaccion["fecha"]), tipo)
+            suma = incrementos.setdefault(clave, {})
+            suma[campo] = suma.get(campo, 0) + monto
+            suma[CAMPOS[campo]] = suma.get(CAMPOS[campo], 0) + 1
+
+    if not incrementos:
+        return
+    operaciones = [
+        UpdateOne(
+            {"usuario": usuario, "dia": fecha, "tipo": tipo, "origen": ORIGEN_VIVO},
+            {"$inc": suma},
+            upsert=True,
+        )
+        for (usuario, fecha, tipo), suma in incrementos.items()
+    ]
+    await resumenes_collection.bulk_write(operaciones, ordered=False, session=session)
+
+
+def filtro_dias(desde: Optional[date], hasta: Optional[date]) -> dict:
+    """Rango de días inclusivo sobre `dia`."""
+    if desde and hasta and desde > hasta:
+        raise HTTPException(status_code=400, detail="`desde` no puede ser posterior a `hasta`")
+    filtro = {}
+    if desde:
+        filtro["$gte"] = datetime.combine(desde, datetime.min.time())
+    if hasta:
+        filtro["$lt"] = datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+    return {"dia": filtro} if filtro else {}
+
+
+def _ceros() -> dict:
+    return {campo: 0 for par in CAMPOS.items() for campo in par}
+
+
+def _sumar(destino: dict, resumen: dict):
+    for campo in destino:
+        destino[campo] += resumen.get(campo, 0)
+
+
+def combinar(resumenes: Iterable[dict]) -> dict:
+    """Totales, desglose por tipo y serie diaria a partir de resúmenes diarios."""
+    totales = _ceros()
+    por_tipo = {}
+    por_dia = {}
+    for resumen in resumenes:
+        _sumar(totales, resumen)
+        _sumar(por_tipo.setdefault(resumen["tipo"], _ceros()), resumen)
+        _sumar(por_dia.setdefault(resumen["dia"], _ceros()), resumen)
+    return {
+        "totales": totales,
+        "por_tipo": por_tipo,
+        "por_dia": [{"dia": d.date().isoformat(), **por_dia[d]} for d in sorted(por_dia)],
+    }
+
+
+def pipeline_plataforma(filtro: dict) -> list:
+    """Suma los resúmenes de todos los usuarios por día y tipo."""
+    return [
+        {"$match": filtro},
+        {
+            "$group": {
+                "_id": {"dia": "$dia", "tipo": "$tipo"},
+                **{campo: {"$sum": f"${campo}"} for campo in _ceros()},
+            }
+        },
+        {"$project": {"_id": 0, "dia": "$_id.dia", "tipo": "$_id.tipo", **{c: 1 for c in _ceros()}}},
+    ]
+
+
+def pipeline_reconstruccion(corte: datetime, sumar: bool = False) -> list:
+    """Agrega en Mongo los movimientos que la API no llegó a acumular.
+
+    Quedan fuera los insertados desde `corte` (por su `_id`) y los
+    completados desde `corte` (aceptar una solicitud reescribe su `fecha`);
+    ambos ya los cuenta `acumular`. Con `sumar` el resultado se suma al
+    resumen ya reconstruido en vez de reemplazarlo: un mismo día puede
+    estar repartido entre una partición de archivo y la colección caliente.
+    """
+    tipo = {"$ifNull": ["$tipo", "transferencia"]}
+    es_bonus = {"$or": [{"$eq": [tipo, "asignacion"]}, {"$eq": ["$id_emisor", "admin"]}]}
+    monto = {"$toDouble": {"$ifNull": ["$monto", 0]}}
+
+    def aporte(usuario: str, campo: str) -> dict:
+        return {"usuario": usuario, "campo": campo}
+
+    suma = {}
+    for campo, contador in CAMPOS.items():
+        es_campo = {"$eq": ["$_aportes.campo", campo]}
+        suma[campo] = {"$sum": {"$cond": [es_campo, "$_monto", 0]}}
+        suma[contador] = {"$sum": {"$cond": [es_campo, 1, 0]}}
+
+    return [
+        {
+            "$match": {
+                "_id": {"$lt": ObjectId.from_datetime(corte)},
+                "fecha": {"$lt": corte},
+                "$nor": [{"tipo": "servicio", "estado": "pending"}],
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "_tipo": tipo,
+                "_monto": monto,
+                "_dia": {"$dateTrunc": {"date": "$fecha", "unit": "day"}},
+                "_aportes": {
+                    "$cond": [
+                        es_bonus,
+                        [aporte("$id_receptor", "bonificado")],
+                        [aporte("$id_emisor", "enviado"), aporte("$id_receptor", "recibido")],
+                    ]
+                },
+            }
+        },
+        {"$unwind": "$_aportes"},
+        {
+            "$group": {
+                "_id": {"usuario": "$_aportes.usuario", "dia": "$_dia", "tipo": "$_tipo"},
+                **suma,
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "usuario": "$_id.usuario",
+                "dia": "$_id.dia",
+                "tipo": "$_id.tipo",
+                "origen": ORIGEN_RECONSTRUCCION,
+                **{campo: 1 for campo in _ceros()},
+            }
+        },
+        {
+            "$merge": {
+                "into": "resumen_diario",
+                "on": ["usuario", "dia", "tipo", "origen"],
+                "whenMatched": (
+                    [{"$set": {campo: {"$add": [f"${campo}", f"$$new.{campo}"]} for campo in _ceros()}}]
+                    if sumar
+                    else "replace"
+                ),
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+async def reconstruir(corte: datetime) -> int:
+    """Recalcula los resúmenes anteriores a `corte`; es idempotente."""
+    # Restos de una ejecución anterior con otro corte
+    await resumenes_collection.delete_many({"origen": ORIGEN_RECONSTRUCCION})
+    cursor = transacciones_collection.aggregate(pipeline_reconstruccion(corte), allowDiskUse=True)
+    await cursor.to_list(None)
+    # Lo que `app.db.archivo` ya sacó de la colección caliente
+    async for particion in archivo_particiones.find({"desde": {"$lt": corte}}, {"_id": 1}):
+        cursor = coleccion(particion["_id"]).aggregate(pipeline_reconstruccion(corte, sumar=True), allowDiskUse=True)
+        await cursor.to_list(None)
+    return await resumenes_collection.count_documents({"origen": ORIGEN_RECONSTRUCCION})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--corte",
+        type=datetime.fromisoformat,
+        required=True,
+        help="Instante (UTC) desde el que la API acumula en vivo",
+    )
+    args = parser.parse_args()
+    total = asyncio.run(reconstruir(args.corte))
+    print(f"{total} resúmenes reconstruidos hasta {args.corte.isoformat()}")
+
+
+if __name__ == "__main__":
+    main()
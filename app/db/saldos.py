@@ -0,0 +1,78 @@
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+from app.db.mongo import usuarios_collection
+
+# Cada cambio en los movimientos de un usuario incrementa su `version_ledger`,
+# que sirve de ETag para saldo, historial y servicios
+INC_VERSION = {"version_ledger": 1}
+
+
+async def debitar(user_id: str, monto: float, session=None, detalle: str = "Saldo insuficiente") -> float:
+    """Descuenta `monto` en una sola actualización condicionada al saldo.
+
+    Devuelve el saldo resultante. Si el filtro `saldo_creditos >= monto` no
+    encuentra al usuario, se distingue entre usuario inexistente (404) y
+    saldo insuficiente (400); ambas excepciones abortan la transacción.
+    """
+    usuario = await usuarios_collection.find_one_and_update(
+        {"_id": ObjectId(user_id), "saldo_creditos": {"$gte": monto}},
+        {"$inc": {"saldo_creditos": -monto, **INC_VERSION}},
+        projection={"saldo_creditos": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+    if usuario is None:
+        existe = await usuarios_collection.count_documents(
+            {"_id": ObjectId(user_id)}, limit=1, session=session
+        )
+        if not existe:
+            raise HTTPException(status_code=404, detail="Usuario no encontrado")
+        raise HTTPException(status_code=400, detail=detalle)
+    return float(usuario["saldo_creditos"])
+
+
+async def acreditar(user_id: str, monto: float, session=None, campos: Optional[dict] = None) -> dict:
+    """Suma `monto` con `$inc` y devuelve el documento actualizado.
+
+    `campos` se aplica como `$set` en la misma actualización.
+    """
+    actualizacion = {"$inc": {"saldo_creditos": monto, **INC_VERSION}}
+    if campos:
+        actualizacion["$set"] = campos
+
+    usuario = await usuarios_collection.find_one_and_update(
+        {"_id": ObjectId(user_id)},
+        actualizacion,
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+    if usuario is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return usuario
+
+
+async def versionar(user_ids, session=None) -> None:
+    """Incrementa la versión de usuarios cuyos movimientos cambian sin tocar el saldo."""
+    await usuarios_collection.update_many(
+        {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}},
+        {"$inc": INC_VERSION},
+        session=session,
+    )
+
+
+async def version_ledger(user_id: str, coleccion=None, session=None) -> Optional[int]:
+    """Versión de los movimientos del usuario con una lectura por `_id`; None si no existe."""
+    if not ObjectId.is_valid(user_id):
+        return None
+    if coleccion is None:
+        coleccion = usuarios_collection
+    usuario = await coleccion.find_one(
+        {"_id": ObjectId(user_id)}, {"version_ledger": 1}, session=session
+    )
+    if usuario is None:
+        return None
+    return int(usuario.get("version_ledger", 0))
@@ -0,0 +1,146 @@
+"""Ejecutor compartido de transacciones con reintentos ante errores transitorios."""
+import asyncio
+import os
+import random
+from typing import Awaitable, Callable, TypeVar
+
+from prometheus_client import Counter, Histogram
+from pymongo.errors import PyMongoError
+
+from app.db.consistencia import registrar_escritura
+from app.db.mongo import client
+
+TRANSACCION_PLAZO_SEGUNDOS = float(os.getenv("TRANSACCION_PLAZO_SEGUNDOS", "10"))
+TRANSACCION_ESPERA_BASE = float(os.getenv("TRANSACCION_ESPERA_BASE", "0.01"))
+TRANSACCION_ESPERA_MAXIMA = float(os.getenv("TRANSACCION_ESPERA_MAXIMA", "0.5"))
+
+_WRITE_CONFLICT = 112
+_MAX_TIME_MS_EXPIRED = 50
+
+TRANSACCIONES_INTENTOS = Histogram(
+    "transacciones_intentos",
+    "Intentos necesarios para confirmar cada transacción",
+    ["endpoint"],
+    buckets=(1, 2, 3, 5, 8, 13, 21),
+)
+TRANSACCIONES_REINTENTOS = Counter(
+    "transacciones_reintentos_total",
+    "Reintentos de transacciones por error transitorio",
+    ["endpoint", "motivo"],
+)
+TRANSACCIONES_CONFLICTOS = Counter(
+    "transacciones_conflictos_total",
+    "Conflictos de escritura (WriteConflict) en transacciones",
+    ["endpoint"],
+)
+TRANSACCIONES_RESULTADO = Counter(
+    "transacciones_total",
+    "Transacciones terminadas por resultado",
+    ["endpoint", "resultado"],
+)
+
+T = TypeVar("T")
+
+
+class _Reintentar(Exception):
+    """Señal interna: el commit falló de forma transitoria y hay que repetir todo."""
+
+
+def _es_conflicto(exc: PyMongoError) -> bool:
+    return getattr(exc, "code", None) == _WRITE_CONFLICT
+
+
+def _registrar_reintento(endpoint: str, motivo: str, exc: PyMongoError):
+    TRANSACCIONES_REINTENTOS.labels(endpoint, motivo).inc()
+    if _es_conflicto(exc):
+        TRANSACCIONES_CONFLICTOS.labels(endpoint).inc()
+
+
+async def _esperar(intento: int, limite: float):
+    # Backoff exponencial con jitter completo, sin pasarse del plazo
+    techo = min(TRANSACCION_ESPERA_MAXIMA, TRANSACCION_ESPERA_BASE * 2 ** (intento - 1))
+    restante = limite - asyncio.get_running_loop().time()
+    await asyncio.sleep(max(0.0, min(random.uniform(0, techo), restante)))
+
+
+async def _confirmar(session, endpoint: str, limite: float):
+    """Confirma la transacción reintentando mientras el resultado sea incierto."""
+    while True:
+        try:
+            await session.commit_transaction()
+            return
+        except PyMongoError as exc:
+            hay_tiempo = asyncio.get_running_loop().time() < limite
+            if (
+                exc.has_error_label("UnknownTransactionCommitResult")
+                and getattr(exc, "code", None) != _MAX_TIME_MS_EXPIRED
+                and hay_tiempo
+            ):
+                _registrar_reintento(endpoint, "commit_incierto", exc)
+                continue
+            if exc.has_error_label("TransientTransactionError") and hay_tiempo:
+                _registrar_reintento(endpoint, "transitorio", exc)
+                raise _Reintentar() from exc
+            raise
+
+
+async def ejecutar_transaccion(
+    endpoint: str,
+    operacion: Callable[..., Awaitable[T]],
+    plazo: float = TRANSACCION_PLAZO_SEGUNDOS,
+) -> T:
+    """Ejecuta `operacion(session)` dentro de una transacción y la confirma.
+
+    Sigue la semántica de `with_transaction`: si la operación o el commit
+    fallan con `TransientTransactionError` se repite todo desde el principio,
+    y si el commit devuelve `UnknownTransactionCommitResult` se reintenta
+    solo el commit. Los reintentos esperan con backoff exponencial y jitter
+    hasta agotar `plazo`. `operacion` puede ejecutarse varias veces, así que
+    no debe modificar estado externo hasta que la transacción se confirme.
+    El punto de la escritura se devuelve al cliente como token causal.
+    """
+    loop = asyncio.get_running_loop()
+    limite = loop.time() + plazo
+    intento = 0
+
+    async with await client.start_session() as session:
+        while True:
+            intento += 1
+            session.start_transaction()
+            try:
+                resultado = await operacion(session)
+            except BaseException as exc:
+                if session.in_transaction:
+                    await session.abort_transaction()
+                if (
+                    isinstance(exc, PyMongoError)
+                    and exc.has_error_label("TransientTransactionError")
+                    and loop.time() < limite
+                ):
+                    _registrar_reintento(endpoint, "transitorio", exc)
+                    await _esperar(intento, limite)
+                    continue
+                TRANSACCIONES_INTENTOS.labels(endpoint).observe(intento)
+                TRANSACCIONES_RESULTADO.labels(
+                    endpoint, "error_mongo" if isinstance(exc, PyMongoError) else "abortada"
+                ).inc()
+                raise
+
+            if not session.in_transaction:
+                # La operación ya confirmó o abortó por su cuenta
+                break
+            try:
+                await _confirmar(session, endpoint, limite)
+            except _Reintentar:
+                await _esperar(intento, limite)
+                continue
+            except PyMongoError:
+                TRANSACCIONES_INTENTOS.labels(endpoint).observe(intento)
+                TRANSACCIONES_RESULTADO.labels(endpoint, "error_mongo").inc()
+                raise
+            break
+        registrar_escritura(session)
+
+    TRANSACCIONES_INTENTOS.labels(endpoint).observe(intento)
+    TRANSACCIONES_RESULTADO.labels(endpoint, "confirmada").inc()
+    return resultado
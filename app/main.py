@@ -3,23 +3,81 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from prometheus_fastapi_instrumentator import Instrumentator
-from app.routers import transacciones, auth, admin
+from app.routers import transacciones, auth, admin, depuracion
 from app.models.transaccion import Transaccion 
 from datetime import datetime, timedelta
 from fastapi.openapi.models import APIKey, APIKeyIn, SecuritySchemeType
 from fastapi.openapi.utils import get_openapi
 from app.utils.jwt_handler import SECRET_KEY, ALGORITHM
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from app.db import mongo
 from app.db.mongo import transacciones_collection, usuarios_collection
+from app.db.cambios import difusor_servicios
+from app.db.indices import crear_indices
+from app.db.consistencia import CABECERA_CONSISTENCIA, ConsistenciaCausal
+from app.db.monitoreo import ContadorComandosMongo
+from app.utils.admision import ControlAdmision
+from app.utils.perfilador import PERFILADOR_ACTIVO, RegistroRutas, perfilador
 from jose import JWTError, jwt
 from bson import ObjectId
+from contextlib import asynccontextmanager
+import asyncio
+import os
 import uvicorn 
 import traceback
 
+READY_TIMEOUT_SEGUNDOS = float(os.getenv("READY_TIMEOUT_SEGUNDOS", "2"))
+REINTENTO_CALENTAMIENTO_SEGUNDOS = float(os.getenv("REINTENTO_CALENTAMIENTO_SEGUNDOS", "5"))
 
-app = FastAPI(title="API de Transacciones y Moneda Virtual")
+estado_db = {"calentada": False}
+
+
+async def preparar_db():
+    """Abre el pool y crea los índices; si Mongo no responde, reintenta en segundo plano.
+
+    Un índice en conflicto no bloquea la readiness: `crear_indices` lo
+    registra en `mongo_indices_fallidos_total` y sigue con el resto.
+    """
+    while True:
+        try:
+            await mongo.calentar()
+            await crear_indices()
+            estado_db["calentada"] = True
+            return
+        except Exception as exc:
+            # La API puede arrancar sin Mongo; /ready devuelve 503 mientras tanto
+            print(f"🔴 No se pudo preparar la base de datos: {exc}")
+            await asyncio.sleep(REINTENTO_CALENTAMIENTO_SEGUNDOS)
+
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    mongo.conectar()
+    if PERFILADOR_ACTIVO:
+        perfilador.iniciar()
+    preparacion = asyncio.create_task(preparar_db())
+    # Se espera al calentamiento para que el tráfico llegue con el pool abierto,
+    # pero sin bloquear el arranque más que un intento de selección de servidor
+    espera = mongo.MONGO_SERVER_SELECTION_TIMEOUT_MS / 1000
+    try:
+        await asyncio.wait_for(asyncio.shield(preparacion), timeout=espera)
+    except asyncio.TimeoutError:
+        pass
+    yield
+    preparacion.cancel()
+    await difusor_servicios.detener()
+    if PERFILADOR_ACTIVO:
+        await perfilador.detener()
+    mongo.cerrar()
+
+
+app = FastAPI(title="API de Transacciones y Moneda Virtual", lifespan=ciclo_de_vida)
 security = HTTPBearer()
 
+# Límites por usuario/IP y concurrencia de historiales; va por dentro de CORS
+# para que los 429/503 lleguen al navegador con sus cabeceras
+app.add_middleware(ControlAdmision)
+
 # 🔵 Añadir middleware de CORS
 app.add_middleware(
     CORSMiddleware,
@@ -27,20 +85,49 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Siguiente-Cursor", "Idempotent-Replayed", "Retry-After", CABECERA_CONSISTENCIA],
 )
 
 # Instrumentación automática de métricas 
 Instrumentator().instrument(app).expose(app)
+# Comandos de Mongo por ruta, para detectar N+1 en Grafana
+app.add_middleware(ContadorComandosMongo)
+# Devuelve el token causal de las escrituras para leer después en secundarios
+app.add_middleware(ConsistenciaCausal)
+if PERFILADOR_ACTIVO:
+    # El más externo: atribuye a la ruta todas las tareas de la request
+    app.add_middleware(RegistroRutas)
 
 # Rutas del API
 app.include_router(auth.router, prefix="/api")
 app.include_router(transacciones.router, prefix="/api")
 app.include_router(admin.router)
+if PERFILADOR_ACTIVO:
+    app.include_router(depuracion.router)
 
 @app.get("/")
 def root():
     return {"mensaje": "API de gestión de créditos y transacciones hola como estassss"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 solo cuando Mongo responde y el arranque terminó."""
+    contenido = {
+        "calentada": estado_db["calentada"],
+        "pool": {
+            "max": mongo.MONGO_MAX_POOL_SIZE,
+            "min": mongo.MONGO_MIN_POOL_SIZE,
+            "servidores": mongo.monitor_pool.estadisticas(),
+        },
+    }
+    try:
+        await asyncio.wait_for(mongo.db.command("ping"), timeout=READY_TIMEOUT_SEGUNDOS)
+        contenido["mongo"] = "ok"
+    except Exception as exc:
+        contenido["mongo"] = f"error: {type(exc).__name__}"
+    listo = contenido["mongo"] == "ok" and estado_db["calentada"]
+    return JSONResponse(status_code=200 if listo else 503, content=contenido)
+
 # Manejo de errores (igual que antes)
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -25,3 +25,23 @@ class ServicioTransaccion(BaseModel):
     monto: float = Field(gt=0)
     descripcion: Optional[str] = None
     estado: Optional[str] = "completed"
+
+
+class TransferenciaLoteItem(BaseModel):
+    """Una de las transferencias de un lote."""
+
+    id_receptor: str
+    monto: float = Field(gt=0)
+    justificacion: Optional[str] = None
+
+
+class TransferenciaLote(BaseModel):
+    """Payload para pagar a muchos receptores desde una misma cuenta.
+
+    Con `atomico` se aplican todas las transferencias o ninguna; sin él se
+    aplican las válidas y se informa el resultado de cada una.
+    """
+
+    id_emisor: str
+    transferencias: List[TransferenciaLoteItem] = Field(min_length=1)
+    atomico: bool = True
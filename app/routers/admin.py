@@ -1,39 +1,39 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from app.models.credito import AsignacionCreditoRequest
-from app.db.mongo import usuarios_collection, transacciones_collection
+from app.db.archivo import movimientos_en_rango
+from app.db.mongo import resumenes_lectura, transacciones_collection
+from app.db.resumenes import acumular, combinar, filtro_dias, pipeline_plataforma
+from app.db.saldos import acreditar
+from app.db.transaccional import ejecutar_transaccion
+from app.utils.exportacion import TipoTransaccion, filtro_exportacion, stream_parquet
 from app.utils.jwt_handler import get_current_user
+from app.utils.perfiles import obtener_perfil
 from bson import ObjectId
-from datetime import datetime
+from datetime import date, datetime
+from typing import Optional
 
 router = APIRouter(prefix="/admin")
 
-@router.post("/admin/asignar_creditos")
-async def asignar_creditos_admin(data: AsignacionCreditoRequest, user_id: str = Depends(get_current_user)):
+
+async def exigir_admin(user_id: str, detalle: str):
     # Validar que el usuario autenticado sea un "admin"
-    admin = await usuarios_collection.find_one({"_id": ObjectId(user_id)})
+    try:
+        admin = await obtener_perfil(user_id)
+    except HTTPException:
+        admin = None
     if not admin or admin.get("rol") != "admin":
-        raise HTTPException(status_code=403, detail="Solo los administradores pueden asignar créditos")
+        raise HTTPException(status_code=403, detail=detalle)
+
+
+@router.post("/admin/asignar_creditos")
+async def asignar_creditos_admin(data: AsignacionCreditoRequest, user_id: str = Depends(get_current_user)):
+    await exigir_admin(user_id, "Solo los administradores pueden asignar créditos")
 
     # Validar que el usuario destino exista
     if not ObjectId.is_valid(data.usuario_id):
         raise HTTPException(status_code=400, detail="ID de usuario inválido")
 
-    usuario = await usuarios_collection.find_one({"_id": ObjectId(data.usuario_id)})
-    if not usuario:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
-
-    saldo_actual = float(usuario.get("saldo_creditos", 0.0))
-    nuevo_saldo = saldo_actual + data.monto
-
-    await usuarios_collection.update_one(
-        {"_id": ObjectId(data.usuario_id)},
-        {
-            "$set": {
-                "saldo_creditos": nuevo_saldo,
-                "moneda_virtual.ultima_actualizacion": datetime.utcnow()
-            }
-        }
-    )
     nueva_transaccion = {
         "id_emisor": "admin",
         "id_receptor": data.usuario_id,
@@ -42,11 +42,56 @@ async def asignar_creditos_admin(data: AsignacionCreditoRequest, user_id: str =
         "tipo": "asignacion",
         "justificacion": data.justificacion if hasattr(data, "justificacion") else "Asignación de créditos"
     }
-    await transacciones_collection.insert_one(nueva_transaccion)
+
+    # $inc atómico en lugar de leer el saldo y sobrescribirlo con $set
+    async def operacion(session):
+        usuario = await acreditar(
+            data.usuario_id,
+            data.monto,
+            session=session,
+            campos={"moneda_virtual.ultima_actualizacion": datetime.utcnow()},
+        )
+        await transacciones_collection.insert_one(dict(nueva_transaccion), session=session)
+        await acumular([nueva_transaccion], session=session)
+        return usuario
+
+    usuario = await ejecutar_transaccion("asignar_creditos_admin", operacion)
+    nuevo_saldo = float(usuario["saldo_creditos"])
 
     return {
         "mensaje": f"{data.monto} créditos asignados a {usuario['nombres']} {usuario['apellidos']}",
         "nuevo_saldo": nuevo_saldo
     }
 
-    
+
+@router.get("/exportar/transacciones")
+async def exportar_transacciones(
+    desde: datetime,
+    hasta: datetime,
+    tipo: Optional[TipoTransaccion] = None,
+    user_id: str = Depends(get_current_user),
+):
+    """Movimientos de todos los usuarios entre `desde` y `hasta` en Parquet."""
+    await exigir_admin(user_id, "Solo los administradores pueden exportar transacciones")
+
+    # El rango sobre `fecha` usa el índice ascendente de esa clave en cada colección
+    cursor = movimientos_en_rango(filtro_exportacion(desde, hasta, tipo), desde, hasta)
+    nombre = f"transacciones_{desde:%Y%m%d}_{hasta:%Y%m%d}.parquet"
+    return StreamingResponse(
+        stream_parquet(cursor),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
+
+
+@router.get("/resumen")
+async def resumen_plataforma(
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    user_id: str = Depends(get_current_user),
+):
+    """Volumen de toda la plataforma por día y tipo, a partir de los resúmenes."""
+    await exigir_admin(user_id, "Solo los administradores pueden ver el resumen de la plataforma")
+
+    filas = await resumenes_lectura.aggregate(pipeline_plataforma(filtro_dias(desde, hasta))).to_list(None)
+    return combinar(filas)
@@ -2,12 +2,11 @@ from datetime import datetime, timedelta
 from fastapi import APIRouter, HTTPException
 from app.models.auth import LoginRequest, LoginResponse
 from app.db.mongo import usuarios_collection
+from app.utils.hashing import verificar_contrasena
 from app.utils.jwt_handler import create_jwt_token
-from passlib.context import CryptContext
 from jose import jwt
 
 router = APIRouter()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = "secret"  # Usa la misma clave que en jwt_handler.py
 ALGORITHM = "HS256"
 
@@ -29,7 +28,7 @@ async def login_user(credentials: LoginRequest):
     if not user:
         raise HTTPException(status_code=401, detail="Correo no encontrado")
 
-    if not pwd_context.verify(credentials.contrasena, user.get("hashed_password", "")):
+    if not await verificar_contrasena(credentials.contrasena, user.get("hashed_password", "")):
         raise HTTPException(status_code=401, detail="Contraseña incorrecta")
 
     token = create_jwt_token(data={"sub": str(user["_id"])})
@@ -0,0 +1,43 @@
+"""Rutas de perfilado; solo se montan con `PERFILADOR_ACTIVO=1`.
+
+Cada worker perfila su propio proceso: con varios workers, la respuesta
+corresponde al que atendió la request.
+"""
+import asyncio
+
+from fastapi import APIRouter, Depends, Query, Response
+
+from app.routers.admin import exigir_admin
+from app.utils.jwt_handler import get_current_user
+from app.utils.perfilador import PERFILADOR_SEGUNDOS_MAXIMO, perfilador
+from app.utils.respuestas import RespuestaORJSON
+
+router = APIRouter(prefix="/debug/pprof")
+
+
+@router.get("/profile")
+async def perfil_cpu(
+    seconds: int = Query(30, ge=1, le=PERFILADOR_SEGUNDOS_MAXIMO),
+    user_id: str = Depends(get_current_user),
+):
+    """Perfil de CPU de los próximos `seconds` segundos en formato pprof (gzip)."""
+    await exigir_admin(user_id, "Solo los administradores pueden perfilar la API")
+
+    ventana = perfilador.suscribir()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        perfilador.desuscribir(ventana)
+    contenido = await asyncio.to_thread(ventana.pprof, perfilador.intervalo_ns)
+    return Response(
+        contenido,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="profile.pb.gz"'},
+    )
+
+
+@router.get("/lentas")
+async def requests_lentas(user_id: str = Depends(get_current_user)):
+    """Últimas requests que superaron `PERFILADOR_UMBRAL_LENTO_MS`, la más reciente primero."""
+    await exigir_admin(user_id, "Solo los administradores pueden ver las requests lentas")
+    return RespuestaORJSON(list(reversed(perfilador.lentas)))
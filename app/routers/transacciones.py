@@ -1,188 +1,429 @@
+import asyncio
 import os
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional
 
 from bson import ObjectId
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel
-
-from app.db.mongo import client, transacciones_collection, usuarios_collection
-from app.models.transaccion import ServicioTransaccion, Transaccion
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from starlette.background import BackgroundTask
+
+from app.db.archivo import mezclar
+from app.db.cambios import difusor_servicios, id_evento, ponerse_al_dia
+from app.db.consistencia import sesion_lectura
+from app.db.historial import pipeline_historial
+from app.db.mongo import (
+    resumenes_lectura,
+    transacciones_collection,
+    transacciones_lectura,
+    usuarios_collection,
+    usuarios_lectura,
+)
+from app.db.resumenes import acumular, combinar, filtro_dias
+from app.db.saldos import INC_VERSION, acreditar, debitar, version_ledger, versionar
+from app.db.transaccional import ejecutar_transaccion
+from app.models.transaccion import ServicioTransaccion, Transaccion, TransferenciaLote
+from app.utils.contrapartes import (
+    TAMANO_LOTE_CONTRAPARTES,
+    ResolutorContrapartes,
+    iterar_por_lotes,
+)
+from app.utils.exportacion import TipoTransaccion, filtro_exportacion, stream_csv
+from app.utils.idempotencia import RegistroIdempotencia, ejecutar_idempotente
 from app.utils.jwt_handler import get_current_user
+from app.utils.paginacion import ORDEN_KEYSET, codificar_cursor, filtro_keyset
+from app.utils.perfiles import generacion_perfiles, guardar_perfil, obtener_perfil
+from app.utils.respuestas import RespuestaORJSON, a_json, etag_version, no_modificado
 
-router = APIRouter()
+router = APIRouter(default_response_class=RespuestaORJSON)
 security = HTTPBearer()
 
+LIMITE_POR_DEFECTO_HISTORIAL = int(os.getenv("HISTORIAL_LIMITE_POR_DEFECTO", "50"))
+LIMITE_MAXIMO_HISTORIAL = int(os.getenv("HISTORIAL_LIMITE_MAXIMO", "500"))
+TAMANO_LOTE_STREAMING = 100
+TRANSFERENCIA_LOTE_MAXIMO = int(os.getenv("TRANSFERENCIA_LOTE_MAXIMO", "500"))
+SSE_KEEPALIVE_SEGUNDOS = float(os.getenv("SSE_KEEPALIVE_SEGUNDOS", "15"))
+# "python" formatea en la API; "agregacion" deja la clasificación y el join a Mongo
+HISTORIAL_MOTOR = os.getenv("HISTORIAL_MOTOR", "python")
+
 
 class AceptarServicioPayload(BaseModel):
     proveedor_id: str
 
 
-USUARIOS_API_BASE_URL = os.getenv(
-    "USUARIOS_API_BASE_URL", "https://usuarios-api-2d5af8f6584a.herokuapp.com"
-)
-
-
-def _build_avatar_url(foto_url: Optional[str]) -> Optional[str]:
-    """Devuelve la URL completa de la foto de perfil."""
-    if not foto_url:
-        return None
-    if foto_url.startswith("http"):
-        return foto_url
-    if foto_url.startswith("/"):
-        return f"{USUARIOS_API_BASE_URL}{foto_url}"
-    return foto_url
-
-
-async def _obtener_usuario(user_id: str, session=None):
+async def _obtener_usuario(user_id: str, session=None, coleccion=None):
+    """Lee el documento completo del usuario; usar cuando se necesita el saldo."""
     if not ObjectId.is_valid(user_id):
         raise HTTPException(status_code=400, detail="ID de usuario inválido")
 
-    usuario = await usuarios_collection.find_one({"_id": ObjectId(user_id)}, session=session)
+    if coleccion is None:
+        coleccion = usuarios_collection
+    usuario = await coleccion.find_one({"_id": ObjectId(user_id)}, session=session)
     if not usuario:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    guardar_perfil(user_id, usuario)
     return usuario
 
 
-async def _build_counterparty(user_id: str):
-    try:
-        usuario = await _obtener_usuario(user_id)
-        nombre = f"{usuario.get('nombres', '')} {usuario.get('apellidos', '')}".strip()
-        return {
-            "id": user_id,
-            "name": nombre or "Usuario",
-            "avatar": _build_avatar_url(usuario.get("foto_url")) or "",
-        }
-    except HTTPException:
-        # Si el usuario ya no existe, devolvemos datos mínimos
-        return {"id": user_id, "name": "Usuario", "avatar": ""}
+def _cerrar_sesion(session):
+    if session is not None:
+        session.end_session()
 
 
 @router.get("/saldo/{user_id}")
-async def obtener_saldo(user_id: str):
-    usuario = await _obtener_usuario(user_id)
-    return {"saldo": float(usuario.get("saldo_creditos", 0.0))}
+async def obtener_saldo(user_id: str, request: Request):
+    # Sin token causal el saldo se lee del primario; con token puede servirlo
+    # un secundario que ya haya replicado la escritura del cliente
+    session = await sesion_lectura(request)
+    try:
+        if session is None:
+            usuario = await _obtener_usuario(user_id)
+        else:
+            usuario = await _obtener_usuario(user_id, session=session, coleccion=usuarios_lectura)
+    finally:
+        _cerrar_sesion(session)
 
+    etag = etag_version(usuario.get("version_ledger", 0))
+    return no_modificado(request, etag) or RespuestaORJSON(
+        {"saldo": float(usuario.get("saldo_creditos", 0.0))}, headers={"ETag": etag}
+    )
 
-@router.get("/transacciones/historial/{user_id}")
-async def historial_transacciones(user_id: str):
-    cursor = (
-        transacciones_collection.find(
-            {
-                "$or": [
-                    {"id_emisor": user_id},
-                    {"id_receptor": user_id},
-                ]
-            }
-        )
-        .sort("fecha", -1)
+
+@router.get("/resumen/{user_id}")
+async def resumen_usuario(
+    user_id: str,
+    request: Request,
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+):
+    """Enviado, recibido y bonificado por día y tipo, leído solo de los resúmenes."""
+    session = await sesion_lectura(request)
+    try:
+        resumenes = await resumenes_lectura.find(
+            {"usuario": user_id, **filtro_dias(desde, hasta)}, session=session
+        ).to_list(None)
+    finally:
+        _cerrar_sesion(session)
+    return {"usuario": user_id, **combinar(resumenes)}
+
+
+def _contraparte_historial(transaccion: dict, user_id: str) -> Optional[str]:
+    if transaccion.get("tipo", "transferencia") == "asignacion" or transaccion.get("id_emisor") == "admin":
+        return transaccion.get("id_emisor")
+    if transaccion.get("id_receptor") == user_id:
+        return transaccion.get("id_emisor")
+    return transaccion.get("id_receptor")
+
+
+def _contraparte_servicio(transaccion: dict, user_id: str) -> Optional[str]:
+    if transaccion.get("id_emisor") == user_id:
+        return transaccion.get("id_receptor")
+    return transaccion.get("id_emisor")
+
+
+def _formatear_historial(transaccion: dict, user_id: str, resolutor: ResolutorContrapartes) -> dict:
+    tipo_original = transaccion.get("tipo", "transferencia")
+
+    if tipo_original == "asignacion" or transaccion.get("id_emisor") == "admin":
+        tipo = "bonus"
+    elif transaccion.get("id_receptor") == user_id:
+        tipo = "received"
+    else:
+        tipo = "sent"
+
+    contraparte_id = _contraparte_historial(transaccion, user_id)
+    return {
+        "id": str(transaccion.get("_id")),
+        "type": tipo,
+        "amount": float(transaccion.get("monto", 0)),
+        "date": transaccion.get("fecha") or datetime.utcnow(),
+        "description": transaccion.get("justificacion") or tipo_original,
+        "status": transaccion.get("estado", "completed"),
+        "counterparty": resolutor.obtener(contraparte_id)
+        if contraparte_id
+        else None,
+        "id_servicio": transaccion.get("id_servicio"),
+    }
+
+
+def _formatear_servicio(transaccion: dict, user_id: str, resolutor: ResolutorContrapartes) -> dict:
+    contraparte_id = _contraparte_servicio(transaccion, user_id)
+    return {
+        "id": str(transaccion.get("_id")),
+        "servicio_id": transaccion.get("id_servicio"),
+        "titulo": transaccion.get("servicio_titulo")
+        or transaccion.get("justificacion")
+        or "Servicio",
+        "fecha": transaccion.get("fecha") or datetime.utcnow(),
+        "estado": transaccion.get("estado", "completed"),
+        "monto": float(transaccion.get("monto", 0)),
+        "contraparte": resolutor.obtener(contraparte_id)
+        if contraparte_id
+        else None,
+    }
+
+
+def _formatear_pendiente(t: dict, resolutor: ResolutorContrapartes) -> dict:
+    return {
+        "id": str(t.get("_id")),
+        "servicio_id": t.get("id_servicio"),
+        "titulo": t.get("servicio_titulo") or t.get("justificacion") or "Servicio",
+        "fecha": t.get("fecha") or datetime.utcnow(),
+        "estado": t.get("estado", "pending"),
+        "monto": float(t.get("monto", 0)),
+        "contraparte": resolutor.obtener(t.get("id_emisor")),
+    }
+
+
+def _linea_ndjson(contenido: dict) -> bytes:
+    return a_json(contenido) + b"\n"
+
+
+async def _filas_python(user_id, filtro, limit, resolutor, session=None, tamano=None, coleccion=None):
+    consulta = (coleccion or transacciones_lectura).find(filtro, session=session).sort(ORDEN_KEYSET)
+    if limit is not None:
+        # Una fila extra indica si existe una página siguiente
+        consulta = consulta.limit(limit + 1)
+    async for lote in iterar_por_lotes(consulta, tamano or TAMANO_LOTE_CONTRAPARTES):
+        await resolutor.cargar(_contraparte_historial(t, user_id) for t in lote)
+        for transaccion in lote:
+            yield _formatear_historial(transaccion, user_id, resolutor), transaccion
+
+
+async def _filas_agregacion(user_id, filtro, limit, resolutor, session=None, tamano=None, coleccion=None):
+    # Clasificación, contrapartes y forma de cada fila las resuelve Mongo
+    cursor = (coleccion or transacciones_lectura).aggregate(
+        pipeline_historial(user_id, filtro, limit),
+        session=session,
+        batchSize=tamano or TAMANO_LOTE_CONTRAPARTES,
     )
+    async for fila in cursor:
+        clave = {"_id": fila.pop("_id"), "fecha": fila.pop("_fecha", None)}
+        yield fila, clave
 
-    historial = []
-    async for transaccion in cursor:
-        tipo_original = transaccion.get("tipo", "transferencia")
 
-        if tipo_original == "asignacion" or transaccion.get("id_emisor") == "admin":
-            tipo = "bonus"
-        elif transaccion.get("id_receptor") == user_id:
-            tipo = "received"
-        else:
-            tipo = "sent"
+MOTORES_HISTORIAL = {"python": _filas_python, "agregacion": _filas_agregacion}
+if HISTORIAL_MOTOR not in MOTORES_HISTORIAL:
+    raise ValueError(f"HISTORIAL_MOTOR desconocido: {HISTORIAL_MOTOR}")
 
-        if tipo == "bonus":
-            contraparte_id = transaccion.get("id_emisor")
-        elif tipo == "received":
-            contraparte_id = transaccion.get("id_emisor")
-        else:
-            contraparte_id = transaccion.get("id_receptor")
-        historial.append(
-            {
-                "id": str(transaccion.get("_id")),
-                "type": tipo,
-                "amount": float(transaccion.get("monto", 0)),
-                "date": (
-                    transaccion.get("fecha").isoformat()
-                    if transaccion.get("fecha")
-                    else datetime.utcnow().isoformat()
-                ),
-                "description": transaccion.get("justificacion") or tipo_original,
-                "status": transaccion.get("estado", "completed"),
-                "counterparty": await _build_counterparty(contraparte_id)
-                if contraparte_id
-                else None,
-                "id_servicio": transaccion.get("id_servicio"),
-            }
-        )
-    return historial
 
+def _clave_fila(elemento) -> tuple:
+    # Con el motor python `clave` es el documento crudo: puede no tener `fecha`
+    _, clave = elemento
+    return clave.get("fecha"), clave["_id"]
 
-@router.get("/transacciones/servicios/{user_id}")
-async def historial_servicios(user_id: str):
-    cursor = (
-        transacciones_collection.find(
-            {
-                "tipo": "servicio",
-                "$or": [
-                    {"id_emisor": user_id},
-                    {"id_receptor": user_id},
-                ],
-            }
-        )
-        .sort("fecha", -1)
+
+def _filas_historial(user_id, filtro, limit, resolutor, session=None, tamano=None):
+    """Filas del motor configurado sobre la colección caliente y, si hace falta, el archivo."""
+    motor = MOTORES_HISTORIAL[HISTORIAL_MOTOR]
+    return mezclar(
+        lambda coleccion: motor(user_id, filtro, limit, resolutor, session, tamano, coleccion),
+        _clave_fila,
+        user_id,
+        session,
+        # Una fila extra indica si existe una página siguiente
+        None if limit is None else limit + 1,
     )
 
-    contratados = []
-    prestados = []
 
-    async for transaccion in cursor:
-        es_contratado = transaccion.get("id_emisor") == user_id
-        contraparte_id = (
-            transaccion.get("id_receptor")
-            if es_contratado
-            else transaccion.get("id_emisor")
+async def _stream_historial(filas, limit: Optional[int], resolutor):
+    """Emite el historial en NDJSON a medida que llegan las filas.
+
+    Si se pidió `limit` y quedan más filas, la última línea es
+    `{"siguiente_cursor": ...}` en lugar de una transacción. La sesión
+    causal la cierra la tarea de fondo de la respuesta, no este generador:
+    si el cliente se desconecta antes del cuerpo, el generador nunca arranca
+    y su `finally` no se ejecuta.
+    """
+    try:
+        emitidas = 0
+        ultima = None
+        async for fila, clave in filas:
+            if limit is not None and emitidas == limit:
+                yield _linea_ndjson({"siguiente_cursor": codificar_cursor(ultima)})
+                break
+            yield _linea_ndjson(fila)
+            emitidas += 1
+            ultima = clave
+        resolutor.reportar("historial_transacciones")
+    finally:
+        await filas.aclose()
+
+
+@router.get("/transacciones/historial/{user_id}")
+async def historial_transacciones(
+    user_id: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=LIMITE_MAXIMO_HISTORIAL),
+    cursor: Optional[str] = None,
+):
+    """Historial del usuario, completo o por páginas con `limit` y `cursor`.
+
+    El ETag combina `version_ledger` con la generación de la caché de
+    perfiles: el nombre o avatar de una contraparte puede seguir desfasado
+    hasta que cambie la ventana de `CACHE_PERFILES_TTL` y caduque su perfil
+    en caché (dos ventanas como mucho).
+    """
+    keyset = {}
+    if cursor:
+        keyset = filtro_keyset(cursor)
+        limit = limit or LIMITE_POR_DEFECTO_HISTORIAL
+    filtro = {
+        "$or": [
+            {"id_emisor": user_id, **keyset},
+            {"id_receptor": user_id, **keyset},
+        ]
+    }
+
+    ndjson = "application/x-ndjson" in request.headers.get("accept", "")
+    # La versión se lee antes que las filas y en la misma sesión causal: el
+    # cuerpo nunca queda por detrás del ETag aunque lo sirva otro secundario
+    session = await sesion_lectura(request, siempre=True)
+    cabeceras = {}
+    version = await version_ledger(user_id, usuarios_lectura, session)
+    if version is not None:
+        etag = etag_version(version, "ndjson" if ndjson else "json", generacion_perfiles())
+        cabeceras = {"ETag": etag, "Vary": "Accept"}
+        sin_cambios = no_modificado(request, cabeceras["ETag"], cabeceras["Vary"])
+        if sin_cambios:
+            _cerrar_sesion(session)
+            return sin_cambios
+
+    resolutor = ResolutorContrapartes()
+
+    # Sin `limit` ni `cursor` se devuelve el historial completo como antes
+    if ndjson:
+        filas = _filas_historial(user_id, filtro, limit, resolutor, session, TAMANO_LOTE_STREAMING)
+        return StreamingResponse(
+            _stream_historial(filas, limit, resolutor),
+            media_type="application/x-ndjson",
+            headers=cabeceras,
+            background=BackgroundTask(_cerrar_sesion, session),
         )
 
-        item = {
-            "id": str(transaccion.get("_id")),
-            "servicio_id": transaccion.get("id_servicio"),
-            "titulo": transaccion.get("servicio_titulo")
-            or transaccion.get("justificacion")
-            or "Servicio",
-            "fecha": (
-                transaccion.get("fecha").isoformat()
-                if transaccion.get("fecha")
-                else datetime.utcnow().isoformat()
-            ),
-            "estado": transaccion.get("estado", "completed"),
-            "monto": float(transaccion.get("monto", 0)),
-            "contraparte": await _build_counterparty(contraparte_id)
-            if contraparte_id
-            else None,
-        }
+    historial = []
+    ultima = None
+    hay_mas = False
+    filas = _filas_historial(user_id, filtro, limit, resolutor, session)
+    try:
+        async for fila, clave in filas:
+            if limit is not None and len(historial) == limit:
+                hay_mas = True
+                break
+            historial.append(fila)
+            ultima = clave
+    finally:
+        await filas.aclose()
+        _cerrar_sesion(session)
+
+    respuesta = RespuestaORJSON(historial, headers=cabeceras)
+    if hay_mas:
+        respuesta.headers["X-Siguiente-Cursor"] = codificar_cursor(ultima)
+    resolutor.reportar("historial_transacciones", respuesta)
+    return respuesta
+
+
+@router.get("/transacciones/historial/{user_id}/exportar")
+async def exportar_historial(
+    user_id: str,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    tipo: Optional[TipoTransaccion] = None,
+    usuario_actual: str = Depends(get_current_user),
+):
+    """Extracto completo en CSV, emitido por lotes a medida que avanza el cursor."""
+    if usuario_actual != user_id:
+        raise HTTPException(status_code=403, detail="Solo puedes exportar tu propio historial")
+
+    extra = filtro_exportacion(desde, hasta, tipo)
+    # El rango de fechas cae dentro de los índices (id_*, fecha, _id) de cada rama
+    filtro = {"$or": [{"id_emisor": user_id, **extra}, {"id_receptor": user_id, **extra}]}
+    resolutor = ResolutorContrapartes()
+    filas = _filas_historial(user_id, filtro, None, resolutor, None, TAMANO_LOTE_STREAMING)
+    return StreamingResponse(
+        stream_csv(filas, TAMANO_LOTE_STREAMING),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="historial_{user_id}.csv"'},
+    )
 
-        if es_contratado:
-            contratados.append(item)
-        else:
-            prestados.append(item)
 
-    return {"contratados": contratados, "prestados": prestados}
+@router.get("/transacciones/servicios/{user_id}")
+async def historial_servicios(user_id: str, request: Request):
+    """Servicios contratados y prestados; el ETag se comporta como el de `historial_transacciones`."""
+    session = await sesion_lectura(request, siempre=True)
+    cabeceras = {}
+    version = await version_ledger(user_id, usuarios_lectura, session)
+    if version is not None:
+        cabeceras = {"ETag": etag_version(version, generacion=generacion_perfiles())}
+        sin_cambios = no_modificado(request, cabeceras["ETag"])
+        if sin_cambios:
+            _cerrar_sesion(session)
+            return sin_cambios
+
+    filtro = {
+        "tipo": "servicio",
+        "$or": [
+            {"id_emisor": user_id},
+            {"id_receptor": user_id},
+        ],
+    }
+
+    async def servicios(coleccion):
+        async for transaccion in coleccion.find(filtro, session=session).sort(ORDEN_KEYSET):
+            yield transaccion
+
+    cursor = mezclar(servicios, lambda t: (t.get("fecha"), t["_id"]), user_id, session)
+
+    contratados = []
+    prestados = []
+
+    resolutor = ResolutorContrapartes()
+    try:
+        async for lote in iterar_por_lotes(cursor):
+            await resolutor.cargar(_contraparte_servicio(t, user_id) for t in lote)
+            for transaccion in lote:
+                item = _formatear_servicio(transaccion, user_id, resolutor)
+                if transaccion.get("id_emisor") == user_id:
+                    contratados.append(item)
+                else:
+                    prestados.append(item)
+    finally:
+        await cursor.aclose()
+        _cerrar_sesion(session)
+
+    respuesta = RespuestaORJSON({"contratados": contratados, "prestados": prestados}, headers=cabeceras)
+    resolutor.reportar("historial_servicios", respuesta)
+    return respuesta
 
 
 @router.post("/transacciones/servicio")
-async def pagar_servicio(payload: ServicioTransaccion):
-    comprador = await _obtener_usuario(payload.comprador_id)
-    proveedor = await _obtener_usuario(payload.proveedor_id)
+async def pagar_servicio(
+    payload: ServicioTransaccion,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await ejecutar_idempotente(
+        idempotency_key,
+        f"servicio:{payload.comprador_id}",
+        payload,
+        lambda registro: _pagar_servicio(payload, registro),
+        response,
+    )
+
+
+async def _pagar_servicio(payload: ServicioTransaccion, registro: RegistroIdempotencia):
+    await obtener_perfil(payload.comprador_id)
+    await obtener_perfil(payload.proveedor_id)
 
     if payload.comprador_id == payload.proveedor_id:
         raise HTTPException(
             status_code=400, detail="No puedes pagar un servicio a tu propio usuario"
         )
 
-    saldo_actual = float(comprador.get("saldo_creditos", 0.0))
-    if saldo_actual < payload.monto:
-        raise HTTPException(status_code=400, detail="Saldo insuficiente")
-
     transaccion_doc = {
         "id_emisor": payload.comprador_id,
         "id_receptor": payload.proveedor_id,
@@ -195,35 +436,28 @@ async def pagar_servicio(payload: ServicioTransaccion):
         "fecha": datetime.utcnow(),
     }
 
-    async with await client.start_session() as session:
-        async with session.start_transaction():
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(payload.comprador_id)},
-                {"$inc": {"saldo_creditos": -payload.monto}},
-                session=session,
-            )
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(payload.proveedor_id)},
-                {"$inc": {"saldo_creditos": payload.monto}},
-                session=session,
-            )
-            result = await transacciones_collection.insert_one(
-                transaccion_doc, session=session
-            )
-            transaccion_doc["_id"] = str(result.inserted_id)
+    async def operacion(session):
+        nuevo_saldo = await debitar(payload.comprador_id, payload.monto, session=session)
+        await acreditar(payload.proveedor_id, payload.monto, session=session)
+        # Copia: insert_one añade el _id al dict y un reintento debe partir limpio
+        result = await transacciones_collection.insert_one(dict(transaccion_doc), session=session)
+        await acumular([transaccion_doc], session=session)
+        respuesta = {
+            "id": str(result.inserted_id),
+            "nuevo_saldo": nuevo_saldo,
+            "transaccion": {**transaccion_doc, "_id": str(result.inserted_id)},
+        }
+        await registro.guardar(respuesta, session)
+        return respuesta
 
-    return {
-        "id": transaccion_doc["_id"],
-        "nuevo_saldo": saldo_actual - payload.monto,
-        "transaccion": transaccion_doc,
-    }
+    return await ejecutar_transaccion("pagar_servicio", operacion)
 
 
 @router.post("/transacciones/servicio/solicitar")
 async def solicitar_servicio(payload: ServicioTransaccion):
     # Valida usuarios pero no mueve saldos todavía
-    await _obtener_usuario(payload.comprador_id)
-    await _obtener_usuario(payload.proveedor_id)
+    await obtener_perfil(payload.comprador_id)
+    await obtener_perfil(payload.proveedor_id)
 
     transaccion_doc = {
         "id_emisor": payload.comprador_id,
@@ -236,33 +470,117 @@ async def solicitar_servicio(payload: ServicioTransaccion):
         "estado": "pending",
         "fecha": datetime.utcnow(),
     }
-    result = await transacciones_collection.insert_one(transaccion_doc)
-    transaccion_doc["_id"] = str(result.inserted_id)
+
+    async def operacion(session):
+        result = await transacciones_collection.insert_one(dict(transaccion_doc), session=session)
+        # La solicitud aparece en el historial de ambos aunque no mueva saldo
+        await versionar([payload.comprador_id, payload.proveedor_id], session=session)
+        return result.inserted_id
+
+    transaccion_doc["_id"] = str(await ejecutar_transaccion("solicitar_servicio", operacion))
     return transaccion_doc
 
 
-@router.get("/transacciones/servicio/pendientes/{proveedor_id}")
-async def solicitudes_pendientes(proveedor_id: str):
-    cursor = transacciones_collection.find(
-        {"tipo": "servicio", "estado": "pending", "id_receptor": proveedor_id}
+async def _listar_pendientes(
+    proveedor_id: str, resolutor: ResolutorContrapartes, session=None, coleccion=None
+) -> list:
+    cursor = (coleccion or transacciones_lectura).find(
+        {"tipo": "servicio", "estado": "pending", "id_receptor": proveedor_id},
+        session=session,
     ).sort("fecha", -1)
 
     solicitudes = []
-    async for t in cursor:
-        solicitudes.append(
-            {
-                "id": str(t.get("_id")),
-                "servicio_id": t.get("id_servicio"),
-                "titulo": t.get("servicio_titulo") or t.get("justificacion") or "Servicio",
-                "fecha": t.get("fecha").isoformat() if t.get("fecha") else datetime.utcnow().isoformat(),
-                "estado": t.get("estado", "pending"),
-                "monto": float(t.get("monto", 0)),
-                "contraparte": await _build_counterparty(t.get("id_emisor")),
-            }
-        )
+    async for lote in iterar_por_lotes(cursor):
+        await resolutor.cargar(t.get("id_emisor") for t in lote)
+        solicitudes.extend(_formatear_pendiente(t, resolutor) for t in lote)
     return solicitudes
 
 
+@router.get("/transacciones/servicio/pendientes/{proveedor_id}")
+async def solicitudes_pendientes(proveedor_id: str, request: Request):
+    resolutor = ResolutorContrapartes()
+    session = await sesion_lectura(request)
+    try:
+        respuesta = RespuestaORJSON(await _listar_pendientes(proveedor_id, resolutor, session))
+    finally:
+        _cerrar_sesion(session)
+    resolutor.reportar("solicitudes_pendientes", respuesta)
+    return respuesta
+
+
+def _evento_sse(evento: str, contenido, id_sse: Optional[str] = None) -> bytes:
+    cabecera = f"event: {evento}\n" + (f"id: {id_sse}\n" if id_sse else "")
+    return cabecera.encode() + b"data: " + a_json(contenido) + b"\n\n"
+
+
+async def _evento_solicitud(cambio: dict, resolutor: ResolutorContrapartes) -> bytes:
+    documento = cambio["fullDocument"]
+    await resolutor.cargar([documento.get("id_emisor")])
+    return _evento_sse("solicitud", _formatear_pendiente(documento, resolutor), id_evento(cambio))
+
+
+async def _stream_pendientes(proveedor_id: str, ultimo_id: Optional[str]):
+    """Eventos SSE de las solicitudes de servicio de un proveedor.
+
+    Sin `Last-Event-ID` empieza con un evento `pendientes` con la lista
+    completa. Al reconectar recupera con un change stream propio los cambios
+    que se perdió y descarta los que también llegan por el stream compartido.
+    """
+    yield b"retry: 3000\n\n"
+    # Suscribirse, con el stream compartido ya abierto, antes de leer el
+    # estado para no perder cambios intermedios
+    try:
+        suscripcion = await difusor_servicios.suscribir(proveedor_id)
+    except asyncio.TimeoutError:
+        # El cliente reintenta solo tras `retry`
+        return
+    resolutor = ResolutorContrapartes()
+    try:
+        enviados = set()
+        recuperado = False
+        if ultimo_id:
+            try:
+                async for cambio in ponerse_al_dia(proveedor_id, ultimo_id):
+                    enviados.add(id_evento(cambio))
+                    yield await _evento_solicitud(cambio, resolutor)
+                recuperado = True
+            except PyMongoError as exc:
+                print(f"🔴 No se pudo reanudar desde Last-Event-ID: {exc}")
+        if not recuperado:
+            # Del primario: un secundario podría no tener aún lo anterior a la apertura del stream
+            pendientes = await _listar_pendientes(proveedor_id, resolutor, coleccion=transacciones_collection)
+            yield _evento_sse("pendientes", pendientes)
+
+        while True:
+            try:
+                cambio = await asyncio.wait_for(suscripcion.cola.get(), SSE_KEEPALIVE_SEGUNDOS)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if cambio is None:
+                return
+            if enviados:
+                # Los duplicados del stream privado llegan al principio de la cola
+                if id_evento(cambio) in enviados:
+                    continue
+                enviados.clear()
+            yield await _evento_solicitud(cambio, resolutor)
+    finally:
+        difusor_servicios.cancelar(suscripcion)
+
+
+@router.get("/transacciones/servicio/pendientes/{proveedor_id}/eventos")
+async def eventos_pendientes(
+    proveedor_id: str,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    return StreamingResponse(
+        _stream_pendientes(proveedor_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/transacciones/servicio/{transaccion_id}/aceptar")
 async def aceptar_servicio(transaccion_id: str, payload: AceptarServicioPayload):
     if not ObjectId.is_valid(transaccion_id):
@@ -285,35 +603,34 @@ async def aceptar_servicio(transaccion_id: str, payload: AceptarServicioPayload)
     proveedor_id = transaccion.get("id_receptor")
     monto = float(transaccion.get("monto", 0))
 
-    comprador = await _obtener_usuario(comprador_id)
-    _ = await _obtener_usuario(proveedor_id)
+    await obtener_perfil(comprador_id)
+    await obtener_perfil(proveedor_id)
 
-    saldo_actual = float(comprador.get("saldo_creditos", 0.0))
-    if saldo_actual < monto:
-        raise HTTPException(status_code=400, detail="Saldo insuficiente para completar el pago")
+    async def operacion(session):
+        completada = {**transaccion, "estado": "completed", "fecha": datetime.utcnow()}
+        # Solo una aceptación concurrente puede pasar la solicitud a completed
+        gestion = await transacciones_collection.update_one(
+            {"_id": ObjectId(transaccion_id), "estado": "pending"},
+            {
+                "$set": {
+                    "estado": completada["estado"],
+                    "fecha": completada["fecha"],
+                }
+            },
+            session=session,
+        )
+        if gestion.matched_count == 0:
+            raise HTTPException(status_code=400, detail="La solicitud ya fue gestionada")
+        await debitar(
+            comprador_id,
+            monto,
+            session=session,
+            detalle="Saldo insuficiente para completar el pago",
+        )
+        await acreditar(proveedor_id, monto, session=session)
+        await acumular([completada], session=session)
 
-    async with await client.start_session() as session:
-        async with session.start_transaction():
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(comprador_id)},
-                {"$inc": {"saldo_creditos": -monto}},
-                session=session,
-            )
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(proveedor_id)},
-                {"$inc": {"saldo_creditos": monto}},
-                session=session,
-            )
-            await transacciones_collection.update_one(
-                {"_id": ObjectId(transaccion_id)},
-                {
-                    "$set": {
-                        "estado": "completed",
-                        "fecha": datetime.utcnow(),
-                    }
-                },
-                session=session,
-            )
+    await ejecutar_transaccion("aceptar_servicio", operacion)
 
     transaccion_actualizada = await transacciones_collection.find_one({"_id": ObjectId(transaccion_id)})
     transaccion_actualizada["_id"] = str(transaccion_actualizada["_id"])
@@ -321,16 +638,27 @@ async def aceptar_servicio(transaccion_id: str, payload: AceptarServicioPayload)
 
 
 @router.post("/transacciones/transferir")
-async def transferir_creditos(datos: Transaccion, user_id: str = Depends(get_current_user)):
+async def transferir_creditos(
+    datos: Transaccion,
+    response: Response,
+    user_id: str = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     if user_id != datos.id_emisor:
         raise HTTPException(status_code=403, detail="No puedes transferir como otro usuario")
 
-    emisor = await _obtener_usuario(datos.id_emisor)
-    receptor = await _obtener_usuario(datos.id_receptor)
+    return await ejecutar_idempotente(
+        idempotency_key,
+        f"transferir:{user_id}",
+        datos,
+        lambda registro: _transferir(datos, registro),
+        response,
+    )
+
 
-    saldo_emisor = float(emisor.get("saldo_creditos", 0.0))
-    if saldo_emisor < datos.monto:
-        raise HTTPException(status_code=400, detail="Saldo insuficiente")
+async def _transferir(datos: Transaccion, registro: RegistroIdempotencia):
+    await obtener_perfil(datos.id_emisor)
+    await obtener_perfil(datos.id_receptor)
 
     transaccion_doc = {
         "id_emisor": datos.id_emisor,
@@ -342,36 +670,162 @@ async def transferir_creditos(datos: Transaccion, user_id: str = Depends(get_cur
         "fecha": datos.fecha or datetime.utcnow(),
     }
 
-    async with await client.start_session() as session:
-        async with session.start_transaction():
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(datos.id_emisor)},
-                {"$inc": {"saldo_creditos": -datos.monto}},
-                session=session,
+    async def operacion(session):
+        await debitar(datos.id_emisor, datos.monto, session=session)
+        await acreditar(datos.id_receptor, datos.monto, session=session)
+        result = await transacciones_collection.insert_one(dict(transaccion_doc), session=session)
+        await acumular([transaccion_doc], session=session)
+        respuesta = {**transaccion_doc, "_id": str(result.inserted_id)}
+        await registro.guardar(respuesta, session)
+        return respuesta
+
+    return await ejecutar_transaccion("transferir_creditos", operacion)
+
+
+def _validar_receptor_lote(id_emisor: str, id_receptor: str, existentes: set) -> Optional[str]:
+    if not ObjectId.is_valid(id_receptor):
+        return "ID de usuario inválido"
+    if id_receptor == id_emisor:
+        return "No puedes transferirte a ti mismo"
+    if id_receptor not in existentes:
+        return "Usuario no encontrado"
+    return None
+
+
+@router.post("/transacciones/transferir/lote")
+async def transferir_lote(
+    datos: TransferenciaLote,
+    response: Response,
+    user_id: str = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    if user_id != datos.id_emisor:
+        raise HTTPException(status_code=403, detail="No puedes transferir como otro usuario")
+
+    return await ejecutar_idempotente(
+        idempotency_key,
+        f"lote:{user_id}",
+        datos,
+        lambda registro: _transferir_lote(datos, registro),
+        response,
+    )
+
+
+async def _transferir_lote(datos: TransferenciaLote, registro: RegistroIdempotencia):
+    if len(datos.transferencias) > TRANSFERENCIA_LOTE_MAXIMO:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Un lote admite como máximo {TRANSFERENCIA_LOTE_MAXIMO} transferencias",
+        )
+
+    await obtener_perfil(datos.id_emisor)
+
+    candidatos = list(
+        {ObjectId(t.id_receptor) for t in datos.transferencias if ObjectId.is_valid(t.id_receptor)}
+    )
+    fecha = datetime.utcnow()
+
+    async def operacion(session):
+        # Los receptores se validan con una sola consulta dentro de la
+        # transacción: un borrado concurrente aborta el intento por conflicto
+        existentes = {
+            str(u["_id"])
+            async for u in usuarios_collection.find(
+                {"_id": {"$in": candidatos}}, {"_id": 1}, session=session
             )
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(datos.id_receptor)},
-                {"$inc": {"saldo_creditos": datos.monto}},
-                session=session,
+        }
+        intento = []
+        for indice, item in enumerate(datos.transferencias):
+            error = _validar_receptor_lote(datos.id_emisor, item.id_receptor, existentes)
+            intento.append(
+                {
+                    "indice": indice,
+                    "id_receptor": item.id_receptor,
+                    "monto": item.monto,
+                    "estado": "rechazada" if error else "completed",
+                    "detalle": error,
+                }
+            )
+
+        if datos.atomico and any(r["detalle"] for r in intento):
+            raise HTTPException(
+                status_code=400,
+                detail={"mensaje": "El lote contiene transferencias inválidas", "resultados": intento},
             )
-            result = await transacciones_collection.insert_one(
-                transaccion_doc, session=session
+        if not datos.atomico:
+            # Se aceptan en orden mientras alcance el saldo leído dentro de la transacción
+            emisor = await usuarios_collection.find_one(
+                {"_id": ObjectId(datos.id_emisor)}, {"saldo_creditos": 1}, session=session
             )
-            transaccion_doc["_id"] = str(result.inserted_id)
+            disponible = float(emisor.get("saldo_creditos", 0.0)) if emisor else 0.0
+            for resultado in intento:
+                if resultado["detalle"]:
+                    continue
+                if resultado["monto"] > disponible:
+                    resultado["estado"] = "rechazada"
+                    resultado["detalle"] = "Saldo insuficiente"
+                else:
+                    disponible -= resultado["monto"]
+
+        aceptadas = [r for r in intento if not r["detalle"]]
+        if not aceptadas:
+            respuesta = {"total": 0, "transferencias": intento}
+            await registro.guardar(respuesta, session)
+            return respuesta
+
+        total = sum(r["monto"] for r in aceptadas)
+        creditos = {}
+        for r in aceptadas:
+            creditos[r["id_receptor"]] = creditos.get(r["id_receptor"], 0) + r["monto"]
+
+        # El débito va aparte para no confundir un receptor ausente con falta de saldo
+        await debitar(datos.id_emisor, total, session=session)
+        escritura = await usuarios_collection.bulk_write(
+            [
+                UpdateOne({"_id": ObjectId(receptor)}, {"$inc": {"saldo_creditos": monto, **INC_VERSION}})
+                for receptor, monto in creditos.items()
+            ],
+            ordered=False,
+            session=session,
+        )
+        if escritura.matched_count != len(creditos):
+            raise HTTPException(status_code=400, detail="Usuario receptor no encontrado")
 
-    return transaccion_doc
+        documentos = [
+            {
+                "id_emisor": datos.id_emisor,
+                "id_receptor": r["id_receptor"],
+                "monto": r["monto"],
+                "tipo": "transferencia",
+                "estado": "completed",
+                "justificacion": datos.transferencias[r["indice"]].justificacion,
+                "fecha": fecha,
+            }
+            for r in aceptadas
+        ]
+        insercion = await transacciones_collection.insert_many(
+            documentos, ordered=True, session=session
+        )
+        await acumular(documentos, session=session)
+        for resultado, transaccion_id in zip(aceptadas, insercion.inserted_ids):
+            resultado["id"] = str(transaccion_id)
+        respuesta = {"total": total, "transferencias": intento}
+        await registro.guardar(respuesta, session)
+        return respuesta
+
+    return await ejecutar_transaccion("transferir_lote", operacion)
 
 
 @router.post("/admin/asignar_creditos")
 async def asignar_creditos(datos: Transaccion, user_id: str = Depends(get_current_user)):
-    admin = await _obtener_usuario(user_id)
+    admin = await obtener_perfil(user_id)
     if admin.get("rol") != "admin":
         raise HTTPException(status_code=403, detail="Acceso restringido a administradores")
 
     if not datos.id_receptor:
         raise HTTPException(status_code=400, detail="Falta receptor")
 
-    await _obtener_usuario(datos.id_receptor)  # valida existencia
+    await obtener_perfil(datos.id_receptor)  # valida existencia
 
     nueva_transaccion = {
         "id_emisor": "admin",
@@ -383,18 +837,14 @@ async def asignar_creditos(datos: Transaccion, user_id: str = Depends(get_curren
         "justificacion": datos.justificacion or "Asignación de créditos",
     }
 
-    async with await client.start_session() as session:
-        async with session.start_transaction():
-            await usuarios_collection.update_one(
-                {"_id": ObjectId(datos.id_receptor)},
-                {"$inc": {"saldo_creditos": datos.monto}},
-                session=session,
-            )
-            result = await transacciones_collection.insert_one(
-                nueva_transaccion, session=session
-            )
+    async def operacion(session):
+        await acreditar(datos.id_receptor, datos.monto, session=session)
+        result = await transacciones_collection.insert_one(dict(nueva_transaccion), session=session)
+        await acumular([nueva_transaccion], session=session)
+        return result.inserted_id
 
+    transaccion_id = await ejecutar_transaccion("asignar_creditos", operacion)
     return {
         "mensaje": f"Se asignaron {datos.monto} créditos al usuario {datos.id_receptor}",
-        "transaccion": {**nueva_transaccion, "_id": str(result.inserted_id)},
+        "transaccion": {**nueva_transaccion, "_id": str(transaccion_id)},
     }
@@ -0,0 +1,256 @@
+"""Control de admisión: límites por usuario o IP y concurrencia de historiales.
+
+Cada ruta configurada tiene un cubo de tokens (`tasa` por segundo, hasta
+`rafaga`) por identidad: el `sub` del JWT si el token es válido y, si no,
+la IP del cliente. Las rutas de historial comparten además un límite global
+de requests en curso con una cola corta; lo que no cabe se rechaza con 503
+en vez de esperar sin límite a una conexión del pool.
+
+Los límites se sobrescriben con `ADMISION_LIMITES`, un JSON del tipo
+`{"GET /api/transacciones/historial/{user_id}": [10, 20]}`; `[0, 0]`
+desactiva el límite de esa ruta y la clave `"*"` cambia el de todas
+(`{"*": [0, 0]}` los desactiva, como hace `benchmarks.reproducir`).
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from jose import JWTError
+from prometheus_client import Counter, Gauge
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from starlette.routing import Match
+
+from app.db.mongo import db
+from app.utils.cache import CacheLRU
+from app.utils.jwt_handler import decodificar_token
+
+# (tasa por segundo, ráfaga) por "MÉTODO plantilla"
+LIMITES_POR_DEFECTO = {
+    "GET /api/transacciones/historial/{user_id}": (10, 20),
+    "GET /api/transacciones/historial/{user_id}/exportar": (0.2, 2),
+    "GET /api/transacciones/servicios/{user_id}": (10, 20),
+    "POST /api/transacciones/transferir": (5, 10),
+    "POST /api/transacciones/transferir/lote": (1, 5),
+    "POST /api/transacciones/servicio": (5, 10),
+    "GET /admin/exportar/transacciones": (0.1, 1),
+}
+_SOBRESCRITOS = json.loads(os.getenv("ADMISION_LIMITES", "{}"))
+# "*" sustituye el límite por defecto de todas las rutas; las demás claves lo precisan
+_TODAS = _SOBRESCRITOS.pop("*", None)
+_BASE = {ruta: _TODAS for ruta in LIMITES_POR_DEFECTO} if _TODAS is not None else LIMITES_POR_DEFECTO
+LIMITES = {ruta: tuple(limite) for ruta, limite in {**_BASE, **_SOBRESCRITOS}.items() if limite[0] > 0}
+
+# Rutas que recorren el ledger y comparten el límite de concurrencia
+RUTAS_HISTORIAL = {
+    "GET /api/transacciones/historial/{user_id}",
+    "GET /api/transacciones/historial/{user_id}/exportar",
+    "GET /api/transacciones/servicios/{user_id}",
+    "GET /admin/exportar/transacciones",
+}
+ADMISION_HISTORIAL_CONCURRENCIA = int(os.getenv("ADMISION_HISTORIAL_CONCURRENCIA", "32"))
+ADMISION_HISTORIAL_COLA = int(os.getenv("ADMISION_HISTORIAL_COLA", "64"))
+ADMISION_HISTORIAL_ESPERA_SEGUNDOS = float(os.getenv("ADMISION_HISTORIAL_ESPERA_SEGUNDOS", "0.5"))
+
+# "memoria" (por proceso) o "mongo" (ventana fija compartida entre procesos)
+ADMISION_BACKEND = os.getenv("ADMISION_BACKEND", "memoria")
+# Solo detrás de un proxy de confianza: si no, el cliente elige su IP
+ADMISION_CONFIAR_PROXY = os.getenv("ADMISION_CONFIAR_PROXY", "0") == "1"
+
+ADMISION_RECHAZOS = Counter(
+    "admision_rechazos_total",
+    "Requests rechazadas por el control de admisión",
+    ["ruta", "motivo"],
+)
+ADMISION_HISTORIAL_EN_CURSO = Gauge(
+    "admision_historial_en_curso",
+    "Requests de historial ejecutándose",
+    multiprocess_mode="livesum",
+)
+ADMISION_HISTORIAL_EN_ESPERA = Gauge(
+    "admision_historial_en_espera",
+    "Requests de historial esperando turno",
+    multiprocess_mode="livesum",
+)
+ADMISION_BACKEND_ERRORES = Counter(
+    "admision_backend_errores_total",
+    "Fallos del backend compartido de límites (la request se admite)",
+)
+
+
+class CubosMemoria:
+    """Cubos de tokens en el proceso; un cubo inactivo caduca cuando ya estaría lleno."""
+
+    def __init__(self, capacidad: int = 100_000):
+        self._cubos = CacheLRU("admision_cubos", capacidad=capacidad, ttl=3600)
+
+    async def consumir(self, clave: str, tasa: float, rafaga: float) -> float:
+        """Consume un token; devuelve 0 si hay, o los segundos hasta el siguiente."""
+        ahora = time.monotonic()
+        tokens, ultimo = self._cubos.obtener(clave) or (rafaga, ahora)
+        tokens = min(rafaga, tokens + (ahora - ultimo) * tasa)
+        if tokens < 1:
+            return (1 - tokens) / tasa
+        self._cubos.guardar(clave, (tokens - 1, ahora), ttl=rafaga / tasa)
+        return 0.0
+
+
+class VentanasMongo:
+    """Ventana fija de `rafaga / tasa` segundos compartida entre procesos.
+
+    Cada admisión es un `$inc` con upsert en `limites_admision`; el índice
+    TTL sobre `expira` borra las ventanas viejas. Si Mongo falla se admite
+    la request para no convertir el limitador en un punto de caída.
+    """
+
+    async def consumir(self, clave: str, tasa: float, rafaga: float) -> float:
+        duracion = rafaga / tasa
+        ahora = time.time()
+        ventana = int(ahora // duracion)
+        try:
+            contador = await db["limites_admision"].find_one_and_update(
+                {"_id": f"{clave}|{ventana}"},
+                {
+                    "$inc": {"n": 1},
+                    "$setOnInsert": {"expira": datetime.utcnow() + timedelta(seconds=duracion)},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except PyMongoError:
+            ADMISION_BACKEND_ERRORES.inc()
+            return 0.0
+        if contador["n"] <= rafaga:
+            return 0.0
+        return (ventana + 1) * duracion - ahora
+
+
+class LimiteConcurrencia:
+    """Semáforo FIFO con cola acotada y espera máxima.
+
+    Como `asyncio.Semaphore`, al salir el cupo pasa directamente al primero
+    en espera: una request recién llegada no puede adelantarse a las
+    encoladas y dejarlas caducar bajo carga sostenida.
+    """
+
+    def __init__(self, maximo: int, cola: int, espera: float):
+        self.maximo = maximo
+        self.cola = cola
+        self.espera = espera
+        self._en_curso = 0
+        self._esperando: Deque[asyncio.Future] = deque()
+
+    async def entrar(self) -> bool:
+        if self._en_curso < self.maximo and not self._esperando:
+            self._en_curso += 1
+            ADMISION_HISTORIAL_EN_CURSO.inc()
+            return True
+        if len(self._esperando) >= self.cola:
+            return False
+
+        turno = asyncio.get_running_loop().create_future()
+        self._esperando.append(turno)
+        ADMISION_HISTORIAL_EN_ESPERA.inc()
+        try:
+            await asyncio.wait_for(turno, self.espera)
+            return True
+        except BaseException as exc:
+            if turno.done() and not turno.cancelled():
+                # El cupo llegó a la vez que el timeout o la cancelación: se cede
+                self._liberar()
+            if isinstance(exc, asyncio.TimeoutError):
+                return False
+            raise
+        finally:
+            if turno in self._esperando:
+                self._esperando.remove(turno)
+            ADMISION_HISTORIAL_EN_ESPERA.dec()
+
+    def _liberar(self):
+        while self._esperando:
+            turno = self._esperando.popleft()
+            if not turno.done():
+                # El cupo cambia de dueño sin pasar por `_en_curso`
+                turno.set_result(None)
+                return
+        self._en_curso -= 1
+        ADMISION_HISTORIAL_EN_CURSO.dec()
+
+    async def salir(self):
+        self._liberar()
+
+
+def _identidad(scope) -> Tuple[str, str]:
+    """("usuario", sub) si el JWT es válido; si no ("ip", dirección)."""
+    cabeceras = dict(scope.get("headers") or [])
+    autorizacion = cabeceras.get(b"authorization", b"").decode("latin-1")
+    if autorizacion.startswith("Bearer "):
+        try:
+            sub = decodificar_token(autorizacion[7:]).get("sub")
+        except JWTError:
+            sub = None
+        if sub:
+            return "usuario", sub
+    if ADMISION_CONFIAR_PROXY and b"x-forwarded-for" in cabeceras:
+        return "ip", cabeceras[b"x-forwarded-for"].decode("latin-1").split(",")[0].strip()
+    cliente = scope.get("client")
+    return "ip", cliente[0] if cliente else "desconocida"
+
+
+def _rechazo(estado: int, detalle: str, espera: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=estado,
+        content={"detail": detalle},
+        headers={"Retry-After": str(max(1, math.ceil(espera)))},
+    )
+
+
+class ControlAdmision:
+    """Middleware ASGI que aplica los límites antes de llegar a las rutas."""
+
+    def __init__(self, app):
+        self.app = app
+        self.cubos = VentanasMongo() if ADMISION_BACKEND == "mongo" else CubosMemoria()
+        self.historial = LimiteConcurrencia(
+            ADMISION_HISTORIAL_CONCURRENCIA, ADMISION_HISTORIAL_COLA, ADMISION_HISTORIAL_ESPERA_SEGUNDOS
+        )
+
+    def _ruta(self, scope) -> Optional[str]:
+        for ruta in scope["app"].routes:
+            coincidencia, _ = ruta.matches(scope)
+            if coincidencia == Match.FULL:
+                return f"{scope['method']} {ruta.path}"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        ruta = self._ruta(scope)
+        limite = LIMITES.get(ruta)
+        if limite:
+            tipo, identidad = _identidad(scope)
+            espera = await self.cubos.consumir(f"{ruta}|{tipo}:{identidad}", *limite)
+            if espera:
+                ADMISION_RECHAZOS.labels(ruta, f"limite_{tipo}").inc()
+                respuesta = _rechazo(429, "Demasiadas solicitudes, inténtalo más tarde", espera)
+                return await respuesta(scope, receive, send)
+
+        if ruta not in RUTAS_HISTORIAL:
+            return await self.app(scope, receive, send)
+
+        if not await self.historial.entrar():
+            ADMISION_RECHAZOS.labels(ruta, "concurrencia").inc()
+            respuesta = _rechazo(503, "Servicio saturado, inténtalo más tarde", 1)
+            return await respuesta(scope, receive, send)
+        try:
+            # En streaming el cupo se libera al terminar de enviar el cuerpo
+            await self.app(scope, receive, send)
+        finally:
+            await self.historial.salir()
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from prometheus_client import Counter
+
+CACHE_HITS = Counter("cache_hits_total", "Lecturas servidas desde una caché en memoria", ["cache"])
+CACHE_MISSES = Counter("cache_misses_total", "Lecturas que no encontraron la entrada en caché", ["cache"])
+CACHE_DESALOJOS = Counter(
+    "cache_desalojos_total", "Entradas desalojadas por capacidad o expiración", ["cache", "motivo"]
+)
+
+
+class CacheLRU:
+    """Caché en memoria acotada, con expiración por entrada y desalojo LRU.
+
+    No hace `await` en ningún método, así que es segura dentro del event loop
+    sin necesidad de locks.
+    """
+
+    def __init__(self, nombre: str, capacidad: int, ttl: float):
+        self.nombre = nombre
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self._entradas: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def obtener(self, clave: Hashable) -> Optional[Any]:
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            CACHE_MISSES.labels(cache=self.nombre).inc()
+            return None
+
+        valor, expira = entrada
+        if expira <= time.monotonic():
+            del self._entradas[clave]
+            CACHE_DESALOJOS.labels(cache=self.nombre, motivo="expiracion").inc()
+            CACHE_MISSES.labels(cache=self.nombre).inc()
+            return None
+
+        self._entradas.move_to_end(clave)
+        CACHE_HITS.labels(cache=self.nombre).inc()
+        return valor
+
+    def guardar(self, clave: Hashable, valor: Any, ttl: Optional[float] = None) -> None:
+        expira = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entradas[clave] = (valor, expira)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.capacidad:
+            self._entradas.popitem(last=False)
+            CACHE_DESALOJOS.labels(cache=self.nombre, motivo="capacidad").inc()
+
+    def invalidar(self, clave: Hashable) -> None:
+        self._entradas.pop(clave, None)
+
+    def limpiar(self) -> None:
+        self._entradas.clear()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
@@ -0,0 +1,114 @@
+import os
+from typing import Dict, Iterable, List, Optional
+
+from bson import ObjectId
+from fastapi import Response
+from prometheus_client import Histogram
+
+from app.db.mongo import usuarios_lectura
+from app.utils.perfiles import PROYECCION_PERFIL, cache_perfiles, guardar_perfil
+
+USUARIOS_API_BASE_URL = os.getenv(
+    "USUARIOS_API_BASE_URL", "https://usuarios-api-2d5af8f6584a.herokuapp.com"
+)
+TAMANO_LOTE_CONTRAPARTES = int(os.getenv("CONTRAPARTES_TAMANO_LOTE", "500"))
+
+CONSULTAS_CONTRAPARTES = Histogram(
+    "contrapartes_consultas_por_request",
+    "Consultas a la colección de usuarios hechas para resolver contrapartes en un request",
+    ["endpoint"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+
+
+def _build_avatar_url(foto_url: Optional[str]) -> Optional[str]:
+    """Devuelve la URL completa de la foto de perfil."""
+    if not foto_url:
+        return None
+    if foto_url.startswith("http"):
+        return foto_url
+    if foto_url.startswith("/"):
+        return f"{USUARIOS_API_BASE_URL}{foto_url}"
+    return foto_url
+
+
+def _contraparte_minima(user_id: Optional[str]) -> dict:
+    # Si el usuario ya no existe, devolvemos datos mínimos
+    return {"id": user_id, "name": "Usuario", "avatar": ""}
+
+
+def _formatear_contraparte(user_id: str, usuario: dict) -> dict:
+    # Los perfiles en caché guardan None para los campos ausentes
+    nombre = f"{usuario.get('nombres') or ''} {usuario.get('apellidos') or ''}".strip()
+    return {
+        "id": user_id,
+        "name": nombre or "Usuario",
+        "avatar": _build_avatar_url(usuario.get("foto_url")) or "",
+    }
+
+
+async def iterar_por_lotes(cursor, tamano: int = TAMANO_LOTE_CONTRAPARTES):
+    """Agrupa los documentos de un cursor en listas de como máximo `tamano`."""
+    lote: List[dict] = []
+    async for documento in cursor:
+        lote.append(documento)
+        if len(lote) >= tamano:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+class ResolutorContrapartes:
+    """Resuelve contrapartes con una consulta `$in` proyectada por lote de IDs.
+
+    Primero se consulta la caché de perfiles; solo los que faltan van a Mongo.
+    Los IDs ya resueltos se recuerdan durante todo el request, así que cada
+    usuario se consulta como mucho una vez aunque aparezca en muchas filas.
+    """
+
+    def __init__(self, tamano_lote: int = TAMANO_LOTE_CONTRAPARTES):
+        self._tamano_lote = tamano_lote
+        self._contrapartes: Dict[str, dict] = {}
+        self.consultas = 0
+
+    async def cargar(self, user_ids: Iterable[Optional[str]]) -> None:
+        pendientes = [
+            user_id
+            for user_id in dict.fromkeys(user_ids)
+            if user_id and user_id not in self._contrapartes
+        ]
+
+        validos = []
+        for user_id in pendientes:
+            if not ObjectId.is_valid(user_id):
+                # IDs como "admin" nunca corresponden a un usuario
+                self._contrapartes[user_id] = _contraparte_minima(user_id)
+                continue
+            perfil = cache_perfiles.obtener(user_id)
+            if perfil is not None:
+                self._contrapartes[user_id] = _formatear_contraparte(user_id, perfil)
+            else:
+                validos.append(user_id)
+
+        for inicio in range(0, len(validos), self._tamano_lote):
+            trozo = {ObjectId(user_id): user_id for user_id in validos[inicio : inicio + self._tamano_lote]}
+            self.consultas += 1
+            cursor = usuarios_lectura.find(
+                {"_id": {"$in": list(trozo)}}, PROYECCION_PERFIL
+            )
+            async for usuario in cursor:
+                user_id = trozo[usuario["_id"]]
+                perfil = guardar_perfil(user_id, usuario)
+                self._contrapartes[user_id] = _formatear_contraparte(user_id, perfil)
+            for user_id in trozo.values():
+                self._contrapartes.setdefault(user_id, _contraparte_minima(user_id))
+
+    def obtener(self, user_id: Optional[str]) -> dict:
+        return self._contrapartes.get(user_id) or _contraparte_minima(user_id)
+
+    def reportar(self, endpoint: str, response: Optional[Response] = None) -> None:
+        """Publica cuántas consultas hizo el request (métrica y cabecera)."""
+        CONSULTAS_CONTRAPARTES.labels(endpoint=endpoint).observe(self.consultas)
+        if response is not None:
+            response.headers["X-Contrapartes-Consultas"] = str(self.consultas)
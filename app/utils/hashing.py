@@ -0,0 +1,65 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from prometheus_client import Counter, Gauge, Histogram
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+HASHING_TRABAJADORES = int(os.getenv("HASHING_TRABAJADORES", "2"))
+HASHING_COLA_MAXIMA = int(os.getenv("HASHING_COLA_MAXIMA", "32"))
+
+# bcrypt bloquea decenas de ms por llamada: se ejecuta en un pool propio y
+# acotado para no frenar el event loop ni el executor por defecto.
+_executor = ThreadPoolExecutor(max_workers=HASHING_TRABAJADORES, thread_name_prefix="bcrypt")
+_pendientes = 0
+
+HASHING_COLA = Gauge(
+    "hashing_cola_pendientes",
+    "Operaciones bcrypt encoladas o en ejecución",
+    multiprocess_mode="livesum",
+)
+HASHING_ESPERA = Histogram(
+    "hashing_espera_segundos",
+    "Tiempo que espera una operación bcrypt antes de empezar a ejecutarse",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+HASHING_RECHAZOS = Counter(
+    "hashing_rechazos_total", "Operaciones bcrypt rechazadas por cola llena"
+)
+
+
+async def _ejecutar(funcion, *args):
+    global _pendientes
+    if _pendientes >= HASHING_COLA_MAXIMA:
+        HASHING_RECHAZOS.inc()
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiadas autenticaciones en curso, intenta de nuevo",
+            headers={"Retry-After": "1"},
+        )
+
+    _pendientes += 1
+    HASHING_COLA.set(_pendientes)
+    encolado = time.perf_counter()
+
+    def trabajo():
+        HASHING_ESPERA.observe(time.perf_counter() - encolado)
+        return funcion(*args)
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, trabajo)
+    finally:
+        _pendientes -= 1
+        HASHING_COLA.set(_pendientes)
+
+
+async def verificar_contrasena(contrasena: str, hashed: str) -> bool:
+    return await _ejecutar(pwd_context.verify, contrasena, hashed)
+
+
+async def hashear_contrasena(contrasena: str) -> str:
+    return await _ejecutar(pwd_context.hash, contrasena)
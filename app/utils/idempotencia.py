@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError
+
+from app.db.mongo import idempotencia_collection
+from app.utils.cache import CacheLRU
+
+IDEMPOTENCIA_TTL_SEGUNDOS = int(os.getenv("IDEMPOTENCIA_TTL_SEGUNDOS", "86400"))
+IDEMPOTENCIA_ESPERA_MAXIMA = float(os.getenv("IDEMPOTENCIA_ESPERA_MAXIMA", "10"))
+# Tras este plazo un registro `en_proceso` se considera abandonado (p. ej. por
+# una caída) y otra solicitud con la misma clave puede tomarlo
+IDEMPOTENCIA_CONCESION_SEGUNDOS = float(os.getenv("IDEMPOTENCIA_CONCESION_SEGUNDOS", "30"))
+# Vueltas de reclamar la clave (registro borrado o concesión vencida) antes del 409
+IDEMPOTENCIA_INTENTOS = int(os.getenv("IDEMPOTENCIA_INTENTOS", "5"))
+_LONGITUD_MAXIMA_CLAVE = 255
+
+# Caché delantera de respuestas ya completadas en este proceso
+_respuestas = CacheLRU(
+    "idempotencia",
+    capacidad=int(os.getenv("CACHE_IDEMPOTENCIA_CAPACIDAD", "10000")),
+    ttl=min(IDEMPOTENCIA_TTL_SEGUNDOS, 300),
+)
+# Claves que este proceso está ejecutando ahora mismo
+_en_curso: Dict[str, asyncio.Event] = {}
+
+
+class RegistroIdempotencia:
+    """Permite guardar la respuesta en la misma transacción que el movimiento.
+
+    Así una caída entre el commit y la actualización del registro no deja la
+    clave bloqueada: o se confirmaron ambos o ninguno. Sin Idempotency-Key
+    `guardar` no hace nada.
+    """
+
+    def __init__(self, id_registro: Optional[str] = None, propietario: Optional[str] = None):
+        self.id_registro = id_registro
+        self.propietario = propietario
+        self.respuesta = None
+
+    async def guardar(self, respuesta, session=None):
+        if self.id_registro is None:
+            return
+        codificada = jsonable_encoder(respuesta)
+        # Solo el propietario de la concesión puede completar el registro
+        resultado = await idempotencia_collection.update_one(
+            {"_id": self.id_registro, "estado": "en_proceso", "propietario": self.propietario},
+            {"$set": {"estado": "completada", "respuesta": codificada}},
+            session=session,
+        )
+        if resultado.matched_count == 0:
+            raise HTTPException(
+                status_code=409,
+                detail="Otra solicitud con la misma Idempotency-Key tomó el relevo",
+            )
+        self.respuesta = codificada
+
+
+def _huella(payload) -> str:
+    # exclude_unset evita que valores por defecto como `fecha` cambien entre reintentos
+    contenido = jsonable_encoder(payload, exclude_unset=True)
+    return hashlib.sha256(json.dumps(contenido, sort_keys=True).encode()).hexdigest()
+
+
+def _comprobar_huella(registro: dict, huella: str):
+    if registro["huella"] != huella:
+        raise HTTPException(
+            status_code=422,
+            detail="La Idempotency-Key ya se usó con un payload distinto",
+        )
+
+
+def _reproducir(registro: dict, huella: str, response: Optional[Response]):
+    _comprobar_huella(registro, huella)
+    if response is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+    return registro["respuesta"]
+
+
+async def _esperar_registro(id_registro: str, huella: str) -> Optional[dict]:
+    """Espera a que otra ejecución de la misma clave termine.
+
+    Lanza 422 en cuanto ve que la clave se usó con otro payload.
+
+    Devuelve el registro completado, o None si la ejecución falló y su
+    registro fue borrado o su concesión venció (el llamador puede volver a
+    intentarlo).
+    """
+    limite = asyncio.get_running_loop().time() + IDEMPOTENCIA_ESPERA_MAXIMA
+    intervalo = 0.05
+    while True:
+        evento = _en_curso.get(id_registro)
+        if evento is not None:
+            restante = limite - asyncio.get_running_loop().time()
+            try:
+                await asyncio.wait_for(evento.wait(), timeout=max(restante, 0))
+            except asyncio.TimeoutError:
+                pass
+
+        registro = await idempotencia_collection.find_one({"_id": id_registro})
+        if registro is None:
+            return None
+        _comprobar_huella(registro, huella)
+        if registro["estado"] == "completada":
+            return registro
+        if registro.get("expira") and registro["expira"] < datetime.utcnow():
+            return None
+
+        if asyncio.get_running_loop().time() >= limite:
+            raise HTTPException(
+                status_code=409,
+                detail="Una solicitud con la misma Idempotency-Key sigue en curso",
+            )
+        await asyncio.sleep(intervalo)
+        intervalo = min(intervalo * 2, 0.5)
+
+
+async def _tomar_abandonado(id_registro: str, huella: str, propietario: str) -> bool:
+    """Toma un registro `en_proceso` cuya concesión venció; True si lo consiguió."""
+    ahora = datetime.utcnow()
+    registro = await idempotencia_collection.find_one_and_update(
+        {"_id": id_registro, "estado": "en_proceso", "huella": huella, "expira": {"$lt": ahora}},
+        {
+            "$set": {
+                "propietario": propietario,
+                "expira": ahora + timedelta(seconds=IDEMPOTENCIA_CONCESION_SEGUNDOS),
+            }
+        },
+    )
+    return registro is not None
+
+
+async def ejecutar_idempotente(
+    clave: Optional[str],
+    alcance: str,
+    payload,
+    operacion: Callable[[RegistroIdempotencia], Awaitable[Any]],
+    response: Optional[Response] = None,
+):
+    """Ejecuta `operacion` una sola vez por `Idempotency-Key` dentro de `alcance`.
+
+    Un reintento con la misma clave devuelve la respuesta guardada sin tocar
+    saldos; un duplicado concurrente espera a que termine la primera ejecución.
+    `operacion` recibe un `RegistroIdempotencia` y debe llamar a `guardar`
+    dentro de su transacción. Si la operación falla se borra el registro
+    para que el cliente pueda reintentar; si el proceso cae antes del
+    commit, otra solicitud toma el registro cuando vence su concesión. Sin
+    clave, la operación se ejecuta normalmente.
+    """
+    if not clave:
+        return await operacion(RegistroIdempotencia())
+    if len(clave) > _LONGITUD_MAXIMA_CLAVE:
+        raise HTTPException(status_code=400, detail="Idempotency-Key demasiado larga")
+
+    id_registro = f"{alcance}:{clave}"
+    huella = _huella(payload)
+    propietario = uuid.uuid4().hex
+
+    for _ in range(IDEMPOTENCIA_INTENTOS):
+        guardado = _respuestas.obtener(id_registro)
+        if guardado is not None:
+            return _reproducir(guardado, huella, response)
+
+        try:
+            await idempotencia_collection.insert_one(
+                {
+                    "_id": id_registro,
+                    "huella": huella,
+                    "estado": "en_proceso",
+                    "propietario": propietario,
+                    "creado": datetime.utcnow(),
+                    "expira": datetime.utcnow() + timedelta(seconds=IDEMPOTENCIA_CONCESION_SEGUNDOS),
+                }
+            )
+        except DuplicateKeyError:
+            if await _tomar_abandonado(id_registro, huella, propietario):
+                break
+            registro = await _esperar_registro(id_registro, huella)
+            if registro is None:
+                continue
+            _respuestas.guardar(id_registro, registro)
+            return _reproducir(registro, huella, response)
+        break
+    else:
+        raise HTTPException(
+            status_code=409,
+            detail="No se pudo reclamar la Idempotency-Key, inténtalo más tarde",
+        )
+
+    evento = _en_curso[id_registro] = asyncio.Event()
+    reserva = RegistroIdempotencia(id_registro, propietario)
+    try:
+        try:
+            respuesta = await operacion(reserva)
+        except BaseException:
+            await idempotencia_collection.delete_one(
+                {"_id": id_registro, "estado": "en_proceso", "propietario": propietario}
+            )
+            raise
+
+        if reserva.respuesta is None:
+            # La operación terminó sin pasar por una transacción
+            await reserva.guardar(respuesta)
+        respuesta = reserva.respuesta
+        _respuestas.guardar(id_registro, {"huella": huella, "respuesta": respuesta})
+        return respuesta
+    finally:
+        _en_curso.pop(id_registro, None)
+        evento.set()
@@ -3,7 +3,11 @@ from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from typing import Optional
+import hashlib
 import os
+import time
+
+from app.utils.cache import CacheLRU
 
 SECRET_KEY = os.getenv("SECRET_KEY", "secret")
 ALGORITHM = "HS256"
@@ -11,6 +15,14 @@ EXPIRATION_MINUTES = 60
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
+# Claims ya verificados, indexados por el digest del token. Cada entrada vence
+# con el `exp` del token (o antes, si el TTL máximo es menor).
+_cache_claims = CacheLRU(
+    "jwt_claims",
+    capacidad=int(os.getenv("CACHE_JWT_CAPACIDAD", "10000")),
+    ttl=float(os.getenv("CACHE_JWT_TTL_MAXIMO", str(EXPIRATION_MINUTES * 60))),
+)
+
 
 def create_jwt_token(data: dict):
     to_encode = data.copy()
@@ -19,14 +31,32 @@ def create_jwt_token(data: dict):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def decodificar_token(token: str) -> dict:
+    """Verifica el token y devuelve sus claims; lanza JWTError si no es válido.
+
+    Las llamadas repetidas con el mismo token se sirven desde caché sin
+    volver a verificar la firma.
+    """
+    clave = hashlib.sha256(token.encode()).digest()
+    payload = _cache_claims.obtener(clave)
+    if payload is not None:
+        return dict(payload)
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    exp = payload.get("exp")
+    restante = exp - time.time() if isinstance(exp, (int, float)) else _cache_claims.ttl
+    if restante > 0:
+        _cache_claims.guardar(clave, payload, ttl=min(restante, _cache_claims.ttl))
+    return dict(payload)
+
+
 async def verificar_token(request: Request) -> dict:
     auth_header: Optional[str] = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Token de autenticación faltante o inválido")
     token = auth_header.split(" ")[1]
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
+        return decodificar_token(token)
     except JWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
 
@@ -38,7 +68,7 @@ async def verificar_admin(request: Request) -> dict:
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decodificar_token(token)
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Token inválido")
@@ -0,0 +1,49 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+
+# Orden estable de los listados: más recientes primero, `_id` como desempate
+ORDEN_KEYSET = [("fecha", -1), ("_id", -1)]
+
+
+def codificar_cursor(documento: dict) -> str:
+    """Genera el token opaco que apunta justo después de `documento`."""
+    fecha = documento.get("fecha")
+    contenido = {
+        "f": fecha.isoformat() if fecha else None,
+        "i": str(documento["_id"]),
+    }
+    crudo = json.dumps(contenido, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(crudo).decode().rstrip("=")
+
+
+def decodificar_cursor(token: str) -> Tuple[Optional[datetime], ObjectId]:
+    try:
+        relleno = "=" * (-len(token) % 4)
+        contenido = json.loads(base64.urlsafe_b64decode(token + relleno))
+        fecha = datetime.fromisoformat(contenido["f"]) if contenido["f"] else None
+        return fecha, ObjectId(contenido["i"])
+    except (ValueError, TypeError, KeyError, InvalidId):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def filtro_keyset(token: str) -> dict:
+    """Condición que selecciona las filas posteriores al cursor en ORDEN_KEYSET.
+
+    Se expresa como un rango sobre `fecha` más una exclusión de empates para
+    poder mezclarla dentro de cada rama de un `$or` y que cada rama use su
+    propio índice (fecha, _id) sin ordenar en memoria. Todas las escrituras de
+    la API asignan `fecha`, así que solo un cursor sin fecha las trata aparte.
+    """
+    fecha, ultimo_id = decodificar_cursor(token)
+    if fecha is None:
+        return {"fecha": None, "_id": {"$lt": ultimo_id}}
+    return {
+        "fecha": {"$lte": fecha},
+        "$nor": [{"fecha": fecha, "_id": {"$gte": ultimo_id}}],
+    }
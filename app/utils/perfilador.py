@@ -0,0 +1,415 @@
+"""Perfilador por muestreo dentro del proceso de la API (opcional).
+
+Un hilo toma cada `PERFILADOR_INTERVALO_MS` la pila de los hilos que han
+consumido CPU desde la muestra anterior, según el reloj de CPU de cada
+hilo: un event loop esperando en `select` o un hilo de Motor bloqueado en
+un socket no cuentan. Las muestras del event loop se atribuyen a la ruta de
+la tarea que se está ejecutando; `RegistroRutas` apunta cada tarea que
+atiende una request, también la que envía un cuerpo en streaming.
+
+Las muestras se sirven de tres formas:
+
+- `/debug/pprof/profile?seconds=N` devuelve un perfil pprof de N segundos;
+- con `PERFILADOR_PYROSCOPE_URL` se envían a Pyroscope en formato folded
+  cada `PERFILADOR_PUSH_SEGUNDOS`, una serie por ruta;
+- con `PERFILADOR_UMBRAL_LENTO_MS`, al cruzar el umbral se captura en qué
+  `await` está cada tarea de la request y, al terminar, se guardan sus
+  pilas en CPU más frecuentes (`/debug/pprof/lentas`).
+
+Se activa con `PERFILADOR_ACTIVO=1`; sin eso no hay hilo ni rutas de depuración.
+"""
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from prometheus_client import Counter, Histogram
+
+from app.utils.pprof import Marco, codificar
+
+PERFILADOR_ACTIVO = os.getenv("PERFILADOR_ACTIVO", "0") == "1"
+PERFILADOR_INTERVALO_MS = float(os.getenv("PERFILADOR_INTERVALO_MS", "10"))
+PERFILADOR_PROFUNDIDAD = int(os.getenv("PERFILADOR_PROFUNDIDAD", "128"))
+PERFILADOR_SEGUNDOS_MAXIMO = int(os.getenv("PERFILADOR_SEGUNDOS_MAXIMO", "60"))
+PERFILADOR_PYROSCOPE_URL = os.getenv("PERFILADOR_PYROSCOPE_URL", "")
+PERFILADOR_PUSH_SEGUNDOS = float(os.getenv("PERFILADOR_PUSH_SEGUNDOS", "10"))
+PERFILADOR_APLICACION = os.getenv("PERFILADOR_APLICACION", "transacciones-api")
+# 0 desactiva la captura de requests lentas
+PERFILADOR_UMBRAL_LENTO_MS = float(os.getenv("PERFILADOR_UMBRAL_LENTO_MS", "0"))
+PERFILADOR_LENTAS_GUARDADAS = int(os.getenv("PERFILADOR_LENTAS_GUARDADAS", "50"))
+
+SIN_RUTA = "sin_ruta"
+
+PERFILADOR_MUESTRAS = Counter(
+    "perfilador_muestras_total",
+    "Pilas muestreadas por el perfilador",
+)
+PERFILADOR_TICK = Histogram(
+    "perfilador_tick_segundos",
+    "Coste de cada pasada del perfilador sobre los hilos del proceso",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+PERFILADOR_LENTAS = Counter(
+    "perfilador_requests_lentas_total",
+    "Requests que superaron PERFILADOR_UMBRAL_LENTO_MS",
+    ["metodo", "ruta"],
+)
+PERFILADOR_PUSH_ERRORES = Counter(
+    "perfilador_push_errores_total",
+    "Envíos a Pyroscope que fallaron (la ventana se descarta)",
+)
+
+Etiquetas = Tuple[Tuple[str, str], ...]
+
+
+def _pila(marco, profundidad: int) -> Tuple[Marco, ...]:
+    """Pila desde `marco` hacia fuera, con la hoja primero."""
+    pila = []
+    while marco is not None and len(pila) < profundidad:
+        codigo = marco.f_code
+        pila.append((codigo.co_filename, codigo.co_qualname, codigo.co_firstlineno, marco.f_lineno or 0))
+        marco = marco.f_back
+    return tuple(pila)
+
+
+def _pila_espera(tarea: asyncio.Task, profundidad: int) -> List[str]:
+    """Cadena de `await` de una tarea suspendida, de fuera hacia dentro.
+
+    `Task.get_stack()` solo devuelve un marco para una corrutina suspendida;
+    aquí se sigue `cr_await` / `ag_await` hasta el futuro que la bloquea.
+    """
+    lineas = []
+    corrutina = tarea.get_coro()
+    while corrutina is not None and len(lineas) < profundidad:
+        marco = (
+            getattr(corrutina, "cr_frame", None)
+            or getattr(corrutina, "ag_frame", None)
+            or getattr(corrutina, "gi_frame", None)
+        )
+        if marco is None:
+            break
+        lineas.append(f"{marco.f_code.co_qualname} ({marco.f_code.co_filename}:{marco.f_lineno})")
+        corrutina = (
+            getattr(corrutina, "cr_await", None)
+            or getattr(corrutina, "ag_await", None)
+            or getattr(corrutina, "gi_yieldfrom", None)
+        )
+    return lineas
+
+
+def _nombre_hilo(nombre: str) -> str:
+    # "ThreadPoolExecutor-0_3" -> "ThreadPoolExecutor-0": una serie por pool, no por hilo
+    return re.sub(r"_\d+$", "", nombre) or "desconocido"
+
+
+class Ventana:
+    """Muestras acumuladas mientras está suscrita: (etiquetas, pila) -> [muestras, cpu_ns]."""
+
+    def __init__(self):
+        self.inicio_ns = time.time_ns()
+        self.muestras: Dict[Tuple[Etiquetas, Tuple[Marco, ...]], List[int]] = {}
+
+    def sumar(self, clave, cpu_ns: int):
+        valores = self.muestras.get(clave)
+        if valores is None:
+            self.muestras[clave] = [1, cpu_ns]
+        else:
+            valores[0] += 1
+            valores[1] += cpu_ns
+
+    def pprof(self, intervalo_ns: int) -> bytes:
+        return codificar(
+            self.muestras,
+            tipos=[("samples", "count"), ("cpu", "nanoseconds")],
+            periodo=("cpu", "nanoseconds", intervalo_ns),
+            inicio_ns=self.inicio_ns,
+            duracion_ns=time.time_ns() - self.inicio_ns,
+        )
+
+
+class _Request:
+    __slots__ = ("scope", "inicio", "tareas", "pilas", "espera")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.inicio = time.perf_counter()
+        self.tareas = weakref.WeakSet()
+        self.pilas: Dict[Tuple[Marco, ...], List[int]] = {}
+        self.espera: List[List[str]] = []
+
+    def metodo(self) -> str:
+        return self.scope.get("method", "")
+
+    def ruta(self) -> str:
+        # FastAPI deja la ruta en el scope al resolverla
+        ruta = self.scope.get("route")
+        return getattr(ruta, "path", SIN_RUTA)
+
+
+class Perfilador:
+    def __init__(self, intervalo_ms: float, profundidad: int, umbral_lento_ms: float):
+        self.intervalo_ns = int(intervalo_ms * 1e6)
+        self.profundidad = profundidad
+        self.umbral_lento = umbral_lento_ms / 1000
+        self.lentas = deque(maxlen=PERFILADOR_LENTAS_GUARDADAS)
+        self._ventanas: List[Ventana] = []
+        # Protege ventanas y pilas por request frente al hilo de muestreo
+        self._bloqueo = threading.Lock()
+        self._parar = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ident_loop: Optional[int] = None
+        self._requests: "weakref.WeakKeyDictionary[asyncio.Task, _Request]" = weakref.WeakKeyDictionary()
+        self._relojes: Dict[int, Tuple[int, int]] = {}
+        self._envio: Optional[asyncio.Task] = None
+
+    # --- ciclo de vida (desde el event loop) ---
+
+    def iniciar(self):
+        self._loop = asyncio.get_running_loop()
+        self._ident_loop = threading.get_ident()
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._muestrear, name="perfilador", daemon=True)
+        self._hilo.start()
+        if PERFILADOR_PYROSCOPE_URL:
+            self._envio = asyncio.create_task(self._empujar(PERFILADOR_PYROSCOPE_URL))
+
+    async def detener(self):
+        if self._envio:
+            self._envio.cancel()
+        self._parar.set()
+        if self._hilo:
+            await asyncio.to_thread(self._hilo.join)
+
+    def suscribir(self) -> Ventana:
+        ventana = Ventana()
+        with self._bloqueo:
+            self._ventanas.append(ventana)
+        return ventana
+
+    def desuscribir(self, ventana: Ventana):
+        # Al volver, el hilo de muestreo ya no escribe en la ventana
+        with self._bloqueo:
+            self._ventanas.remove(ventana)
+
+    def registrar(self, tarea: asyncio.Task, request: _Request):
+        request.tareas.add(tarea)
+        self._requests[tarea] = request
+
+    # --- hilo de muestreo ---
+
+    def _cpu(self, ident: int) -> Optional[int]:
+        """CPU consumida por el hilo desde la muestra anterior; None sin reloj por hilo."""
+        try:
+            reloj, anterior = self._relojes.get(ident) or (time.pthread_getcpuclockid(ident), None)
+            actual = time.clock_gettime_ns(reloj)
+        except (AttributeError, OSError):
+            return None
+        self._relojes[ident] = (reloj, actual)
+        if anterior is None or actual < anterior:
+            return 0
+        return actual - anterior
+
+    def _muestrear(self):
+        intervalo = self.intervalo_ns / 1e9
+        propio = threading.get_ident()
+        while not self._parar.wait(intervalo):
+            if not self._ventanas and not self.umbral_lento:
+                # La primera muestra tras la pausa vuelve a tomar la referencia de CPU
+                self._relojes.clear()
+                continue
+            inicio = time.perf_counter()
+            marcos = sys._current_frames()
+            # Lectura entre hilos del dict interno de asyncio: un `get` es atómico con el GIL
+            tarea = asyncio.tasks._current_tasks.get(self._loop)
+            request = self._requests.get(tarea) if tarea is not None else None
+            nombres = {hilo.ident: hilo.name for hilo in threading.enumerate()}
+
+            muestras = []
+            for ident, marco in marcos.items():
+                if ident == propio:
+                    continue
+                cpu = self._cpu(ident)
+                if cpu is None:
+                    # Sin reloj de CPU por hilo solo cuenta el loop mientras ejecuta una tarea
+                    if ident != self._ident_loop or tarea is None:
+                        continue
+                    cpu = self.intervalo_ns
+                if not cpu:
+                    continue
+                if ident == self._ident_loop:
+                    metodo, ruta = (request.metodo(), request.ruta()) if request else ("", SIN_RUTA)
+                    etiquetas = (("hilo", "loop"), ("metodo", metodo), ("ruta", ruta))
+                    de_request = request
+                else:
+                    hilo = _nombre_hilo(nombres.get(ident, ""))
+                    etiquetas = (("hilo", hilo), ("metodo", ""), ("ruta", SIN_RUTA))
+                    de_request = None
+                muestras.append((etiquetas, _pila(marco, self.profundidad), cpu, de_request))
+            for ident in set(self._relojes) - set(marcos):
+                del self._relojes[ident]
+            del marcos
+
+            with self._bloqueo:
+                for etiquetas, pila, cpu, de_request in muestras:
+                    for ventana in self._ventanas:
+                        ventana.sumar((etiquetas, pila), cpu)
+                    if de_request is not None and self.umbral_lento:
+                        valores = de_request.pilas.setdefault(pila, [0, 0])
+                        valores[0] += 1
+                        valores[1] += cpu
+            PERFILADOR_MUESTRAS.inc(len(muestras))
+            PERFILADOR_TICK.observe(time.perf_counter() - inicio)
+
+    # --- requests lentas (desde el event loop) ---
+
+    def capturar_espera(self, request: _Request):
+        """Al cruzar el umbral: en qué `await` está cada tarea de la request."""
+        request.espera = [
+            _pila_espera(tarea, self.profundidad) for tarea in list(request.tareas) if not tarea.done()
+        ]
+
+    def informar_lenta(self, request: _Request, duracion: float):
+        with self._bloqueo:
+            pilas = sorted(request.pilas.items(), key=lambda par: par[1][1], reverse=True)[:5]
+        metodo, ruta = request.metodo(), request.ruta()
+        PERFILADOR_LENTAS.labels(metodo, ruta).inc()
+        self.lentas.append(
+            {
+                "metodo": metodo,
+                "ruta": ruta,
+                "path": request.scope.get("path"),
+                "duracion_ms": round(duracion * 1000, 1),
+                "fecha": datetime.utcnow(),
+                "esperando_en": request.espera,
+                "cpu": [
+                    {
+                        "muestras": muestras,
+                        "cpu_ms": round(cpu / 1e6, 3),
+                        "pila": [f"{nombre} ({archivo}:{linea})" for archivo, nombre, _, linea in pila],
+                    }
+                    for pila, (muestras, cpu) in pilas
+                ],
+            }
+        )
+        mensaje = f"🔴 Request lenta {metodo} {ruta}: {duracion * 1000:.0f} ms"
+        donde = " | ".join(pila[-1] for pila in request.espera if pila)
+        print(f"{mensaje}, esperando en {donde}" if donde else mensaje)
+
+    # --- envío a Pyroscope ---
+
+    def _folded(self, ventana: Ventana) -> Dict[Tuple[str, str], bytes]:
+        """Una serie por (método, ruta), con el hilo como marco raíz."""
+        series: Dict[Tuple[str, str], Dict[str, int]] = {}
+        for (etiquetas, pila), (_, cpu) in ventana.muestras.items():
+            valores = dict(etiquetas)
+            linea = ";".join(
+                [f"hilo:{valores['hilo']}"]
+                + [f"{nombre} ({archivo}:{numero})" for archivo, nombre, _, numero in reversed(pila)]
+            )
+            serie = series.setdefault((valores["metodo"], valores["ruta"]), {})
+            serie[linea] = serie.get(linea, 0) + cpu
+        cuerpos = {}
+        for clave, lineas in series.items():
+            # Pyroscope cuenta muestras: la CPU se pasa a periodos del intervalo
+            texto = "".join(
+                f"{linea} {round(cpu / self.intervalo_ns)}\n"
+                for linea, cpu in lineas.items()
+                if round(cpu / self.intervalo_ns)
+            )
+            if texto:
+                cuerpos[clave] = texto.encode()
+        return cuerpos
+
+    async def _empujar(self, url: str):
+        ventana = self.suscribir()
+        try:
+            async with httpx.AsyncClient(base_url=url, timeout=5) as cliente:
+                while True:
+                    await asyncio.sleep(PERFILADOR_PUSH_SEGUNDOS)
+                    anterior, ventana = ventana, self.suscribir()
+                    self.desuscribir(anterior)
+                    try:
+                        await self._enviar(cliente, anterior)
+                    except httpx.HTTPError as exc:
+                        PERFILADOR_PUSH_ERRORES.inc()
+                        print(f"🔴 No se pudo enviar el perfil a Pyroscope: {exc}")
+        finally:
+            self.desuscribir(ventana)
+
+    async def _enviar(self, cliente: httpx.AsyncClient, ventana: Ventana):
+        desde = ventana.inicio_ns // 1_000_000_000
+        hasta = int(time.time())
+        for (metodo, ruta), cuerpo in self._folded(ventana).items():
+            etiquetas = f"ruta={_valor_etiqueta(ruta)}"
+            if metodo:
+                etiquetas += f",metodo={metodo}"
+            respuesta = await cliente.post(
+                "/ingest",
+                params={
+                    "name": f"{PERFILADOR_APLICACION}.cpu{{{etiquetas}}}",
+                    "from": desde,
+                    "until": hasta,
+                    "format": "folded",
+                    "sampleRate": round(1e9 / self.intervalo_ns),
+                    "spyName": "pyspy",
+                    "units": "samples",
+                    "aggregationType": "sum",
+                },
+                content=cuerpo,
+            )
+            respuesta.raise_for_status()
+
+
+def _valor_etiqueta(ruta: str) -> str:
+    # Las llaves y comas rompen el nombre de la serie: {user_id} -> :user_id
+    return re.sub(r"[^\w./:-]", "_", re.sub(r"\{(\w+)\}", r":\1", ruta))
+
+
+perfilador = Perfilador(PERFILADOR_INTERVALO_MS, PERFILADOR_PROFUNDIDAD, PERFILADOR_UMBRAL_LENTO_MS)
+
+
+class RegistroRutas:
+    """Middleware ASGI que asocia a su request cada tarea que la atiende.
+
+    La tarea de la request se registra al entrar; las que crea Starlette
+    para enviar un cuerpo en streaming se registran en su primer `send`.
+    También arma la captura de requests lentas.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request = _Request(scope)
+        perfilador.registrar(asyncio.current_task(), request)
+        captura = None
+        if perfilador.umbral_lento:
+            captura = asyncio.get_running_loop().call_later(
+                perfilador.umbral_lento, perfilador.capturar_espera, request
+            )
+
+        async def enviar(mensaje):
+            tarea = asyncio.current_task()
+            if tarea not in request.tareas:
+                perfilador.registrar(tarea, request)
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            if captura is not None:
+                captura.cancel()
+                duracion = time.perf_counter() - request.inicio
+                if duracion >= perfilador.umbral_lento:
+                    perfilador.informar_lenta(request, duracion)
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+from typing import Dict, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+from app.db.mongo import usuarios_collection
+from app.utils.cache import CacheLRU
+
+# Datos de perfil que pueden servirse desde caché. `saldo_creditos` queda
+# fuera a propósito: los saldos siempre se leen de Mongo.
+CAMPOS_PERFIL = ("nombres", "apellidos", "foto_url", "rol")
+PROYECCION_PERFIL = {campo: 1 for campo in CAMPOS_PERFIL}
+
+cache_perfiles = CacheLRU(
+    "perfiles_usuario",
+    capacidad=int(os.getenv("CACHE_PERFILES_CAPACIDAD", "10000")),
+    ttl=float(os.getenv("CACHE_PERFILES_TTL", "60")),
+)
+
+# Lecturas en curso por usuario, para que fallos concurrentes compartan una sola consulta
+_en_vuelo: Dict[str, "asyncio.Task"] = {}
+
+
+def generacion_perfiles() -> Optional[int]:
+    """Ventana de `CACHE_PERFILES_TTL` segundos alineada al reloj, igual en todos los procesos.
+
+    Los ETag que incluyen nombres o avatares de contrapartes la añaden: no
+    hay versión de perfil que consultar, y un perfil en caché ya puede
+    tener esa antigüedad. El precio es que esos ETag cambian en cada
+    ventana aunque no cambie nada. Con la caché desactivada (TTL <= 0)
+    devuelve None y el ETag depende solo del ledger.
+    """
+    if cache_perfiles.ttl <= 0:
+        return None
+    return int(time.time() // cache_perfiles.ttl)
+
+
+def extraer_perfil(usuario: dict) -> dict:
+    return {campo: usuario.get(campo) for campo in CAMPOS_PERFIL}
+
+
+def guardar_perfil(user_id: str, usuario: dict) -> dict:
+    """Escribe en caché el perfil de un documento de usuario recién leído."""
+    perfil = extraer_perfil(usuario)
+    cache_perfiles.guardar(user_id, perfil)
+    return perfil
+
+
+def invalidar_perfil(user_id: str) -> None:
+    cache_perfiles.invalidar(user_id)
+
+
+async def _cargar_perfil(user_id: str) -> Optional[dict]:
+    usuario = await usuarios_collection.find_one({"_id": ObjectId(user_id)}, PROYECCION_PERFIL)
+    if not usuario:
+        return None
+    return guardar_perfil(user_id, usuario)
+
+
+async def obtener_perfil(user_id: str) -> dict:
+    """Devuelve el perfil del usuario, desde caché si es posible.
+
+    Lanza los mismos 400/404 que la lectura directa del documento.
+    """
+    if not ObjectId.is_valid(user_id):
+        raise HTTPException(status_code=400, detail="ID de usuario inválido")
+
+    perfil = cache_perfiles.obtener(user_id)
+    if perfil is None:
+        tarea = _en_vuelo.get(user_id)
+        if tarea is None:
+            tarea = asyncio.ensure_future(_cargar_perfil(user_id))
+            _en_vuelo[user_id] = tarea
+            tarea.add_done_callback(lambda _: _en_vuelo.pop(user_id, None))
+        perfil = await asyncio.shield(tarea)
+
+    if perfil is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return perfil
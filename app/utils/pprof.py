@@ -0,0 +1,94 @@
+"""Codificación mínima del formato pprof (`profile.proto`) sin dependencias.
+
+Solo se escriben los campos que leen `go tool pprof` y Pyroscope: tipos de
+muestra, muestras con etiquetas, ubicaciones de una línea, funciones y la
+tabla de cadenas. El resultado va comprimido con gzip, como lo espera
+`/debug/pprof/profile`.
+"""
+import gzip
+from typing import Dict, Iterable, List, Tuple
+
+# Marco de pila: (archivo, función, primera línea, línea actual)
+Marco = Tuple[str, str, int, int]
+
+
+def _varint(valor: int) -> bytes:
+    valor &= (1 << 64) - 1
+    salida = bytearray()
+    while valor >= 0x80:
+        salida.append((valor & 0x7F) | 0x80)
+        valor >>= 7
+    salida.append(valor)
+    return bytes(salida)
+
+
+def _entero(campo: int, valor: int) -> bytes:
+    return _varint(campo << 3) + _varint(valor)
+
+
+def _bytes(campo: int, datos: bytes) -> bytes:
+    return _varint((campo << 3) | 2) + _varint(len(datos)) + datos
+
+
+def _empaquetados(campo: int, valores: Iterable[int]) -> bytes:
+    return _bytes(campo, b"".join(_varint(v) for v in valores))
+
+
+class _Cadenas:
+    def __init__(self):
+        self.indices: Dict[str, int] = {"": 0}
+
+    def __call__(self, texto: str) -> int:
+        if texto not in self.indices:
+            self.indices[texto] = len(self.indices)
+        return self.indices[texto]
+
+
+def codificar(
+    muestras: Dict[Tuple[Tuple[Tuple[str, str], ...], Tuple[Marco, ...]], List[int]],
+    tipos: List[Tuple[str, str]],
+    periodo: Tuple[str, str, int],
+    inicio_ns: int,
+    duracion_ns: int,
+) -> bytes:
+    """Perfil pprof comprimido.
+
+    `muestras` asocia (etiquetas, pila con la hoja primero) a un valor por
+    cada entrada de `tipos`; `periodo` es (tipo, unidad, valor).
+    """
+    cadena = _Cadenas()
+    funciones: Dict[Tuple[str, str, int], int] = {}
+    ubicaciones: Dict[Tuple[int, int], int] = {}
+    perfil = bytearray()
+
+    for tipo, unidad in tipos:
+        perfil += _bytes(1, _entero(1, cadena(tipo)) + _entero(2, cadena(unidad)))
+
+    for (etiquetas, pila), valores in muestras.items():
+        ids = []
+        for archivo, nombre, primera, linea in pila:
+            funcion = funciones.setdefault((archivo, nombre, primera), len(funciones) + 1)
+            ids.append(ubicaciones.setdefault((funcion, linea), len(ubicaciones) + 1))
+        muestra = _empaquetados(1, ids) + _empaquetados(2, valores)
+        for clave, valor in etiquetas:
+            muestra += _bytes(3, _entero(1, cadena(clave)) + _entero(2, cadena(valor)))
+        perfil += _bytes(2, muestra)
+
+    for (funcion, linea), id_ubicacion in ubicaciones.items():
+        perfil += _bytes(4, _entero(1, id_ubicacion) + _bytes(4, _entero(1, funcion) + _entero(2, linea)))
+    for (archivo, nombre, primera), id_funcion in funciones.items():
+        perfil += _bytes(
+            5,
+            _entero(1, id_funcion)
+            + _entero(2, cadena(nombre))
+            + _entero(3, cadena(nombre))
+            + _entero(4, cadena(archivo))
+            + _entero(5, primera),
+        )
+
+    tipo, unidad, valor = periodo
+    perfil += _bytes(11, _entero(1, cadena(tipo)) + _entero(2, cadena(unidad))) + _entero(12, valor)
+    perfil += _entero(9, inicio_ns) + _entero(10, duracion_ns)
+    # La tabla de cadenas va al final, cuando ya se han registrado todas
+    perfil += b"".join(_bytes(6, texto.encode()) for texto in cadena.indices)
+    return gzip.compress(bytes(perfil))
@@ -0,0 +1,59 @@
+from typing import Any, Optional
+
+import orjson
+from bson import ObjectId
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+
+def _por_defecto(valor: Any):
+    if isinstance(valor, ObjectId):
+        return str(valor)
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def a_json(contenido: Any) -> bytes:
+    """Serializa a JSON con orjson.
+
+    Los `datetime` sin zona salen igual que `isoformat()` y los `ObjectId`
+    como su hex, así que la salida es la misma que producía el
+    `jsonable_encoder` de FastAPI (salvo la notación de floats fuera del
+    rango 1e-4..1e16, que orjson escribe sin el signo/cero del exponente).
+    """
+    return orjson.dumps(contenido, default=_por_defecto)
+
+
+class RespuestaORJSON(JSONResponse):
+    """Respuesta JSON que se salta `jsonable_encoder` y serializa con orjson.
+
+    Los endpoints de listados la devuelven directamente con filas ya
+    formadas a partir de los documentos de Mongo.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return a_json(content)
+
+
+def etag_version(version: int, variante: str = "", generacion: Optional[int] = None) -> str:
+    """ETag débil a partir de la versión del ledger del usuario.
+
+    `generacion` distingue respuestas que dependen de datos sin versión
+    propia, como los perfiles de las contrapartes.
+    """
+    if generacion is not None:
+        version = f"{version}.{generacion}"
+    return f'W/"{version}-{variante}"' if variante else f'W/"{version}"'
+
+
+def no_modificado(request: Request, etag: str, vary: Optional[str] = None) -> Optional[Response]:
+    """304 si `If-None-Match` incluye `etag` (comparación débil), o None."""
+    cabecera = request.headers.get("if-none-match")
+    if not cabecera:
+        return None
+    etiquetas = {etiqueta.strip().removeprefix("W/") for etiqueta in cabecera.split(",")}
+    if "*" not in etiquetas and etag.removeprefix("W/") not in etiquetas:
+        return None
+    cabeceras = {"ETag": etag}
+    if vary:
+        cabeceras["Vary"] = vary
+    return Response(status_code=304, headers=cabeceras)
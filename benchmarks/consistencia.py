@@ -0,0 +1,93 @@
+"""Comprueba leer-tus-escrituras con lecturas en secundarios.
+
+Pensado para el replica set de `benchmarks/docker-compose.yml` con datos de
+`benchmarks.sembrar`. Cada iteración transfiere un crédito y lee enseguida
+el saldo del receptor y el historial del emisor, con y sin el token de
+`X-Consistencia-Causal`. Con token no debe haber lecturas atrasadas; sin
+token el historial (servido por secundarios) puede ir por detrás.
+
+    LECTURA_PREFERENCIA=secondary python -m benchmarks.consistencia --iteraciones 200
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+
+import httpx
+
+from app.db.consistencia import CABECERA_CONSISTENCIA
+
+
+async def comprobar(cliente: httpx.AsyncClient, usuarios: list, iteraciones: int, rnd: random.Random) -> dict:
+    from app.utils.jwt_handler import create_jwt_token
+
+    atrasadas = {"saldo_con_token": 0, "historial_con_token": 0, "historial_sin_token": 0}
+    for _ in range(iteraciones):
+        emisor, receptor = rnd.sample(usuarios, 2)
+        cabeceras = {"Authorization": f"Bearer {create_jwt_token({'sub': emisor})}"}
+        saldo_previo = (await cliente.get(f"/api/saldo/{receptor}")).json()["saldo"]
+
+        respuesta = await cliente.post(
+            "/api/transacciones/transferir",
+            json={
+                "id_emisor": emisor,
+                "id_receptor": receptor,
+                "monto": 1,
+                "tipo": "transferencia",
+                "justificacion": "Prueba de consistencia",
+            },
+            headers=cabeceras,
+        )
+        respuesta.raise_for_status()
+        transaccion_id = respuesta.json()["_id"]
+        token = {CABECERA_CONSISTENCIA: respuesta.headers[CABECERA_CONSISTENCIA]}
+
+        saldo = (await cliente.get(f"/api/saldo/{receptor}", headers=token)).json()["saldo"]
+        if saldo < saldo_previo + 1:
+            atrasadas["saldo_con_token"] += 1
+
+        for clave, extra in (("historial_con_token", token), ("historial_sin_token", {})):
+            pagina = await cliente.get(
+                f"/api/transacciones/historial/{emisor}", params={"limit": 5}, headers=extra
+            )
+            if all(fila["id"] != transaccion_id for fila in pagina.json()):
+                atrasadas[clave] += 1
+    return atrasadas
+
+
+async def ejecutar(args) -> dict:
+    with open(args.manifiesto) as fichero:
+        usuarios = json.load(fichero)["usuarios"][: args.usuarios]
+
+    async with contextlib.AsyncExitStack() as pila:
+        if args.url:
+            cliente = httpx.AsyncClient(base_url=args.url, timeout=30)
+        else:
+            from app.main import app
+
+            await pila.enter_async_context(app.router.lifespan_context(app))
+            cliente = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://consistencia")
+        await pila.enter_async_context(cliente)
+        return await comprobar(cliente, usuarios, args.iteraciones, random.Random(args.semilla))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifiesto", default=os.path.join("benchmarks", "manifiesto.json"))
+    parser.add_argument("--url", help="Servidor a comprobar; si se omite se usa app.main:app en proceso")
+    parser.add_argument("--iteraciones", type=int, default=100)
+    parser.add_argument("--usuarios", type=int, default=50, help="Cuentas del manifiesto que se usan")
+    parser.add_argument("--semilla", type=int, default=42)
+    args = parser.parse_args()
+
+    atrasadas = asyncio.run(ejecutar(args))
+    for clave, total in atrasadas.items():
+        print(f"{clave:<22} {total}/{args.iteraciones} lecturas atrasadas")
+    if atrasadas["saldo_con_token"] or atrasadas["historial_con_token"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Comprueba que /metrics agrega las métricas de todos los workers.
+
+Arranca gunicorn con `gunicorn.conf.py`, `--workers` workers y un
+directorio de métricas temporal, lanza `--peticiones` requests a `/` y
+raspa `/metrics` varias veces: cada raspado, lo sirva el worker que lo
+sirva, debe contar exactamente esas requests. No necesita Mongo.
+
+    python -m benchmarks.metricas_multiproceso --workers 4 --peticiones 200
+"""
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+_PETICIONES_RAIZ = re.compile(r'^http_requests_total\{(?=[^}]*handler="/")(?=[^}]*method="GET")[^}]*\} (\S+)$', re.M)
+
+
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _esperar(url: str, plazo: float):
+    limite = time.monotonic() + plazo
+    while time.monotonic() < limite:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise SystemExit(f"gunicorn no respondió en {plazo} s")
+
+
+def comprobar(args) -> int:
+    puerto = _puerto_libre()
+    url = f"http://127.0.0.1:{puerto}"
+    with tempfile.TemporaryDirectory() as directorio:
+        entorno = {
+            **os.environ,
+            "PORT": str(puerto),
+            "WEB_CONCURRENCY": str(args.workers),
+            "PROMETHEUS_MULTIPROC_DIR": directorio,
+            # Sin Mongo disponible cada worker arranca igual tras este plazo
+            "MONGO_SERVER_SELECTION_TIMEOUT_MS": "500",
+        }
+        proceso = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "app.main:app", "-c", "gunicorn.conf.py"],
+            env=entorno,
+        )
+        try:
+            _esperar(f"{url}/ready", args.plazo)
+            # Espera a que todos los workers hayan abierto sus ficheros de métricas
+            time.sleep(args.plazo_workers)
+            with httpx.Client(base_url=url, timeout=10) as cliente:
+                # Conexiones nuevas por request para repartir entre workers
+                for _ in range(args.peticiones):
+                    cliente.get("/", headers={"Connection": "close"}).raise_for_status()
+                fallos = 0
+                for _ in range(args.raspados):
+                    texto = cliente.get("/metrics", headers={"Connection": "close"}).text
+                    total = sum(float(valor) for valor in _PETICIONES_RAIZ.findall(texto))
+                    print(f"http_requests_total GET / = {total:.0f} (esperado {args.peticiones})")
+                    fallos += total != args.peticiones
+            ficheros = [f for f in os.listdir(directorio) if f.startswith("counter_")]
+            print(f"{len(ficheros)} procesos con contadores en {directorio}")
+            return fallos
+        finally:
+            proceso.terminate()
+            proceso.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--peticiones", type=int, default=200)
+    parser.add_argument("--raspados", type=int, default=10)
+    parser.add_argument("--plazo", type=float, default=30, help="Segundos para que arranque gunicorn")
+    parser.add_argument("--plazo-workers", type=float, default=2, help="Espera extra tras el primer worker")
+    args = parser.parse_args()
+    if comprobar(args):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
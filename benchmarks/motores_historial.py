@@ -0,0 +1,75 @@
+"""Compara los dos motores del historial sobre las cuentas con más movimientos.
+
+Usa las cuentas más calientes del manifiesto de `benchmarks.sembrar` (las
+primeras en la distribución Zipf) y mide, para cada motor, el historial
+completo y una página de `--limite` filas. Antes de medir comprueba que
+ambos motores devuelven exactamente las mismas filas.
+
+    python -m benchmarks.motores_historial --cuentas 5 --repeticiones 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from benchmarks.reproducir import percentil
+
+
+async def _recoger(motor, user_id: str, limit):
+    from app.utils.contrapartes import ResolutorContrapartes
+
+    filtro = {"$or": [{"id_emisor": user_id}, {"id_receptor": user_id}]}
+    filas = motor(user_id, filtro, limit, ResolutorContrapartes())
+    return [fila async for fila, _ in filas]
+
+
+async def ejecutar(args) -> dict:
+    from app.routers.transacciones import MOTORES_HISTORIAL
+
+    with open(args.manifiesto) as fichero:
+        cuentas = json.load(fichero)["usuarios"][: args.cuentas]
+
+    for user_id in cuentas:
+        python = await _recoger(MOTORES_HISTORIAL["python"], user_id, None)
+        agregacion = await _recoger(MOTORES_HISTORIAL["agregacion"], user_id, None)
+        if python != agregacion:
+            raise SystemExit(f"Los motores difieren para {user_id}")
+
+    resultados = {}
+    for nombre, motor in MOTORES_HISTORIAL.items():
+        for caso, limit in (("completo", None), ("pagina", args.limite)):
+            tiempos = []
+            filas = 0
+            for _ in range(args.repeticiones):
+                for user_id in cuentas:
+                    inicio = time.perf_counter()
+                    filas += len(await _recoger(motor, user_id, limit))
+                    tiempos.append(time.perf_counter() - inicio)
+            tiempos.sort()
+            resultados[f"{nombre}/{caso}"] = {
+                "filas_media": round(filas / len(tiempos)),
+                "p50_ms": round(percentil(tiempos, 50) * 1000, 3),
+                "p95_ms": round(percentil(tiempos, 95) * 1000, 3),
+                "max_ms": round(tiempos[-1] * 1000, 3),
+            }
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifiesto", default=os.path.join("benchmarks", "manifiesto.json"))
+    parser.add_argument("--cuentas", type=int, default=5, help="Cuentas más activas a medir")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    parser.add_argument("--limite", type=int, default=50, help="Tamaño de página")
+    args = parser.parse_args()
+
+    for clave, medida in asyncio.run(ejecutar(args)).items():
+        print(
+            f"{clave:<22} filas {medida['filas_media']:>8}  p50 {medida['p50_ms']:>9.2f} ms  "
+            f"p95 {medida['p95_ms']:>9.2f} ms  max {medida['max_ms']:>9.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Reproduce una mezcla de peticiones contra la API y mide latencias por ruta.
+
+Lee la mezcla de `benchmarks/carga.jsonl` (una ruta por línea con su peso)
+y el manifiesto generado por `benchmarks.sembrar`. Por defecto ejecuta
+`app.main:app` en el mismo proceso; con `--url` ataca un servidor ya
+levantado.
+
+    python -m benchmarks.reproducir --duracion 60 --concurrencia 64
+
+El resultado (throughput y p50/p95/p99 por ruta) se guarda como JSON en
+`benchmarks/resultados/<commit>.json` para comparar entre commits.
+
+Toda la carga sale de un solo cliente, así que el control de admisión la
+trataría como un único usuario o IP: en proceso se ejecuta con
+`ADMISION_LIMITES={"*": [0, 0]}` salvo que se pase `--con-limites`, y con
+`--url` el servidor debe arrancarse con ese mismo valor. Las respuestas
+429 y el resto de 4xx se cuentan aparte y no entran en los percentiles,
+para que un rechazo rápido no pase por una petición servida.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+from benchmarks.sembrar import pesos_zipf
+
+
+def cargar_mezcla(ruta: str) -> list:
+    with open(ruta) as fichero:
+        return [json.loads(linea) for linea in fichero if linea.strip()]
+
+
+def _sustituir(valor, variables: dict):
+    if isinstance(valor, str):
+        return valor.format(**variables)
+    if isinstance(valor, dict):
+        return {clave: _sustituir(v, variables) for clave, v in valor.items()}
+    if isinstance(valor, list):
+        return [_sustituir(v, variables) for v in valor]
+    return valor
+
+
+def percentil(ordenadas: list, p: float) -> float:
+    if not ordenadas:
+        return 0.0
+    indice = min(len(ordenadas) - 1, int(round(p / 100 * (len(ordenadas) - 1))))
+    return ordenadas[indice]
+
+
+def _commit_actual() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+class Reproductor:
+    def __init__(self, mezcla: list, manifiesto: dict, semilla: int):
+        self.mezcla = mezcla
+        self.pesos = [entrada["peso"] for entrada in mezcla]
+        self.usuarios = manifiesto["usuarios"]
+        self.acumulados = pesos_zipf(len(self.usuarios), manifiesto.get("zipf", 1.1))
+        self.manifiesto = manifiesto
+        self.rnd = random.Random(semilla)
+        self.latencias = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.rechazos = defaultdict(int)
+        self.errores_cliente = defaultdict(int)
+
+    def _peticion(self, entrada: dict) -> dict:
+        usuario = self.rnd.choices(self.usuarios, cum_weights=self.acumulados)[0]
+        otro = usuario
+        while otro == usuario:
+            otro = self.usuarios[self.rnd.randrange(len(self.usuarios))]
+        variables = {
+            "usuario": usuario,
+            "otro": otro,
+            "correo": self.rnd.choice(self.manifiesto["correos"]),
+            "contrasena": self.manifiesto["contrasena"],
+        }
+
+        peticion = {"method": entrada["metodo"], "url": _sustituir(entrada["ruta"], variables)}
+        if "params" in entrada:
+            peticion["params"] = _sustituir(entrada["params"], variables)
+        if "cuerpo" in entrada:
+            peticion["json"] = _sustituir(entrada["cuerpo"], variables)
+        if entrada.get("auth"):
+            from app.utils.jwt_handler import create_jwt_token
+
+            peticion["headers"] = {"Authorization": f"Bearer {create_jwt_token({'sub': usuario})}"}
+        return peticion
+
+    async def trabajador(self, cliente: httpx.AsyncClient, fin: float):
+        while time.perf_counter() < fin:
+            entrada = self.rnd.choices(self.mezcla, weights=self.pesos)[0]
+            peticion = self._peticion(entrada)
+            nombre = entrada["nombre"]
+            inicio = time.perf_counter()
+            try:
+                respuesta = await cliente.request(**peticion)
+                estado = respuesta.status_code
+            except httpx.HTTPError:
+                estado = None
+            duracion = time.perf_counter() - inicio
+            if estado is None or estado >= 500:
+                self.errores[nombre] += 1
+            elif estado == 429:
+                self.rechazos[nombre] += 1
+            elif estado >= 400:
+                self.errores_cliente[nombre] += 1
+            else:
+                self.latencias[nombre].append(duracion)
+
+    def resumen(self, duracion: float) -> dict:
+        rutas = {}
+        nombres = set(self.latencias) | set(self.errores) | set(self.rechazos) | set(self.errores_cliente)
+        for nombre in sorted(nombres):
+            ordenadas = sorted(self.latencias[nombre])
+            rutas[nombre] = {
+                "peticiones": len(ordenadas),
+                "errores": self.errores[nombre],
+                "rechazos_429": self.rechazos[nombre],
+                "errores_4xx": self.errores_cliente[nombre],
+                "rps": round(len(ordenadas) / duracion, 2),
+                "p50_ms": round(percentil(ordenadas, 50) * 1000, 3),
+                "p95_ms": round(percentil(ordenadas, 95) * 1000, 3),
+                "p99_ms": round(percentil(ordenadas, 99) * 1000, 3),
+                "max_ms": round(ordenadas[-1] * 1000, 3) if ordenadas else 0.0,
+            }
+        total = sum(r["peticiones"] for r in rutas.values())
+        return {"rutas": rutas, "total": {"peticiones": total, "rps": round(total / duracion, 2)}}
+
+
+async def ejecutar(args) -> dict:
+    mezcla = cargar_mezcla(args.carga)
+    with open(args.manifiesto) as fichero:
+        manifiesto = json.load(fichero)
+    reproductor = Reproductor(mezcla, manifiesto, args.semilla)
+
+    async with contextlib.AsyncExitStack() as pila:
+        if args.url:
+            cliente = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        else:
+            if not args.con_limites:
+                # Debe fijarse antes de importar la app: los límites se leen al importar
+                os.environ["ADMISION_LIMITES"] = json.dumps({"*": [0, 0]})
+            from app.main import app
+
+            await pila.enter_async_context(app.router.lifespan_context(app))
+            transporte = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+            cliente = httpx.AsyncClient(
+                transport=transporte, base_url="http://benchmark", timeout=args.timeout
+            )
+        await pila.enter_async_context(cliente)
+
+        inicio = time.perf_counter()
+        fin = inicio + args.duracion
+        await asyncio.gather(*(reproductor.trabajador(cliente, fin) for _ in range(args.concurrencia)))
+        duracion = time.perf_counter() - inicio
+
+    return {
+        "commit": _commit_actual(),
+        "fecha": datetime.utcnow().isoformat(),
+        "configuracion": {
+            "objetivo": args.url or "app.main:app",
+            "duracion_s": args.duracion,
+            "concurrencia": args.concurrencia,
+            "carga": args.carga,
+            "usuarios": len(manifiesto["usuarios"]),
+            "transacciones_sembradas": manifiesto.get("transacciones"),
+            "semilla": args.semilla,
+            # Con --url depende de cómo se arrancó el servidor
+            "limites_admision": None if args.url else args.con_limites,
+        },
+        **reproductor.resumen(duracion),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--carga", default=os.path.join("benchmarks", "carga.jsonl"))
+    parser.add_argument("--manifiesto", default=os.path.join("benchmarks", "manifiesto.json"))
+    parser.add_argument("--url", help="Servidor a medir; si se omite se usa app.main:app en proceso")
+    parser.add_argument("--duracion", type=float, default=30.0, help="Segundos de carga")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument(
+        "--con-limites", action="store_true", help="Mantiene los límites de admisión en la app en proceso"
+    )
+    parser.add_argument("--salida", help="Ruta del JSON; por defecto benchmarks/resultados/<commit>.json")
+    args = parser.parse_args()
+
+    resultado = asyncio.run(ejecutar(args))
+    salida = args.salida or os.path.join("benchmarks", "resultados", f"{resultado['commit'][:12]}.json")
+    os.makedirs(os.path.dirname(salida) or ".", exist_ok=True)
+    with open(salida, "w") as fichero:
+        json.dump(resultado, fichero, indent=2)
+
+    for nombre, ruta in resultado["rutas"].items():
+        print(
+            f"{nombre:<20} {ruta['rps']:>9.1f} req/s  p50 {ruta['p50_ms']:>8.2f} ms  "
+            f"p95 {ruta['p95_ms']:>8.2f} ms  p99 {ruta['p99_ms']:>8.2f} ms  errores {ruta['errores']}  "
+            f"429 {ruta['rechazos_429']}  4xx {ruta['errores_4xx']}"
+        )
+    print(f"Resultado guardado en {salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Siembra usuarios y transacciones sintéticas para los benchmarks.
+
+Las cuentas siguen una distribución Zipf: unas pocas cuentas "calientes"
+concentran la mayoría de los movimientos, como pasa en producción.
+
+    MONGODB_URI=... python -m benchmarks.sembrar --usuarios 10000 --transacciones 5000000
+
+El ledger queda consistente con los saldos (cada usuario recibe una
+asignación inicial y su saldo final es la suma de sus movimientos) y el
+orden de las cuentas por popularidad se guarda en el manifiesto que usa
+`benchmarks.reproducir`.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+from app.db.mongo import DATABASE_NAME, MONGO_URI
+
+SALDO_INICIAL = 1_000_000.0
+TAMANO_LOTE = 10_000
+CONTRASENA_BENCHMARK = "benchmark"
+
+# Mezcla de tipos de transacción sembrados (tipo, estado, peso)
+MEZCLA_TIPOS = [
+    ("transferencia", "completed", 70),
+    ("servicio", "completed", 20),
+    ("servicio", "pending", 5),
+    ("asignacion", "completed", 5),
+]
+
+
+def pesos_zipf(n: int, s: float):
+    """Pesos acumulados de una Zipf(s) sobre n rangos."""
+    return list(itertools.accumulate(1.0 / (rango ** s) for rango in range(1, n + 1)))
+
+
+def _hash_contrasena() -> str:
+    from app.utils.hashing import pwd_context
+
+    return pwd_context.hash(CONTRASENA_BENCHMARK)
+
+
+def limpiar(db) -> None:
+    """Borra los datos de benchmarks previos, incluido lo que escribió la reproducción.
+
+    `benchmarks.reproducir` crea movimientos y resúmenes a través de la API,
+    que no los marca con `benchmark`; se reconocen por tener un usuario de
+    benchmark como emisor, receptor o titular.
+    """
+    ids = [str(u["_id"]) for u in db.usuarios.find({"benchmark": True}, {"_id": 1})]
+    for inicio_lote in range(0, len(ids), TAMANO_LOTE):
+        lote = ids[inicio_lote : inicio_lote + TAMANO_LOTE]
+        db.transacciones_moneda.delete_many(
+            {"$or": [{"id_emisor": {"$in": lote}}, {"id_receptor": {"$in": lote}}]}
+        )
+        db.resumen_diario.delete_many({"usuario": {"$in": lote}})
+    db.transacciones_moneda.delete_many({"benchmark": True})
+    db.usuarios.delete_many({"benchmark": True})
+
+
+def sembrar(args) -> dict:
+    rnd = random.Random(args.semilla)
+    db = MongoClient(MONGO_URI)[DATABASE_NAME]
+    if args.limpiar:
+        limpiar(db)
+
+    ids = [ObjectId() for _ in range(args.usuarios)]
+    hashed = _hash_contrasena()
+    ahora = datetime.utcnow()
+    inicio = ahora - timedelta(days=args.dias)
+
+    usuarios = [
+        {
+            "_id": user_id,
+            "nombres": f"Usuario{i}",
+            "apellidos": "Benchmark",
+            "correo": f"bench{i}@ejemplo.com",
+            "hashed_password": hashed,
+            "rol": "admin" if i == 0 else "user",
+            "saldo_creditos": 0.0,
+            "benchmark": True,
+        }
+        for i, user_id in enumerate(ids)
+    ]
+    for inicio_lote in range(0, len(usuarios), TAMANO_LOTE):
+        db.usuarios.insert_many(usuarios[inicio_lote : inicio_lote + TAMANO_LOTE], ordered=False)
+
+    netos = {user_id: SALDO_INICIAL for user_id in ids}
+    asignaciones = [
+        {
+            "id_emisor": "admin",
+            "id_receptor": str(user_id),
+            "monto": SALDO_INICIAL,
+            "tipo": "asignacion",
+            "estado": "completed",
+            "justificacion": "Saldo inicial de benchmark",
+            "fecha": inicio,
+            "benchmark": True,
+        }
+        for user_id in ids
+    ]
+    for inicio_lote in range(0, len(asignaciones), TAMANO_LOTE):
+        db.transacciones_moneda.insert_many(asignaciones[inicio_lote : inicio_lote + TAMANO_LOTE], ordered=False)
+
+    acumulados = pesos_zipf(len(ids), args.zipf)
+    tipos = [(tipo, estado) for tipo, estado, _ in MEZCLA_TIPOS]
+    pesos_tipos = [peso for _, _, peso in MEZCLA_TIPOS]
+    segundos = args.dias * 86400
+
+    t0 = time.perf_counter()
+    restantes = args.transacciones
+    while restantes > 0:
+        n = min(TAMANO_LOTE, restantes)
+        emisores = rnd.choices(ids, cum_weights=acumulados, k=n)
+        receptores = rnd.choices(ids, cum_weights=acumulados, k=n)
+        lote = []
+        for emisor, receptor, (tipo, estado) in zip(
+            emisores, receptores, rnd.choices(tipos, weights=pesos_tipos, k=n)
+        ):
+            if emisor == receptor:
+                receptor = ids[rnd.randrange(len(ids))]
+                if emisor == receptor:
+                    continue
+            monto = round(rnd.uniform(1, 50), 2)
+            doc = {
+                "id_emisor": "admin" if tipo == "asignacion" else str(emisor),
+                "id_receptor": str(receptor),
+                "monto": monto,
+                "tipo": tipo,
+                "estado": estado,
+                "justificacion": f"Benchmark {tipo}",
+                "fecha": inicio + timedelta(seconds=rnd.randrange(segundos)),
+                "benchmark": True,
+            }
+            if tipo == "servicio":
+                doc["id_servicio"] = f"srv-{rnd.randrange(1000)}"
+            lote.append(doc)
+            if estado == "completed":
+                netos[receptor] += monto
+                if tipo != "asignacion":
+                    netos[emisor] -= monto
+        if lote:
+            db.transacciones_moneda.insert_many(lote, ordered=False)
+        restantes -= n
+        hechas = args.transacciones - restantes
+        print(f"{hechas}/{args.transacciones} transacciones ({hechas / (time.perf_counter() - t0):.0f}/s)")
+
+    operaciones = [UpdateOne({"_id": user_id}, {"$set": {"saldo_creditos": saldo}}) for user_id, saldo in netos.items()]
+    for inicio_lote in range(0, len(operaciones), TAMANO_LOTE):
+        db.usuarios.bulk_write(operaciones[inicio_lote : inicio_lote + TAMANO_LOTE], ordered=False)
+
+    return {
+        "usuarios": [str(user_id) for user_id in ids],
+        "zipf": args.zipf,
+        "contrasena": CONTRASENA_BENCHMARK,
+        "correos": [u["correo"] for u in usuarios[:100]],
+        "transacciones": args.transacciones,
+        "semilla": args.semilla,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=10_000)
+    parser.add_argument("--transacciones", type=int, default=100_000)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Exponente de la distribución de cuentas")
+    parser.add_argument("--dias", type=int, default=730, help="Antigüedad máxima de las transacciones")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--limpiar", action="store_true", help="Borra antes los datos de un benchmark previo")
+    parser.add_argument("--manifiesto", default=os.path.join("benchmarks", "manifiesto.json"))
+    args = parser.parse_args()
+
+    manifiesto = sembrar(args)
+
+    from app.db.indices import crear_indices
+
+    asyncio.run(crear_indices())
+    with open(args.manifiesto, "w") as fichero:
+        json.dump(manifiesto, fichero)
+    print(f"Manifiesto escrito en {args.manifiesto}")
+
+
+if __name__ == "__main__":
+    main()
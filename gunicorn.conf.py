@@ -0,0 +1,42 @@
+"""Configuración de gunicorn: varios workers de uvicorn con métricas agregadas.
+
+    gunicorn app.main:app -c gunicorn.conf.py
+
+`WEB_CONCURRENCY` fija el número de workers (por defecto, uno por núcleo).
+Las métricas de todos los workers se escriben en `PROMETHEUS_MULTIPROC_DIR`
+y `/metrics` las agrega, responda el worker que responda.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+
+# Debe fijarse antes de que los workers importen prometheus_client
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus_multiproc")
+)
+PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Sin preload: cada worker importa la app tras el fork y crea su propio
+# cliente de Mongo (y sus hilos de monitorización) en el lifespan
+preload_app = False
+# Margen para terminar las requests en curso al reiniciar; las conexiones
+# SSE abiertas se cortan al agotarlo y el cliente reconecta con Last-Event-ID
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+
+def on_starting(server):
+    # Los ficheros de una ejecución anterior sumarían contadores viejos
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    for fichero in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, "*.db")):
+        os.remove(fichero)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # Quita los gauges "live" del worker muerto; sus contadores se conservan
+    multiprocess.mark_process_dead(worker.pid)
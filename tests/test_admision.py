@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.utils import admision
+from app.utils.admision import CubosMemoria, LimiteConcurrencia
+
+
+def test_el_cupo_pasa_al_primero_de_la_cola():
+    async def escenario():
+        limite = LimiteConcurrencia(maximo=1, cola=5, espera=1)
+        assert await limite.entrar()
+        primera = asyncio.create_task(limite.entrar())
+        await asyncio.sleep(0)
+
+        await limite.salir()
+        # Llega otra antes de que la encolada despierte: no puede adelantarse
+        recien_llegada = asyncio.create_task(limite.entrar())
+        await asyncio.sleep(0)
+
+        assert await primera
+        assert not recien_llegada.done()
+        await limite.salir()
+        assert await recien_llegada
+        await limite.salir()
+        return limite
+
+    limite = asyncio.run(escenario())
+
+    assert limite._en_curso == 0
+    assert not limite._esperando
+
+
+def test_cola_llena_y_espera_agotada_rechazan():
+    async def escenario():
+        limite = LimiteConcurrencia(maximo=1, cola=1, espera=0.01)
+        assert await limite.entrar()
+        encolada = asyncio.create_task(limite.entrar())
+        await asyncio.sleep(0)
+
+        assert not await limite.entrar()
+        assert not await encolada
+        return limite
+
+    limite = asyncio.run(escenario())
+
+    assert limite._en_curso == 1
+    assert not limite._esperando
+
+
+def test_cancelada_tras_recibir_el_cupo_lo_devuelve():
+    async def escenario():
+        limite = LimiteConcurrencia(maximo=1, cola=5, espera=1)
+        assert await limite.entrar()
+        encolada = asyncio.create_task(limite.entrar())
+        await asyncio.sleep(0)
+
+        # El cupo se le entrega y la cancelación llega antes de que despierte
+        await limite.salir()
+        encolada.cancel()
+        (resultado,) = await asyncio.gather(encolada, return_exceptions=True)
+        # Según la versión, `wait_for` devuelve el cupo ya entregado o propaga
+        # la cancelación; en ningún caso puede quedarse colgado
+        if resultado is True:
+            await limite.salir()
+        else:
+            assert isinstance(resultado, asyncio.CancelledError)
+
+        assert limite._en_curso == 0
+        assert await limite.entrar()
+
+    asyncio.run(escenario())
+
+
+def test_cancelada_en_espera_no_toca_el_cupo():
+    async def escenario():
+        limite = LimiteConcurrencia(maximo=1, cola=5, espera=1)
+        assert await limite.entrar()
+        encolada = asyncio.create_task(limite.entrar())
+        await asyncio.sleep(0)
+
+        encolada.cancel()
+        await asyncio.gather(encolada, return_exceptions=True)
+
+        assert limite._en_curso == 1
+        assert not limite._esperando
+
+    asyncio.run(escenario())
+
+
+def test_cubo_de_tokens_se_rellena_con_el_tiempo(monkeypatch):
+    reloj = SimpleNamespace(ahora=1000.0)
+    monkeypatch.setattr(admision, "time", SimpleNamespace(monotonic=lambda: reloj.ahora))
+    cubos = CubosMemoria()
+
+    def consumir():
+        return asyncio.run(cubos.consumir("ruta|ip:1", tasa=2, rafaga=3))
+
+    assert [consumir() for _ in range(3)] == [0, 0, 0]
+    assert consumir() == 0.5
+
+    reloj.ahora += 0.5
+    assert consumir() == 0
+    assert consumir() == 0.5
+
+    # Nunca acumula más que la ráfaga
+    reloj.ahora += 60
+    assert [consumir() for _ in range(3)] == [0, 0, 0]
+    assert consumir() > 0
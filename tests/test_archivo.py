@@ -0,0 +1,155 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from app.db import archivo
+from app.routers.transacciones import _clave_fila
+
+USUARIO = str(ObjectId())
+AHORA = datetime.utcnow()
+# Doce particiones mensuales, todas por debajo del horizonte del archivador
+MESES = [archivo._mes(AHORA - timedelta(days=400 + 31 * i)) for i in range(12)]
+PARTICIONES = [archivo.nombre_particion(mes) for mes in MESES]
+
+
+class _Cursor:
+    def __init__(self, documentos):
+        self.documentos = list(documentos)
+
+    def sort(self, campo, direccion):
+        self.documentos.sort(key=lambda d: d[campo], reverse=direccion < 0)
+        return self
+
+    async def to_list(self, _):
+        return self.documentos
+
+
+class _Coleccion:
+    def __init__(self, documentos):
+        self.documentos = documentos
+        self.consultas = 0
+
+    def find(self, filtro, proyeccion=None, session=None):
+        self.consultas += 1
+
+        def cumple(documento):
+            for campo, condicion in filtro.items():
+                if isinstance(condicion, dict):
+                    if documento.get(campo) == condicion["$ne"]:
+                        return False
+                elif documento.get(campo) != condicion:
+                    return False
+            return True
+
+        return _Cursor(d for d in self.documentos if cumple(d))
+
+
+def _catalogo(indexadas=True):
+    return _Coleccion(
+        [
+            {"_id": nombre, "hasta": archivo._mes_siguiente(mes), "usuarios_indexados": indexadas}
+            for nombre, mes in zip(PARTICIONES, MESES)
+        ]
+    )
+
+
+def _orden_mongo(fila):
+    # Orden descendente de Mongo: los documentos sin `fecha` van al final
+    return fila["fecha"] is not None, fila["fecha"] or datetime.min, fila["_id"]
+
+
+def _mezclar(monkeypatch, filas, usuarios, catalogo, maximo=None, orden=None, envolver=None):
+    """Ejecuta `mezclar` sobre fuentes en memoria y devuelve (filas, fuentes abiertas)."""
+    monkeypatch.setattr(archivo, "transacciones_lectura", "caliente")
+    monkeypatch.setattr(archivo, "coleccion", lambda nombre, lectura=False: nombre)
+    monkeypatch.setattr(archivo, "archivo_usuarios_lectura", usuarios)
+    monkeypatch.setattr(archivo, "archivo_particiones_lectura", catalogo)
+    abiertas = []
+
+    async def abrir(coleccion):
+        abiertas.append(coleccion)
+        for fila in sorted(filas.get(coleccion, []), key=_orden_mongo, reverse=True):
+            yield envolver(fila) if envolver else fila
+
+    async def recorrer():
+        cursor = archivo.mezclar(abrir, orden or (lambda f: (f["fecha"], f["_id"])), USUARIO, maximo=maximo)
+        return [fila async for fila in cursor]
+
+    return asyncio.run(recorrer()), abiertas
+
+
+def _fila(fecha):
+    return {"_id": ObjectId(), "fecha": fecha}
+
+
+def test_historial_corto_solo_abre_las_particiones_del_usuario(monkeypatch):
+    filas = {
+        "caliente": [_fila(AHORA - timedelta(days=d)) for d in (1, 2, 3)],
+        PARTICIONES[2]: [_fila(MESES[2] + timedelta(days=5))],
+    }
+    usuarios = _Coleccion(
+        [{"usuario": USUARIO, "particion": PARTICIONES[2], "hasta": archivo._mes_siguiente(MESES[2])}]
+    )
+
+    resultado, abiertas = _mezclar(monkeypatch, filas, usuarios, _catalogo())
+
+    assert len(resultado) == 4
+    assert abiertas == ["caliente", PARTICIONES[2]]
+
+
+def test_usuario_sin_archivo_no_abre_particiones(monkeypatch):
+    filas = {"caliente": [_fila(AHORA - timedelta(days=1))]}
+
+    resultado, abiertas = _mezclar(monkeypatch, filas, _Coleccion([]), _catalogo())
+
+    assert len(resultado) == 1
+    assert abiertas == ["caliente"]
+
+
+def test_no_lee_el_archivo_tras_completar_la_pagina(monkeypatch):
+    filas = {"caliente": [_fila(AHORA - timedelta(days=d)) for d in (1, 2, 3)]}
+    usuarios = _Coleccion(
+        [
+            {"usuario": USUARIO, "particion": nombre, "hasta": archivo._mes_siguiente(mes)}
+            for nombre, mes in zip(PARTICIONES, MESES)
+        ]
+    )
+
+    resultado, abiertas = _mezclar(monkeypatch, filas, usuarios, _catalogo(), maximo=3)
+
+    assert len(resultado) == 3
+    assert abiertas == ["caliente"]
+    assert usuarios.consultas == 0
+
+
+def test_particiones_sin_indexar_se_abren_igualmente(monkeypatch):
+    filas = {PARTICIONES[0]: [_fila(MESES[0] + timedelta(days=1))]}
+
+    resultado, abiertas = _mezclar(monkeypatch, filas, _Coleccion([]), _catalogo(indexadas=False))
+
+    assert len(resultado) == 1
+    assert abiertas == ["caliente", *PARTICIONES]
+
+
+def test_documento_sin_fecha_se_mezcla_con_el_archivo(monkeypatch):
+    reciente = _fila(AHORA - timedelta(days=1))
+    sin_fecha = {"_id": ObjectId()}
+    archivada = _fila(MESES[0] + timedelta(days=1))
+    filas = {"caliente": [reciente, {**sin_fecha, "fecha": None}], PARTICIONES[0]: [archivada]}
+    usuarios = _Coleccion(
+        [{"usuario": USUARIO, "particion": PARTICIONES[0], "hasta": archivo._mes_siguiente(MESES[0])}]
+    )
+
+    def envolver(fila):
+        # Como el motor python: (fila formateada, documento crudo sin `fecha`)
+        documento = {k: v for k, v in fila.items() if v is not None}
+        return {"id": str(fila["_id"])}, documento
+
+    resultado, abiertas = _mezclar(
+        monkeypatch, filas, usuarios, _catalogo(), orden=_clave_fila, envolver=envolver
+    )
+
+    esperados = [reciente, archivada, sin_fecha]
+    assert [fila["id"] for fila, _ in resultado] == [str(d["_id"]) for d in esperados]
+    assert abiertas == ["caliente", PARTICIONES[0]]
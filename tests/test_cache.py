@@ -0,0 +1,81 @@
+from app.utils import cache
+from app.utils.cache import CacheLRU
+
+
+class _Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+def _cache(monkeypatch, capacidad=2, ttl=10):
+    reloj = _Reloj()
+    monkeypatch.setattr(cache.time, "monotonic", reloj)
+    return CacheLRU("prueba", capacidad=capacidad, ttl=ttl), reloj
+
+
+def test_entrada_caduca_al_cumplir_el_ttl(monkeypatch):
+    perfiles, reloj = _cache(monkeypatch)
+    perfiles.guardar("a", 1)
+
+    reloj.ahora += 9.9
+    assert perfiles.obtener("a") == 1
+
+    reloj.ahora += 0.1
+    assert perfiles.obtener("a") is None
+    assert len(perfiles) == 0
+
+
+def test_ttl_por_entrada(monkeypatch):
+    perfiles, reloj = _cache(monkeypatch)
+    perfiles.guardar("corta", 1, ttl=1)
+    perfiles.guardar("larga", 2)
+
+    reloj.ahora += 5
+
+    assert perfiles.obtener("corta") is None
+    assert perfiles.obtener("larga") == 2
+
+
+def test_desaloja_la_menos_usada_recientemente(monkeypatch):
+    perfiles, _ = _cache(monkeypatch)
+    perfiles.guardar("a", 1)
+    perfiles.guardar("b", 2)
+
+    # Leer `a` la convierte en la más reciente: sale `b`
+    perfiles.obtener("a")
+    perfiles.guardar("c", 3)
+
+    assert perfiles.obtener("b") is None
+    assert perfiles.obtener("a") == 1
+    assert perfiles.obtener("c") == 3
+
+
+def test_reescribir_una_clave_la_renueva(monkeypatch):
+    perfiles, reloj = _cache(monkeypatch)
+    perfiles.guardar("a", 1)
+    perfiles.guardar("b", 2)
+
+    reloj.ahora += 8
+    perfiles.guardar("a", 10)
+    perfiles.guardar("c", 3)
+    reloj.ahora += 8
+
+    assert perfiles.obtener("a") == 10
+    assert perfiles.obtener("b") is None
+
+
+def test_invalidar_y_limpiar(monkeypatch):
+    perfiles, _ = _cache(monkeypatch)
+    perfiles.guardar("a", 1)
+    perfiles.guardar("b", 2)
+
+    perfiles.invalidar("a")
+    perfiles.invalidar("inexistente")
+    assert perfiles.obtener("a") is None
+    assert len(perfiles) == 1
+
+    perfiles.limpiar()
+    assert len(perfiles) == 0
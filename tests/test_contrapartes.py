@@ -0,0 +1,78 @@
+import asyncio
+
+from bson import ObjectId
+
+from app.utils import contrapartes, perfiles
+from app.utils.cache import CacheLRU
+from app.utils.contrapartes import ResolutorContrapartes
+
+
+class _Cursor:
+    def __init__(self, documentos):
+        self.documentos = documentos
+
+    def __aiter__(self):
+        return self._iterar()
+
+    async def _iterar(self):
+        for documento in self.documentos:
+            yield documento
+
+
+class _Usuarios:
+    def __init__(self, documentos):
+        self.documentos = {d["_id"]: d for d in documentos}
+        self.lotes = []
+
+    def find(self, filtro, proyeccion):
+        ids = filtro["_id"]["$in"]
+        self.lotes.append(len(ids))
+        return _Cursor([self.documentos[i] for i in ids if i in self.documentos])
+
+
+def _resolver(monkeypatch, usuarios, user_ids, tamano_lote=2, en_cache=()):
+    cache = CacheLRU("perfiles_prueba", capacidad=100, ttl=60)
+    for user_id, perfil in en_cache:
+        cache.guardar(user_id, perfil)
+    monkeypatch.setattr(perfiles, "cache_perfiles", cache)
+    monkeypatch.setattr(contrapartes, "cache_perfiles", cache)
+    monkeypatch.setattr(contrapartes, "usuarios_lectura", usuarios)
+    resolutor = ResolutorContrapartes(tamano_lote=tamano_lote)
+    asyncio.run(resolutor.cargar(user_ids))
+    return resolutor, cache
+
+
+def test_resuelve_por_lotes_sin_repetir_usuarios(monkeypatch):
+    ids = [ObjectId() for _ in range(3)]
+    usuarios = _Usuarios([{"_id": i, "nombres": f"U{n}", "apellidos": "X"} for n, i in enumerate(ids)])
+    repetidos = [str(i) for i in ids] * 4
+
+    resolutor, cache = _resolver(monkeypatch, usuarios, repetidos)
+
+    assert usuarios.lotes == [2, 1]
+    assert resolutor.consultas == 2
+    assert resolutor.obtener(str(ids[2]))["name"] == "U2 X"
+    # Lo leído queda en la caché de perfiles para el siguiente request
+    assert cache.obtener(str(ids[0])) is not None
+
+    asyncio.run(resolutor.cargar(repetidos))
+    assert resolutor.consultas == 2
+
+
+def test_cache_admin_y_usuarios_borrados_no_van_a_mongo(monkeypatch):
+    en_cache, borrado = str(ObjectId()), str(ObjectId())
+    usuarios = _Usuarios([])
+    perfil = {"nombres": "Ana", "apellidos": None, "foto_url": "/fotos/ana.png"}
+
+    resolutor, _ = _resolver(
+        monkeypatch, usuarios, [en_cache, "admin", borrado, None], en_cache=[(en_cache, perfil)]
+    )
+
+    assert usuarios.lotes == [1]
+    assert resolutor.obtener(en_cache) == {
+        "id": en_cache,
+        "name": "Ana",
+        "avatar": f"{contrapartes.USUARIOS_API_BASE_URL}/fotos/ana.png",
+    }
+    assert resolutor.obtener("admin") == {"id": "admin", "name": "Usuario", "avatar": ""}
+    assert resolutor.obtener(borrado)["name"] == "Usuario"
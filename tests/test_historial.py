@@ -0,0 +1,48 @@
+import asyncio
+
+from starlette.requests import Request
+
+from app.routers import transacciones
+
+
+class _Sesion:
+    def __init__(self):
+        self.cerrada = False
+
+    def end_session(self):
+        self.cerrada = True
+
+
+def test_stream_ndjson_cierra_la_sesion_si_el_cliente_se_va_antes_del_cuerpo(monkeypatch):
+    sesion = _Sesion()
+
+    async def sesion_lectura(request, siempre=False):
+        return sesion
+
+    async def version_ledger(user_id, coleccion, session):
+        return None
+
+    async def filas():
+        yield {"id": "1"}, {"_id": "1"}
+
+    monkeypatch.setattr(transacciones, "sesion_lectura", sesion_lectura)
+    monkeypatch.setattr(transacciones, "version_ledger", version_ledger)
+    monkeypatch.setattr(transacciones, "_filas_historial", lambda *args: filas())
+    request = Request(
+        {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept", b"application/x-ndjson")]}
+    )
+
+    async def recibir():
+        return {"type": "http.disconnect"}
+
+    async def enviar(mensaje):
+        # El cliente ya no está: el cuerpo nunca llega a pedirse
+        await asyncio.sleep(3600)
+
+    async def servir():
+        respuesta = await transacciones.historial_transacciones("u", request, limit=None, cursor=None)
+        await respuesta({"type": "http"}, recibir, enviar)
+
+    asyncio.run(servir())
+
+    assert sesion.cerrada
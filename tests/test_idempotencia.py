@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+from app.utils import idempotencia
+
+
+class _Coleccion:
+    """Registro `en_proceso` con la concesión vencida que nunca se deja tomar."""
+
+    def __init__(self, huella):
+        self.registro = {
+            "_id": "transferir:u:clave",
+            "huella": huella,
+            "estado": "en_proceso",
+            "propietario": "otro",
+            "expira": datetime.utcnow() - timedelta(seconds=1),
+        }
+        self.inserciones = 0
+
+    async def insert_one(self, documento):
+        self.inserciones += 1
+        raise DuplicateKeyError("duplicada")
+
+    async def find_one_and_update(self, filtro, actualizacion):
+        return None
+
+    async def find_one(self, filtro):
+        return self.registro
+
+
+def _ejecutar(monkeypatch, coleccion, payload):
+    monkeypatch.setattr(idempotencia, "idempotencia_collection", coleccion)
+
+    async def operacion(registro):
+        raise AssertionError("no debe ejecutarse")
+
+    return asyncio.run(idempotencia.ejecutar_idempotente("clave", "transferir:u", payload, operacion))
+
+
+def test_clave_reutilizada_con_otro_payload_y_concesion_vencida_da_422(monkeypatch):
+    coleccion = _Coleccion(huella="otra")
+
+    with pytest.raises(HTTPException) as error:
+        _ejecutar(monkeypatch, coleccion, {"monto": 1})
+
+    assert error.value.status_code == 422
+    assert coleccion.inserciones == 1
+
+
+def test_reclamar_la_clave_tiene_un_limite_de_vueltas(monkeypatch):
+    payload = {"monto": 1}
+    coleccion = _Coleccion(huella=idempotencia._huella(payload))
+
+    with pytest.raises(HTTPException) as error:
+        _ejecutar(monkeypatch, coleccion, payload)
+
+    assert error.value.status_code == 409
+    assert coleccion.inserciones == idempotencia.IDEMPOTENCIA_INTENTOS
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+from jose import JWTError, jwt
+
+from app.utils import jwt_handler
+from app.utils.cache import CacheLRU
+from app.utils.jwt_handler import ALGORITHM, SECRET_KEY, create_jwt_token, decodificar_token
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    nueva = CacheLRU("jwt_prueba", capacidad=10, ttl=3600)
+    monkeypatch.setattr(jwt_handler, "_cache_claims", nueva)
+    return nueva
+
+
+def test_token_repetido_no_se_vuelve_a_verificar(cache, monkeypatch):
+    token = create_jwt_token({"sub": "u"})
+    assert decodificar_token(token)["sub"] == "u"
+
+    def sin_verificar(*args, **kwargs):
+        raise AssertionError("debía servirse desde caché")
+
+    monkeypatch.setattr(jwt_handler.jwt, "decode", sin_verificar)
+    claims = decodificar_token(token)
+    claims["sub"] = "otro"
+
+    # Cada llamada recibe una copia: mutarla no altera la caché
+    assert decodificar_token(token)["sub"] == "u"
+
+
+def _vence_en(cache):
+    ((_, expira),) = cache._entradas.values()
+    return expira - time.monotonic()
+
+
+def test_la_entrada_vence_con_el_token(cache):
+    decodificar_token(jwt.encode({"sub": "u", "exp": int(time.time()) + 30}, SECRET_KEY, algorithm=ALGORITHM))
+
+    assert 25 < _vence_en(cache) <= 30
+
+
+def test_la_entrada_no_supera_el_ttl_maximo(cache):
+    cache.ttl = 5
+    decodificar_token(create_jwt_token({"sub": "u"}))
+
+    assert _vence_en(cache) <= 5
+
+
+def test_token_invalido_no_se_guarda(cache):
+    with pytest.raises(JWTError):
+        decodificar_token("no.es.jwt")
+
+    assert len(cache) == 0
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from app.utils.paginacion import codificar_cursor, decodificar_cursor, filtro_keyset
+
+
+def test_cursor_ida_y_vuelta():
+    documento = {"_id": ObjectId(), "fecha": datetime(2024, 3, 1, 12, 30, 15, 250000)}
+
+    token = codificar_cursor(documento)
+
+    assert "=" not in token
+    assert decodificar_cursor(token) == (documento["fecha"], documento["_id"])
+
+
+def test_cursor_sin_fecha():
+    documento = {"_id": ObjectId()}
+
+    assert decodificar_cursor(codificar_cursor(documento)) == (None, documento["_id"])
+
+
+@pytest.mark.parametrize("token", ["", "no-es-base64!", "eyJmIjpudWxsfQ", "eyJmIjpudWxsLCJpIjoieCJ9"])
+def test_cursor_invalido_da_400(token):
+    with pytest.raises(HTTPException) as error:
+        decodificar_cursor(token)
+
+    assert error.value.status_code == 400
+
+
+def test_filtro_keyset_excluye_los_empates_ya_servidos():
+    fecha, ultimo_id = datetime(2024, 3, 1), ObjectId()
+
+    filtro = filtro_keyset(codificar_cursor({"_id": ultimo_id, "fecha": fecha}))
+
+    assert filtro == {
+        "fecha": {"$lte": fecha},
+        "$nor": [{"fecha": fecha, "_id": {"$gte": ultimo_id}}],
+    }
+
+
+def test_filtro_keyset_tras_un_documento_sin_fecha():
+    ultimo_id = ObjectId()
+
+    assert filtro_keyset(codificar_cursor({"_id": ultimo_id})) == {"fecha": None, "_id": {"$lt": ultimo_id}}
@@ -0,0 +1,104 @@
+import gzip
+
+from app.utils.pprof import _varint, codificar
+
+
+def _leer_varint(datos, posicion):
+    valor = desplazamiento = 0
+    while True:
+        byte = datos[posicion]
+        posicion += 1
+        valor |= (byte & 0x7F) << desplazamiento
+        desplazamiento += 7
+        if byte < 0x80:
+            return valor, posicion
+
+
+def _campos(datos):
+    """Decodifica un mensaje protobuf en una lista de (campo, valor)."""
+    campos, posicion = [], 0
+    while posicion < len(datos):
+        clave, posicion = _leer_varint(datos, posicion)
+        if clave & 7 == 0:
+            valor, posicion = _leer_varint(datos, posicion)
+        else:
+            assert clave & 7 == 2
+            longitud, posicion = _leer_varint(datos, posicion)
+            valor, posicion = datos[posicion : posicion + longitud], posicion + longitud
+        campos.append((clave >> 3, valor))
+    return campos
+
+
+def _empaquetados(datos):
+    valores, posicion = [], 0
+    while posicion < len(datos):
+        valor, posicion = _leer_varint(datos, posicion)
+        valores.append(valor)
+    return valores
+
+
+def _uno(campos, numero):
+    (valor,) = [v for c, v in campos if c == numero]
+    return valor
+
+
+def test_varint():
+    assert _varint(0) == b"\x00"
+    assert _varint(1) == b"\x01"
+    assert _varint(300) == b"\xac\x02"
+    # Los negativos se codifican en complemento a dos de 64 bits
+    assert _varint(-1) == b"\xff" * 9 + b"\x01"
+
+
+def test_perfil_con_funciones_y_ubicaciones_compartidas():
+    hoja = ("app/db.py", "consultar", 10, 12)
+    otra_linea = ("app/db.py", "consultar", 10, 15)
+    raiz = ("app/main.py", "historial", 1, 3)
+    muestras = {
+        ((("ruta", "/historial"),), (hoja, raiz)): [3, 30],
+        ((), (otra_linea, raiz)): [1, 10],
+    }
+
+    tipos = [("samples", "count"), ("cpu", "nanoseconds")]
+    perfil = _campos(gzip.decompress(codificar(muestras, tipos, ("cpu", "nanoseconds", 10), 5, 7)))
+
+    cadenas = [v.decode() for c, v in perfil if c == 6]
+    assert cadenas[0] == ""
+    leidos = [_campos(v) for c, v in perfil if c == 1]
+    assert [(cadenas[_uno(t, 1)], cadenas[_uno(t, 2)]) for t in leidos] == tipos
+    assert (_uno(perfil, 9), _uno(perfil, 10), _uno(perfil, 12)) == (5, 7, 10)
+
+    funciones = {}
+    for c, v in perfil:
+        if c == 5:
+            funcion = _campos(v)
+            archivo, nombre = cadenas[_uno(funcion, 4)], cadenas[_uno(funcion, 2)]
+            funciones[_uno(funcion, 1)] = (archivo, nombre, _uno(funcion, 5))
+    # Las dos líneas de `consultar` comparten función pero no ubicación
+    assert sorted(funciones.values()) == [("app/db.py", "consultar", 10), ("app/main.py", "historial", 1)]
+
+    ubicaciones = {}
+    for c, v in perfil:
+        if c == 4:
+            ubicacion = _campos(v)
+            linea = _campos(_uno(ubicacion, 4))
+            ubicaciones[_uno(ubicacion, 1)] = (funciones[_uno(linea, 1)][1], _uno(linea, 2))
+    assert len(ubicaciones) == 3
+
+    leidas = []
+    for c, v in perfil:
+        if c == 2:
+            muestra = _campos(v)
+            pila = [ubicaciones[i] for i in _empaquetados(_uno(muestra, 1))]
+            etiquetas = [_campos(e) for n, e in muestra if n == 3]
+            leidas.append(
+                (
+                    pila,
+                    _empaquetados(_uno(muestra, 2)),
+                    [(cadenas[_uno(e, 1)], cadenas[_uno(e, 2)]) for e in etiquetas],
+                )
+            )
+    assert leidas == [
+        ([("consultar", 12), ("historial", 3)], [3, 30], [("ruta", "/historial")]),
+        ([("consultar", 15), ("historial", 3)], [1, 10], []),
+    ]
@@ -0,0 +1,53 @@
+from bson import ObjectId
+from starlette.requests import Request
+
+from app.utils import perfiles
+from app.utils.respuestas import a_json, etag_version, no_modificado
+
+
+def _request(if_none_match=None):
+    cabeceras = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": cabeceras})
+
+
+def test_etag_version_con_variante_y_generacion():
+    assert etag_version(7) == 'W/"7"'
+    assert etag_version(7, "json") == 'W/"7-json"'
+    assert etag_version(7, "ndjson", 3) == 'W/"7.3-ndjson"'
+    assert etag_version(7, generacion=None) == 'W/"7"'
+
+
+def test_no_modificado_sin_cabecera_devuelve_none():
+    assert no_modificado(_request(), 'W/"7"') is None
+
+
+def test_no_modificado_compara_en_debil_y_en_listas():
+    respuesta = no_modificado(_request('"1", "7-json"'), 'W/"7-json"', "Accept")
+
+    assert respuesta.status_code == 304
+    assert respuesta.headers["ETag"] == 'W/"7-json"'
+    assert respuesta.headers["Vary"] == "Accept"
+
+
+def test_no_modificado_con_otra_version_o_comodin():
+    assert no_modificado(_request('W/"6"'), 'W/"7"') is None
+    assert no_modificado(_request("*"), 'W/"7"').status_code == 304
+
+
+def test_a_json_serializa_object_id():
+    _id = ObjectId()
+
+    assert a_json({"id": _id}) == f'{{"id":"{_id}"}}'.encode()
+
+
+def test_generacion_perfiles_por_ventanas_de_ttl(monkeypatch):
+    monkeypatch.setattr(perfiles.cache_perfiles, "ttl", 60)
+    monkeypatch.setattr(perfiles.time, "time", lambda: 125.0)
+
+    assert perfiles.generacion_perfiles() == 2
+
+
+def test_generacion_perfiles_con_cache_desactivada(monkeypatch):
+    monkeypatch.setattr(perfiles.cache_perfiles, "ttl", 0)
+
+    assert perfiles.generacion_perfiles() is None
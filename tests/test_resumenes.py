@@ -0,0 +1,90 @@
+import asyncio
+from datetime import date, datetime
+
+import pytest
+from fastapi import HTTPException
+
+from app.db import resumenes
+from app.db.resumenes import acumular, aportes, combinar, filtro_dias
+
+LUNES = datetime(2024, 6, 3)
+MARTES = datetime(2024, 6, 4)
+
+
+def _resumen(dia, tipo, **campos):
+    return {"usuario": "u", "dia": dia, "tipo": tipo, "origen": "vivo", **campos}
+
+
+def test_combinar_suma_vivo_y_reconstruccion_por_tipo_y_dia():
+    filas = [
+        _resumen(MARTES, "transferencia", enviado=5.0, n_enviados=1),
+        _resumen(LUNES, "transferencia", enviado=10.0, n_enviados=2, recibido=3.0, n_recibidos=1),
+        {**_resumen(LUNES, "transferencia", enviado=1.0, n_enviados=1), "origen": "reconstruccion"},
+        _resumen(LUNES, "asignacion", bonificado=50.0, n_bonificados=1),
+    ]
+
+    resultado = combinar(filas)
+
+    assert resultado["totales"] == {
+        "enviado": 16.0,
+        "n_enviados": 4,
+        "recibido": 3.0,
+        "n_recibidos": 1,
+        "bonificado": 50.0,
+        "n_bonificados": 1,
+    }
+    assert resultado["por_tipo"]["transferencia"]["enviado"] == 16.0
+    assert resultado["por_tipo"]["asignacion"]["enviado"] == 0
+    assert [(d["dia"], d["enviado"], d["bonificado"]) for d in resultado["por_dia"]] == [
+        ("2024-06-03", 11.0, 50.0),
+        ("2024-06-04", 5.0, 0),
+    ]
+
+
+def test_combinar_sin_resumenes():
+    resultado = combinar([])
+
+    assert set(resultado["totales"].values()) == {0}
+    assert resultado["por_tipo"] == {}
+    assert resultado["por_dia"] == []
+
+
+def test_aportes_de_asignacion_solo_bonifican_al_receptor():
+    assert aportes({"tipo": "asignacion", "id_emisor": "admin", "id_receptor": "r"}) == [("r", "bonificado")]
+    assert aportes({"id_emisor": "admin", "id_receptor": "r"}) == [("r", "bonificado")]
+    assert aportes({"id_emisor": "e", "id_receptor": "r"}) == [("e", "enviado"), ("r", "recibido")]
+
+
+def test_acumular_agrupa_por_usuario_dia_y_tipo(monkeypatch):
+    escrituras = []
+
+    class _Coleccion:
+        async def bulk_write(self, operaciones, ordered, session):
+            escrituras.extend(operaciones)
+
+    monkeypatch.setattr(resumenes, "resumenes_collection", _Coleccion())
+    movimientos = [
+        {"id_emisor": "e", "id_receptor": "r", "monto": 2, "fecha": LUNES.replace(hour=9)},
+        {"id_emisor": "e", "id_receptor": "r", "monto": 3, "fecha": LUNES.replace(hour=18)},
+        # Solicitud de servicio pendiente: todavía no ha movido saldo
+        {"tipo": "servicio", "estado": "pending", "id_emisor": "e", "id_receptor": "r", "monto": 7},
+    ]
+
+    asyncio.run(acumular(movimientos))
+
+    incrementos = {op._filter["usuario"]: op._doc["$inc"] for op in escrituras}
+    assert incrementos == {
+        "e": {"enviado": 5.0, "n_enviados": 2},
+        "r": {"recibido": 5.0, "n_recibidos": 2},
+    }
+    assert {op._filter["dia"] for op in escrituras} == {LUNES}
+
+
+def test_filtro_dias_inclusivo():
+    assert filtro_dias(None, None) == {}
+    filtro = filtro_dias(date(2024, 6, 3), date(2024, 6, 4))
+    assert filtro == {"dia": {"$gte": LUNES, "$lt": datetime(2024, 6, 5)}}
+
+    with pytest.raises(HTTPException) as error:
+        filtro_dias(date(2024, 6, 4), date(2024, 6, 3))
+    assert error.value.status_code == 400